@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+"""benchmarks for lazyblue's poll loop and state machine.
+
+Runs against fake screen lockers and a faked adapter, so needs no bluetooth
+device, and prints the results as JSON. Save the output of one version and
+pass it to --compare when running another to see what changed:
+
+    python bench_lazyblue.py --output before.json
+    python bench_lazyblue.py --compare before.json
+"""
+
+import argparse
+import errno
+import json
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import lazyblue
+
+class Settings(dict):
+  """stands in for lazyblue's parsed configuration."""
+  def __getattr__(self, key):
+    return self.get(key, None)
+
+class FakeConnection(object):
+  """a connection whose signal strength follows a repeating pattern."""
+  def __init__(self, strengths):
+    self.strengths = strengths
+    self.index = 0
+
+  def get_signal_strength(self):
+    strength = self.strengths[self.index % len(self.strengths)]
+    self.index += 1
+    return strength
+
+class FakeScreenLocker(object):
+  """a screen locker that runs nothing, noting the time of each lock."""
+  def __init__(self, clock=time.time):
+    self.clock = clock
+    self.locks = []
+    self.locked = False
+
+  def lock_screen(self):
+    self.locks.append(self.clock())
+    self.locked = True
+
+  def unlock_screen(self):
+    self.locked = False
+
+  def simulate_activity(self):
+    pass
+
+  def is_locked(self):
+    return self.locked
+
+  def reap(self):
+    return []
+
+  def watch_fds(self):
+    return []
+
+  def next_deadline(self):
+    return None
+
+class ReaderConnection(object):
+  """a connection that reads the signal strength through a real RSSI
+     reader, from an adapter whose answers follow a repeating pattern."""
+  def __init__(self, reader, adapter, strengths, mac="00:11:22:33:44:55"):
+    self.reader = reader
+    self.adapter = adapter
+    self.strengths = strengths
+    self.mac = mac
+    self.index = 0
+
+  def get_signal_strength(self):
+    strength = self.strengths[self.index % len(self.strengths)]
+    self.index += 1
+    self.adapter.set_strength(
+        None if strength == lazyblue._NOT_CONNECTED else strength)
+    strength = self.reader.read(self.mac)
+    if strength is None:
+      return lazyblue._NOT_CONNECTED
+    return strength
+
+class FakeHci(object):
+  """stands in for the bluez module and the HCI socket's ioctl, answering
+     Read RSSI for one connected device, so HciRssiReader runs as it would
+     against an adapter."""
+  error = IOError
+  OGF_STATUS_PARAM = 0x05
+  OCF_READ_RSSI = 0x05
+  EVT_CMD_COMPLETE = 0x0E
+  HANDLE = 11
+
+  class Socket(object):
+    def close(self):
+      pass
+
+  def __init__(self):
+    self.strength = None
+    self.saved = None
+
+  def set_strength(self, strength):
+    self.strength = strength
+
+  def hci_get_route(self):
+    return 0
+
+  def hci_open_dev(self, dev_id):
+    return self.Socket()
+
+  def hci_send_req(self, sock, ogf, ocf, event, length, params):
+    if self.strength is None:
+      return struct.pack("<BHb", 2, self.HANDLE, 0)
+    return struct.pack("<BHb", 0, self.HANDLE, self.strength)
+
+  def acl_handle(self, sock, mac):
+    if self.strength is None:
+      raise IOError(errno.ENOTCONN, os.strerror(errno.ENOTCONN))
+    return self.HANDLE
+
+  def __enter__(self):
+    self.saved = (lazyblue.bluez, lazyblue._acl_handle)
+    lazyblue.bluez = self
+    lazyblue._acl_handle = self.acl_handle
+    return self
+
+  def __exit__(self, *exc_info):
+    lazyblue.bluez, lazyblue._acl_handle = self.saved
+
+class FakeHcitool(object):
+  """puts a hcitool on PATH that answers for one connected device, so
+     HcitoolRssiReader forks and runs it as it would the real one."""
+  SCRIPT = ('#!/bin/sh\n'
+            '[ -n "$BENCH_RSSI" ] && echo "RSSI return value: $BENCH_RSSI"\n')
+
+  def __init__(self):
+    self.directory = None
+    self.path = None
+
+  def set_strength(self, strength):
+    os.environ["BENCH_RSSI"] = "" if strength is None else str(strength)
+
+  def __enter__(self):
+    self.directory = tempfile.mkdtemp()
+    script = os.path.join(self.directory, "hcitool")
+    with open(script, "w") as fd:
+      fd.write(self.SCRIPT)
+    os.chmod(script, 0755)
+    self.path = os.environ["PATH"]
+    os.environ["PATH"] = self.directory + os.pathsep + self.path
+    return self
+
+  def __exit__(self, *exc_info):
+    os.environ["PATH"] = self.path
+    os.environ.pop("BENCH_RSSI", None)
+    shutil.rmtree(self.directory)
+
+class ForkCounter(object):
+  """counts processes started while installed: calls to os.fork, which
+     subprocess uses, and to os.popen, which forks in C."""
+  def __init__(self):
+    self.forks = 0
+    self.fork = None
+    self.popen = None
+
+  def _fork(self):
+    self.forks += 1
+    return self.fork()
+
+  def _popen(self, *args):
+    self.forks += 1
+    return self.popen(*args)
+
+  def __enter__(self):
+    self.fork = os.fork
+    self.popen = os.popen
+    os.fork = self._fork
+    os.popen = self._popen
+    return self
+
+  def __exit__(self, *exc_info):
+    os.fork = self.fork
+    os.popen = self.popen
+
+def _cpu_time():
+  """user plus system CPU time used by this process so far."""
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+def _pattern(here, gone, period):
+  """strengths alternating between here and gone every period readings."""
+  return [here] * period + [gone] * period
+
+def _monitor(strengths, screenlocker, clock):
+  monitor = lazyblue.Monitor(FakeConnection(strengths), screenlocker,
+                             clock=clock)
+  monitor.vlock = FakeScreenLocker(clock)
+  return monitor
+
+def bench_poll(polls):
+  """the wall and CPU time and the forks of each Monitor.poll_now, with
+     real lock, unlock and status commands run for the device coming and
+     going, and the signal read by the native RSSI reader."""
+  lazyblue.config.update(lock_command="true", unlock_command="true",
+                         status_command="true")
+  clock = lazyblue.VirtualClock()
+  with FakeHci() as adapter:
+    monitor = lazyblue.Monitor(
+        ReaderConnection(lazyblue.HciRssiReader(0), adapter,
+                         _pattern(0, lazyblue._NOT_CONNECTED, 20)),
+        lazyblue.ScreenLocker(), clock=clock)
+    monitor.vlock = FakeScreenLocker(clock)
+    result = _time_polls(monitor, clock, polls)
+  for command in monitor.screenlocker.runner.running:
+    command.process.wait()
+  return result
+
+def _time_polls(monitor, clock, polls):
+  """poll monitor polls times, returning the wall and CPU time and forks
+     per poll."""
+  with ForkCounter() as counter:
+    wall = time.time()
+    cpu = _cpu_time()
+    for _ in xrange(polls):
+      clock.now = monitor.next_deadline()
+      monitor.poll_now()
+    cpu = _cpu_time() - cpu
+    wall = time.time() - wall
+  return {
+      "polls": polls,
+      "wall_seconds_per_poll": wall / polls,
+      "cpu_seconds_per_poll": cpu / polls,
+      "forks_per_poll": float(counter.forks) / polls,
+    }
+
+def bench_rssi_read(reads):
+  """the wall and CPU time and the forks of each signal strength read, for
+     each RSSI backend."""
+  strengths = _pattern(-5, lazyblue._NOT_CONNECTED, 20)
+  results = {"reads": reads}
+  for (name, adapter, make_reader) in (
+      ("native", FakeHci(), lambda: lazyblue.HciRssiReader(0)),
+      ("hcitool", FakeHcitool(), lazyblue.HcitoolRssiReader)):
+    with adapter:
+      connection = ReaderConnection(make_reader(), adapter, strengths)
+      with ForkCounter() as counter:
+        wall = time.time()
+        cpu = _cpu_time()
+        for _ in xrange(reads):
+          connection.get_signal_strength()
+        cpu = _cpu_time() - cpu
+        wall = time.time() - wall
+    results[name + "_wall_seconds_per_read"] = wall / reads
+    results[name + "_cpu_seconds_per_read"] = cpu / reads
+    results[name + "_forks_per_read"] = float(counter.forks) / reads
+  return results
+
+def bench_update(updates):
+  """how many readings a second Monitor.update gets through."""
+  clock = lazyblue.VirtualClock()
+  monitor = _monitor([], FakeScreenLocker(clock), clock)
+  strengths = _pattern(0, lazyblue._NOT_CONNECTED, 20)
+  update = monitor.update
+  start = time.time()
+  for index in xrange(updates):
+    clock.now = index
+    update(strengths[index % len(strengths)], index)
+  elapsed = time.time() - start
+  return {"updates": updates, "updates_per_second": updates / elapsed}
+
+def bench_transition(transitions):
+  """how many state changes a second Monitor.transition gets through."""
+  clock = lazyblue.VirtualClock()
+  monitor = _monitor([], FakeScreenLocker(clock), clock)
+  states = [lazyblue._HERE] * 20 + [lazyblue._GONE] * 20
+  transition = monitor.transition
+  start = time.time()
+  for index in xrange(transitions):
+    transition(states[index % len(states)], 1, index)
+  elapsed = time.time() - start
+  return {"transitions": transitions,
+          "transitions_per_second": transitions / elapsed}
+
+def bench_decision(departures):
+  """how long after the signal crosses lock_strength the screen locker is
+     called: in simulated seconds, which counts lock_time and the polling
+     schedule, and in the wall time spent on the poll that locks."""
+  clock = lazyblue.VirtualClock()
+  screenlocker = FakeScreenLocker()
+  monitor = _monitor([], screenlocker, clock)
+  latencies = []
+  overheads = []
+
+  def poll(strength):
+    clock.now = monitor.last_poll = monitor.next_deadline()
+    start = time.time()
+    monitor.update(strength, clock.now)
+    return start
+
+  for _ in xrange(departures):
+    for _ in xrange(3):
+      poll(0)
+    screenlocker.locked = False
+    monitor.state = lazyblue._UNLOCKED
+    start = poll(lazyblue._NOT_CONNECTED)
+    crossed = clock.now
+    while monitor.state != lazyblue._LOCKED:
+      start = poll(lazyblue._NOT_CONNECTED)
+    latencies.append(clock.now - crossed)
+    overheads.append(screenlocker.locks[-1] - start)
+  return {
+      "departures": departures,
+      "decision_latency_seconds": lazyblue._median(latencies),
+      "decision_overhead_seconds": lazyblue._median(overheads),
+    }
+
+def bench_startup(runs):
+  """how long lazyblue takes to start, parse and check its options and write
+     its config out, in a fresh interpreter."""
+  script = os.path.splitext(os.path.abspath(lazyblue.__file__))[0] + ".py"
+  times = []
+  for _ in xrange(runs):
+    start = time.time()
+    subprocess.check_call([sys.executable, script, "-m", "00:11:22:33:44:55",
+                           "--write_config", os.devnull])
+    times.append(time.time() - start)
+  return {"runs": runs, "startup_seconds": lazyblue._median(times)}
+
+BENCHMARKS = (
+    ("poll", bench_poll, 200),
+    ("rssi_read", bench_rssi_read, 200),
+    ("update", bench_update, 200000),
+    ("transition", bench_transition, 200000),
+    ("decision", bench_decision, 1000),
+    ("startup", bench_startup, 10),
+  )
+
+def run(scale=1.0, only=None):
+  """run the benchmarks, each with its iterations times scale. Returns their
+     results by name."""
+  results = {}
+  for (name, function, iterations) in BENCHMARKS:
+    if only and name not in only:
+      continue
+    lazyblue.config = Settings(lazyblue.DEFAULT_OPTIONS)
+    lazyblue.config.update(lock_cooldown=0)
+    results[name] = function(max(1, int(iterations * scale)))
+  return results
+
+def compare(old, new, out):
+  """write each measurement of old and new side by side to out."""
+  for name in sorted(new):
+    for key in sorted(new[name]):
+      before = old.get(name, {}).get(key)
+      after = new[name][key]
+      if before:
+        change = "%+.1f%%" % ((after - before) * 100.0 / before)
+      else:
+        change = "-"
+      out.write("%-12s %-28s %14.6g %14.6g %10s\n" %
+                (name, key, before if before is not None else float("nan"),
+                 after, change))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description="Benchmark lazyblue's poll loop and state machine.")
+  parser.add_argument("--output", metavar="FILE",
+                      help="Write the results as JSON to FILE rather than "
+                           "standard output.")
+  parser.add_argument("--compare", metavar="FILE",
+                      help="Compare the results with those saved in FILE.")
+  parser.add_argument("--scale", type=float, default=1.0,
+                      help="Multiply the iterations of each benchmark by "
+                           "this.")
+  parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                      help="Benchmarks to run out of %s; all by default." %
+                           ", ".join(name for (name, _, _) in BENCHMARKS))
+  args = parser.parse_args(argv)
+  for name in args.benchmarks:
+    if name not in [known for (known, _, _) in BENCHMARKS]:
+      parser.error("unknown benchmark %s" % name)
+
+  results = run(args.scale, args.benchmarks)
+  if args.output:
+    with open(args.output, "w") as fd:
+      json.dump(results, fd, indent=2, sort_keys=True)
+      fd.write("\n")
+  else:
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+  if args.compare:
+    with open(args.compare) as fd:
+      compare(json.load(fd), results, sys.stderr)
+
+if __name__ == "__main__":
+  main()
@@ -1,13 +1,36 @@
 import argparse
+import array
+import atexit
+import bisect
 import ConfigParser
+import cProfile
+import ctypes
+import errno
+import fcntl
+import heapq
+import itertools
+import json
 import os
+import pstats
+import pwd
+import Queue
+import random
+import re
+import select
 import time
+import shlex
 import signal
+import socket
+import struct
 import subprocess
 import sys
+import threading
+import traceback
 
-import bluetooth
-import bluetooth._bluetooth as bluez
+# Loading the bluetooth stack is slow, so it is only imported, by
+# _import_bluetooth, once monitoring starts.
+bluetooth = None
+bluez = None
 
 DEFAULT_OPTIONS = {
     "lock_strength": -1,
@@ -17,11 +40,64 @@ DEFAULT_OPTIONS = {
     "lock_cooldown": 15,
     "rearm_cooldown": 0,
     "poll_interval": 1,
+    "adaptive_poll": False,
+    "min_poll_interval": 0.25,
+    "max_poll_interval": 4,
     "connect_interval": 1,
+    "max_connect_interval": 60,
+    "connect_timeout": 10,
+    "filter": "none",
+    "filter_window": 5,
+    "predictive_lock": False,
+    "predict_window": 5,
+    "predict_slope": -2,
+    "predict_horizon": 3,
+    "calibrate": "off",
+    "calibrate_range": "",
+    "calibrate_quantile": 0.05,
+    "calibrate_min_samples": 600,
+    "calibrate_interval": 300,
+    "ewma_alpha": 0.3,
+    "kalman_process_noise": 0.5,
+    "kalman_measurement_noise": 4,
+    "poll_workers": 4,
+    "event_loop": False,
+    "rssi_backend": "auto",
+    "presence_source": "rfcomm",
+    "adapters": "",
+    "adapter_fusion": "max",
+    "adapter_timeout": 1,
+    "ble_timeout": 10,
+    "serve_broker": "",
+    "broker_socket": "/run/lazyblue/broker.sock",
+    "broker_timeout": 5,
+    "broker_users": "",
+    "broker_max_subscriptions": 8,
+    "broker_max_devices": 32,
     "lock_command": "",
     "unlock_command": "",
     "status_command": "",
     "activity_command": "",
+    "command_timeout": 10,
+    "prewarm": False,
+    "record_max_bytes": 16 * 1024 * 1024,
+    "record_backups": 5,
+    "event_log": "",
+    "event_log_mode": "changes",
+    "event_log_max_bytes": 16 * 1024 * 1024,
+    "event_log_backups": 5,
+    "event_log_summary_interval": 60,
+    "tune_samples": 0,
+    "tune_processes": 0,
+    "false_lock_window": 60,
+    "metrics_file": "",
+    "metrics_interval": 10,
+    "profile": "",
+    "profile_interval": 60,
+    "status_ttl": 5,
+    "watch_command": "",
+    "watch_lock_pattern": "^LOCK|boolean true",
+    "watch_unlock_pattern": "^UNBLANK|boolean false",
   }
 
 #######################################################################
@@ -36,110 +112,1567 @@ _HERE = "here"
 _GONE = "gone"
 _NEITHER = "neither"
 
-# Terrible vlock command -- need to sudo up, run vlock, and get its PID back
-# to this process (the grandparent), but bash's echo doesn't seem to want to
-# write to stdout unbuffered. We could also use expect's unbuffered, but
-# I'd prefer to avoid another external dependency. So we have a python
-# inside a subprocess inside a subprocess.
-_VLOCK_COMMAND = """
-sudo python -u -c '
+# Signal strength reported when the device is not connected.
+_NOT_CONNECTED = -255
 
-import subprocess
-import sys
-lock_shell = subprocess.Popen(["vlock", "-a", "-n"],
-                              stdin=subprocess.PIPE,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              env={"USER":"%s"})
-print lock_shell.pid
-sys.stdout.flush()
-lock_shell.wait()'
-
-"""
-
-def _strength_to_state(strength):
+# Locks every console until the user's password is given. Run through sudo
+# as vlock -a needs root; sudo passes on the SIGTERM we unlock with.
+_VLOCK_COMMAND = "sudo env USER=%s vlock -a -n"
+
+# Options that may be set per device in a [Device MAC] config file section.
+_DEVICE_OPTIONS = ("lock_strength", "unlock_strength", "lock_time",
+                   "unlock_time")
+
+class _Timespec(ctypes.Structure):
+  _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+_CLOCK_MONOTONIC = 1
+
+def _load_clock_gettime():
+  """find clock_gettime in libc, or librt on older systems."""
+  for library in (None, "librt.so.1"):
+    try:
+      return ctypes.CDLL(library, use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+      pass
+  return None
+
+_clock_gettime = _load_clock_gettime()
+
+def _monotonic():
+  """seconds since an arbitrary point, unaffected by changes to the wall
+     clock. All of lazyblue's timing uses this rather than time.time()."""
+  if _clock_gettime is None:
+    return time.time()
+  ts = _Timespec()
+  if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+    raise OSError(ctypes.get_errno(), "clock_gettime failed")
+  return ts.tv_sec + ts.tv_nsec * 1e-9
+
+# pidfd_open(2) and pidfd_send_signal(2) have the same numbers on every
+# architecture.
+_SYS_PIDFD_OPEN = 434
+_SYS_PIDFD_SEND_SIGNAL = 424
+
+def _pidfd_open(pid):
+  """return a file descriptor that becomes readable when the child process
+     exits, or None if the kernel does not support pidfds."""
+  try:
+    fd = ctypes.CDLL(None, use_errno=True).syscall(_SYS_PIDFD_OPEN, pid, 0)
+  except (OSError, AttributeError):
+    return None
+  if fd < 0:
+    return None
+  fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+  return fd
+
+def _pidfd_send_signal(pidfd, signum):
+  """send signum to the process behind pidfd. Unlike kill(2), this can't
+     hit an unrelated process that has reused the pid."""
+  libc = ctypes.CDLL(None, use_errno=True)
+  if libc.syscall(_SYS_PIDFD_SEND_SIGNAL, pidfd, signum, None, 0) < 0:
+    error = ctypes.get_errno()
+    raise OSError(error, os.strerror(error))
+
+def _set_nonblocking(fd):
+  """make reads from fd return EAGAIN rather than block."""
+  fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+# Read end of the pipe signal.set_wakeup_fd writes to, once installed.
+_wakeup_fd = None
+
+def _install_signal_wakeup():
+  """have every signal, in particular SIGCHLD when a lock process exits, wake
+     up a monitor waiting in _wait. Must be called from the main thread."""
+  global _wakeup_fd
+  if _wakeup_fd is not None:
+    return
+  read_fd, write_fd = os.pipe()
+  for fd in (read_fd, write_fd):
+    _set_nonblocking(fd)
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+  signal.set_wakeup_fd(write_fd)
+  # The wakeup fd is only written for signals with a python handler.
+  signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+  # Don't let SIGCHLD interrupt reads from hcitool and friends.
+  signal.siginterrupt(signal.SIGCHLD, False)
+  _wakeup_fd = read_fd
+
+def _wait(timeout, fds=()):
+  """sleep for up to timeout seconds, returning early if a signal arrives or
+     one of fds becomes readable. Returns the fds that are readable, plus
+     _wakeup_fd if woken by a signal."""
+  fds = list(fds)
+  if _wakeup_fd is not None:
+    fds.append(_wakeup_fd)
+  if not fds:
+    time.sleep(timeout)
+    return []
+  try:
+    readable = select.select(fds, [], [], timeout)[0]
+  except select.error, ex:
+    if ex.args[0] != errno.EINTR:
+      raise
+    # select is never restarted after a signal, whatever siginterrupt says.
+    # The handler has written to the wakeup pipe, so report it, rather than
+    # nothing readable, which means the timeout passed.
+    readable = [_wakeup_fd] if _wakeup_fd is not None else []
+  if _wakeup_fd in readable:
+    try:
+      while os.read(_wakeup_fd, 4096):
+        pass
+    except OSError:
+      pass
+  return readable
+
+# Histogram buckets in seconds, for things that take a fraction of a second
+# and for how long a lock takes.
+_DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+_LOCK_LATENCY_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 60, 120, 300)
+
+_METRIC_HELP = {
+    "lazyblue_poll_seconds": "Time taken by each poll.",
+    "lazyblue_rssi_read_seconds": "Time taken to read the signal strength.",
+    "lazyblue_reconnects_total": "Attempts to connect to the device.",
+    "lazyblue_reconnect_failures_total":
+        "Attempts to connect to the device that failed.",
+    "lazyblue_command_seconds":
+        "Run time of lock, unlock, status and other commands.",
+    "lazyblue_command_failures_total":
+        "Commands that exited nonzero or timed out.",
+    "lazyblue_locks_total": "Screen locks.",
+    "lazyblue_link_losses_total":
+        "Times the device's link went down, as reported by the adapter.",
+    "lazyblue_unlocks_total": "Screen unlocks.",
+    "lazyblue_lock_latency_seconds":
+        "Time from the first reading of the device gone to the screen "
+        "being locked.",
+  }
+
+class Histogram(object):
+  """counts of observations falling at or under each of buckets, with their
+     sum."""
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+
+class Metrics(object):
+  """counters and histograms of what the daemon is doing, written out in
+     the Prometheus text format. Labels are tuples of (name, value) pairs.
+     Safe to update from several polling threads."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.histograms = {}
+    self.last_write = None
+
+  def increment(self, name, labels=(), value=1):
+    with self.lock:
+      key = (name, labels)
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name, value, labels=(), buckets=_DURATION_BUCKETS):
+    with self.lock:
+      key = (name, labels)
+      if key not in self.histograms:
+        self.histograms[key] = Histogram(buckets)
+      self.histograms[key].observe(value)
+
+  def render(self):
+    """the metrics in the Prometheus text exposition format."""
+    lines = []
+    with self.lock:
+      names = set(name for (name, _) in self.counters.keys() +
+                                        self.histograms.keys())
+      for name in sorted(names):
+        if name in _METRIC_HELP:
+          lines.append("# HELP %s %s" % (name, _METRIC_HELP[name]))
+        counters = sorted((labels, value) for ((key, labels), value)
+                          in self.counters.items() if key == name)
+        histograms = sorted((labels, histogram) for ((key, labels), histogram)
+                            in self.histograms.items() if key == name)
+        if counters:
+          lines.append("# TYPE %s counter" % name)
+        else:
+          lines.append("# TYPE %s histogram" % name)
+        for (labels, value) in counters:
+          lines.append("%s%s %s" % (name, _format_labels(labels), value))
+        for (labels, histogram) in histograms:
+          total = 0
+          for (bound, count) in zip(histogram.buckets + ("+Inf",),
+                                    histogram.counts):
+            total += count
+            lines.append("%s_bucket%s %i" % (
+                name, _format_labels(labels + (("le", str(bound)),)), total))
+          lines.append("%s_sum%s %r" % (name, _format_labels(labels),
+                                        histogram.sum))
+          lines.append("%s_count%s %i" % (name, _format_labels(labels),
+                                          total))
+    return "".join(line + "\n" for line in lines)
+
+  def write(self, path):
+    """write the metrics to path, replacing it atomically so readers never
+       see a partial file."""
+    temporary = "%s.%i.tmp" % (path, os.getpid())
+    with open(temporary, "w") as fd:
+      fd.write(self.render())
+    os.rename(temporary, path)
+
+  def write_if_due(self):
+    """write the metrics to metrics_file if metrics_interval has passed since
+       they were last written."""
+    if not config.metrics_file:
+      return
+    now = _monotonic()
+    with self.lock:
+      if (self.last_write is not None and
+          now - self.last_write < config.metrics_interval):
+        return
+      self.last_write = now
+    self.write(config.metrics_file)
+
+# The stages of a poll that --profile times, in the order they happen, with
+# what each covers. Stages nest where they are indented.
+_PROFILE_STAGES = (
+    ("poll", "all of Monitor.poll_now"),
+    ("  events", "reaping commands and checking for a manual unlock"),
+    ("    is_locked", "asking the screen locker whether it is locked"),
+    ("  signal", "Connection.get_signal_strength"),
+    ("    connect", "connecting and reconnecting"),
+    ("    liveness", "checking an open connection has not dropped"),
+    ("    rssi_read", "reading the signal strength"),
+    ("  update", "the state machine, with the commands it starts"),
+    ("    command_start", "forking lock, unlock and other commands"),
+  )
+
+class Profiler(object):
+  """the calls, total and longest time of each stage of polling, for
+     --profile, cheap enough to leave on. While switched on by SIGUSR1, also
+     runs polls under cProfile, one profile per polling thread."""
+  def __init__(self):
+    self.enabled = False
+    self.lock = threading.Lock()
+    # [calls, total seconds, longest seconds] by stage.
+    self.stages = {}
+    self.last_write = None
+    self.profiles = None
+
+  def add(self, stage, seconds):
+    if not self.enabled:
+      return
+    with self.lock:
+      totals = self.stages.get(stage)
+      if totals is None:
+        totals = self.stages[stage] = [0, 0.0, 0.0]
+      totals[0] += 1
+      totals[1] += seconds
+      if seconds > totals[2]:
+        totals[2] = seconds
+
+  def render(self):
+    """a table of the stages timed so far."""
+    lines = ["%-20s %10s %12s %12s %12s" %
+             ("stage", "calls", "total_s", "mean_ms", "max_ms")]
+    with self.lock:
+      for (label, _) in _PROFILE_STAGES:
+        totals = self.stages.get(label.strip())
+        if totals is None:
+          continue
+        calls, total, longest = totals
+        lines.append("%-20s %10i %12.3f %12.3f %12.3f" %
+                     (label, calls, total, total * 1000 / calls,
+                      longest * 1000))
+    return "".join(line + "\n" for line in lines)
+
+  def write(self, path):
+    """write the table to path, replacing it atomically."""
+    temporary = "%s.%i.tmp" % (path, os.getpid())
+    with open(temporary, "w") as fd:
+      fd.write(self.render())
+    os.rename(temporary, path)
+
+  def write_if_due(self):
+    """write the table to the --profile file if profile_interval has passed
+       since it was last written."""
+    if not self.enabled:
+      return
+    now = _monotonic()
+    with self.lock:
+      if (self.last_write is not None and
+          now - self.last_write < config.profile_interval):
+        return
+      self.last_write = now
+    self.write(config.profile)
+
+  def call(self, function, *args):
+    """call function(*args), under this thread's cProfile while profiling."""
+    profiles = self.profiles
+    if profiles is None:
+      return function(*args)
+    ident = threading.current_thread().ident
+    with self.lock:
+      profile = profiles.get(ident)
+      if profile is None:
+        profile = profiles[ident] = cProfile.Profile()
+    return profile.runcall(function, *args)
+
+  def toggle_cprofile(self, path):
+    """start running polls under cProfile or, if already, stop and write
+       what they did to path in the pstats format. Only call with no poll
+       under way."""
+    if self.profiles is None:
+      self.profiles = {}
+      return
+    profiles = self.profiles.values()
+    self.profiles = None
+    if profiles:
+      pstats.Stats(*profiles).dump_stats(path)
+
+profiler = Profiler()
+
+def _format_labels(labels):
+  if not labels:
+    return ""
+  return "{%s}" % ",".join(
+      '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+      for (name, value) in labels)
+
+metrics = Metrics()
+
+def _strength_to_state(strength, settings=None):
   """convert signal strength to appropriate state constant."""
-  if strength < config.lock_strength:
+  if settings is None:
+    settings = config
+  if strength < settings.lock_strength:
     return _GONE
-  elif strength >= config.unlock_strength:
+  elif strength >= settings.unlock_strength:
     return _HERE
   else:
     return _NEITHER
 
+class SampleWindow(object):
+  """the last size samples, kept in a fixed size array used as a ring
+     buffer."""
+  def __init__(self, size, typecode="d"):
+    self.samples = array.array(typecode, [0] * size)
+    self.next = 0
+    self.count = 0
+
+  def append(self, value):
+    """add a sample, overwriting the oldest once the window is full."""
+    self.samples[self.next] = value
+    self.next = (self.next + 1) % len(self.samples)
+    self.count = min(self.count + 1, len(self.samples))
+
+  def values(self):
+    """the samples in the window, oldest first."""
+    start = (self.next - self.count) % len(self.samples)
+    if start + self.count <= len(self.samples):
+      return self.samples[start:start + self.count].tolist()
+    else:
+      return (self.samples[start:].tolist() +
+              self.samples[:self.next].tolist())
+
+  def clear(self):
+    """forget all samples."""
+    self.next = 0
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+class SignalFilter(object):
+  """passes signal strength readings through unchanged. Subclasses smooth
+     them over a window of recent readings so that noise doesn't keep
+     resetting the lock count. Readings taken while disconnected pass through
+     and restart the filter, since they are not noise."""
+  def __init__(self, settings):
+    self.settings = settings
+    self.window = SampleWindow(settings.filter_window)
+
+  def update(self, strength):
+    """feed in a raw reading and return the filtered one."""
+    if strength == _NOT_CONNECTED:
+      self.reset()
+      return strength
+    self.window.append(strength)
+    return self._filter(strength)
+
+  def reset(self):
+    """forget all readings so far."""
+    self.window.clear()
+
+  def _filter(self, strength):
+    return strength
+
+class EwmaFilter(SignalFilter):
+  """exponentially weighted moving average, weighting the newest reading by
+     ewma_alpha."""
+  def reset(self):
+    SignalFilter.reset(self)
+    self.value = None
+
+  def _filter(self, strength):
+    if self.value is None:
+      self.value = float(strength)
+    else:
+      alpha = self.settings.ewma_alpha
+      self.value = alpha * strength + (1 - alpha) * self.value
+    return self.value
+
+class MedianFilter(SignalFilter):
+  """median of the last filter_window readings."""
+  def _filter(self, strength):
+    samples = sorted(self.window.values())
+    middle = len(samples) // 2
+    if len(samples) % 2:
+      return samples[middle]
+    else:
+      return (samples[middle - 1] + samples[middle]) / 2.0
+
+class KalmanFilter(SignalFilter):
+  """one dimensional Kalman filter modelling the true signal strength as a
+     random walk observed through measurement noise."""
+  def reset(self):
+    SignalFilter.reset(self)
+    self.value = None
+    self.variance = None
+
+  def _filter(self, strength):
+    if self.value is None:
+      self.value = float(strength)
+      self.variance = self.settings.kalman_measurement_noise
+    else:
+      self.variance += self.settings.kalman_process_noise
+      gain = self.variance / (self.variance +
+                              self.settings.kalman_measurement_noise)
+      self.value += gain * (strength - self.value)
+      self.variance *= 1 - gain
+    return self.value
+
+_FILTERS = {
+    "none": SignalFilter,
+    "ewma": EwmaFilter,
+    "median": MedianFilter,
+    "kalman": KalmanFilter,
+  }
+
+def _make_filter(settings):
+  """build the signal filter chosen by settings.filter."""
+  signal_filter = _FILTERS[settings.filter](settings)
+  signal_filter.reset()
+  return signal_filter
+
+# How much of the variation in the readings the fitted trend must explain
+# before predictive_lock trusts it, so that noise around a steady signal
+# doesn't look like a fall.
+_PREDICT_MIN_R2 = 0.6
+
+class TrendEstimator(object):
+  """fits a least squares line to the last size (time, signal strength)
+     readings, to tell when the signal is falling fast."""
+  def __init__(self, size):
+    self.times = SampleWindow(size)
+    self.strengths = SampleWindow(size)
+
+  def append(self, now, strength):
+    self.times.append(now)
+    self.strengths.append(strength)
+
+  def clear(self):
+    self.times.clear()
+    self.strengths.clear()
+
+  def fit(self):
+    """the slope in signal strength per second, the fitted strength at the
+       latest reading and the fraction of the variance explained, or None
+       until the window is full."""
+    if len(self.times) < len(self.times.samples):
+      return None
+    times = self.times.values()
+    strengths = self.strengths.values()
+    count = float(len(times))
+    mean_time = sum(times) / count
+    mean_strength = sum(strengths) / count
+    time_variance = sum((t - mean_time) ** 2 for t in times)
+    strength_variance = sum((s - mean_strength) ** 2 for s in strengths)
+    if time_variance == 0:
+      return None
+    covariance = sum((t - mean_time) * (s - mean_strength)
+                     for (t, s) in zip(times, strengths))
+    slope = covariance / time_variance
+    if strength_variance == 0:
+      r2 = 0.0
+    else:
+      r2 = covariance * covariance / (time_variance * strength_variance)
+    return (slope, mean_strength + slope * (times[-1] - mean_time), r2)
+
+  def predicts_departure(self, settings):
+    """whether the signal is falling at least as fast as predict_slope,
+       steadily, and is headed below lock_strength within predict_horizon
+       seconds."""
+    fit = self.fit()
+    if fit is None:
+      return False
+    slope, latest, r2 = fit
+    return (slope <= settings.predict_slope and r2 >= _PREDICT_MIN_R2 and
+            latest + slope * settings.predict_horizon < settings.lock_strength)
+
+# Signal strengths the calibration sketches tell apart; readings outside
+# are counted at the nearest end.
+_SKETCH_MIN = -128
+_SKETCH_MAX = 127
+
+class StrengthSketch(object):
+  """a histogram of integer signal strengths, one count per possible value,
+     so it takes the same memory however many readings it has seen."""
+  def __init__(self):
+    self.counts = array.array("L", [0] * (_SKETCH_MAX - _SKETCH_MIN + 1))
+    self.total = 0
+
+  def add(self, strength):
+    index = int(min(max(strength, _SKETCH_MIN), _SKETCH_MAX)) - _SKETCH_MIN
+    self.counts[index] += 1
+    self.total += 1
+
+  def quantile(self, fraction):
+    """the smallest strength at or under which at least fraction of the
+       readings fall, or None if there are none."""
+    if not self.total:
+      return None
+    needed = fraction * self.total
+    seen = 0
+    for (index, count) in enumerate(self.counts):
+      seen += count
+      if count and seen >= needed:
+        return index + _SKETCH_MIN
+    return _SKETCH_MAX
+
+  def __len__(self):
+    return self.total
+
+class Calibration(object):
+  """sketches of the signal strengths read while the screen is unlocked
+     (the user is about) and while it is locked (they are away), to suggest
+     thresholds from. Disconnected readings are left out, as they say
+     nothing about where the thresholds should sit."""
+  def __init__(self):
+    # A hardened screen is locked too.
+    self.sketches = {_UNLOCKED: StrengthSketch(), _LOCKED: StrengthSketch()}
+
+  def add(self, state, strength):
+    if strength != _NOT_CONNECTED:
+      self.sketches[_UNLOCKED if state == _UNLOCKED else _LOCKED].add(strength)
+
+  def suggest(self, settings):
+    """the (lock_strength, unlock_strength) the readings so far suggest, or
+       None until calibrate_min_samples readings have been taken unlocked.
+       Only calibrate_quantile of readings while unlocked fall under
+       lock_strength, and only that much of those while locked reach
+       unlock_strength, which stays no higher than the median unlocked
+       reading so that coming back still unlocks. Both are kept within
+       calibrate_range, if given."""
+    here = self.sketches[_UNLOCKED]
+    away = self.sketches[_LOCKED]
+    if len(here) < max(settings.calibrate_min_samples, 1):
+      return None
+    lock_strength = here.quantile(settings.calibrate_quantile)
+    unlock_strength = lock_strength + 1
+    if len(away):
+      unlock_strength = max(unlock_strength, min(
+          away.quantile(1 - settings.calibrate_quantile) + 1,
+          here.quantile(0.5)))
+    if settings.calibrate_range:
+      low, high = _parse_strength_range(settings.calibrate_range)
+      lock_strength = min(max(lock_strength, low), high - 1)
+      unlock_strength = min(max(unlock_strength, lock_strength + 1), high)
+    return (lock_strength, unlock_strength)
+
+def _parse_strength_range(text):
+  """parse LO:HI into the bounds of a range of signal strengths."""
+  low, high = [int(part) for part in text.split(":")]
+  if low >= high:
+    raise ValueError(text)
+  return (low, high)
+
+def _import_bluetooth():
+  global bluetooth, bluez
+  if bluetooth is None:
+    import bluetooth
+  if bluez is None:
+    import bluetooth._bluetooth as bluez
+
+def _acl_handle(sock, mac):
+  """look up the ACL connection handle of a connected device on the adapter
+     behind the given HCI socket. Raises IOError if it is not connected."""
+  request = array.array("c", struct.pack("6sB17s", bluez.str2ba(mac),
+                                         bluez.ACL_LINK, "\0" * 17))
+  fcntl.ioctl(sock.fileno(), bluez.HCIGETCONNINFO, request, 1)
+  return struct.unpack("8xH14x", request.tostring())[0]
+
+class DeviceConfig(object):
+  """one device's view of the global config, with some options overridden.
+     Options not overridden are read from config whenever they are used."""
+  def __init__(self, overrides=None):
+    self.overrides = overrides if overrides is not None else {}
+
+  def __getattr__(self, key):
+    if key in self.overrides:
+      return self.overrides[key]
+    return getattr(config, key)
+
+def _adapter_address(adapter):
+  """the bluetooth address of a local adapter such as hci0."""
+  with open("/sys/class/bluetooth/%s/address" % adapter) as fd:
+    return fd.read().strip().upper()
+
+class HcitoolRssiReader(object):
+  """reads signal strength by running hcitool. Forks a shell and hcitool on
+     every read, but works anywhere hcitool does."""
+  def __init__(self, adapter=None):
+    self.adapter = adapter
+
+  def read(self, mac):
+    """return the device's current signal strength, or None if it is not
+       connected."""
+    command = "hcitool rssi " + mac + " 2>/dev/null"
+    if self.adapter is not None:
+      command = "hcitool -i %s rssi %s 2>/dev/null" % (self.adapter, mac)
+    devices = list(os.popen(command, "r"))
+    if devices and ":" in devices[0]:
+      return int(devices[0].split(":")[1].strip())
+    else:
+      return None
+
+  def forget(self, mac):
+    """discard anything cached about the device's current connection."""
+    pass
+
+# Errors meaning the adapter itself went away (unplugged, reset or
+# suspended), so its HCI socket is no use until reopened.
+_ADAPTER_GONE_ERRORS = (errno.EBADFD, errno.ENODEV, errno.EPIPE,
+                        errno.ENETDOWN)
+
+class HciRssiReader(HcitoolRssiReader):
+  """reads signal strength in-process by issuing Read RSSI over a raw HCI
+     socket, caching each device's ACL connection handle between reads. If
+     the adapter goes away, the socket is reopened once it is back."""
+  def __init__(self, dev_id=None):
+    _import_bluetooth()
+    if dev_id is None:
+      dev_id = bluez.hci_get_route()
+    self.dev_id = dev_id
+    self.sock = bluez.hci_open_dev(dev_id)
+    self.handles = {}
+    self.lock = threading.Lock()
+    self.failures = 0
+    self.next_open = 0
+
+  def read(self, mac):
+    """return the device's current signal strength, or None if it is not
+       connected."""
+    # Several monitors may share one reader; keep their requests and replies
+    # on the socket from interleaving.
+    with self.lock:
+      return self._read(mac)
+
+  def _read(self, mac):
+    if self.sock is None and not self._reopen():
+      return None
+    handle = self.handles.get(mac)
+    try:
+      if handle is None:
+        handle = self.handles[mac] = _acl_handle(self.sock, mac)
+      reply = bluez.hci_send_req(self.sock, bluez.OGF_STATUS_PARAM,
+                                 bluez.OCF_READ_RSSI, bluez.EVT_CMD_COMPLETE,
+                                 4, struct.pack("<H", handle))
+    except (IOError, bluez.error), ex:
+      self.forget(mac)
+      if ex.args and ex.args[0] in _ADAPTER_GONE_ERRORS:
+        self._close()
+      return None
+    status, reply_handle, strength = struct.unpack("<BHb", reply[:4])
+    if status != 0 or reply_handle != handle:
+      # Stale handle (the link went down and came back), look it up again.
+      self.forget(mac)
+      return None
+    return strength
+
+  def forget(self, mac):
+    """discard anything cached about the device's current connection."""
+    self.handles.pop(mac, None)
+
+  def _close(self):
+    """drop the socket of an adapter that has gone away, and every handle
+       learnt through it. The next read tries to reopen it."""
+    try:
+      self.sock.close()
+    except (IOError, bluez.error):
+      pass
+    self.sock = None
+    self.handles = {}
+    self.next_open = 0
+
+  def _reopen(self):
+    """try to open the adapter again, unless still waiting after a failed
+       try. The wait doubles after each failure up to max_connect_interval,
+       as for connecting to the device. Returns whether it is open."""
+    now = _monotonic()
+    if now < self.next_open:
+      return False
+    try:
+      self.sock = bluez.hci_open_dev(self.dev_id)
+    except (IOError, OSError, bluez.error):
+      self.next_open = now + min(
+          config.connect_interval * 2 ** min(self.failures, 30),
+          config.max_connect_interval)
+      self.failures += 1
+      return False
+    self.failures = 0
+    return True
+
+def _make_rssi_reader(adapter=None):
+  """build the signal strength reader chosen by config.rssi_backend, for
+     the given adapter or the default one. In auto mode, fall back to
+     hcitool if the native backend is unavailable."""
+  _import_bluetooth()
+  if config.rssi_backend == "hcitool":
+    return HcitoolRssiReader(adapter)
+  try:
+    return HciRssiReader(None if adapter is None else int(adapter[3:]))
+  except (IOError, OSError, bluez.error):
+    if config.rssi_backend == "native":
+      raise
+    return HcitoolRssiReader(adapter)
+
+# Connection states.
+_BACKING_OFF = "backing off"
+_CONNECTING = "connecting"
+_CONNECTED = "connected"
+
 class Connection(object):
   """responsible for establishing and maintaining a connection to the bluetooth
-     device."""
-  def __init__(self, mac, channel):
+     device. Never blocks on the radio: connects are started on a
+     non-blocking socket and checked on later polls, and failed attempts back
+     off exponentially. Connects through the given adapter, such as hci1, or
+     whichever the system picks."""
+  def __init__(self, mac, channel, rssi_reader=None, adapter=None):
+    _import_bluetooth()
     self.mac = mac
     self.channel = channel
+    self.adapter = adapter
     self.sock = None
-    self.last_connected = 0
-    self._attempt_reconnect()
-
-  def _attempt_reconnect(self):
-    """attempt to reestablish the bluetooth connection, closing an
-       existing connection if necessary and respecting CONNECT_INTERVAL by
-       silently failing without trying if necessary."""
-    try:
-      if self.sock is not None:
-        self.sock.close()
-        self.sock = None
-      if time.time() - self.last_connected < config.connect_interval:
-        return
-      self._connect()
+    self.rssi_reader = (rssi_reader if rssi_reader is not None
+                        else _make_rssi_reader())
+    self.state = _BACKING_OFF
+    self.failures = 0
+    self.next_attempt = 0
+    self.connect_started = None
+    self._advance()
+
+  def _advance(self):
+    """move the connection along: start a connect once any backoff is over,
+       see whether a connect in progress has finished, and back off if the
+       connect failed or the connection dropped."""
+    now = _monotonic()
+    stage = "liveness" if self.state == _CONNECTED else "connect"
+    try:
+      if self.state == _BACKING_OFF and now >= self.next_attempt:
+        self._connect(now)
+      if self.state == _CONNECTING:
+        self._check_connecting(now)
+      elif self.state == _CONNECTED:
+        self._check_connected()
     except bluetooth.btcommon.BluetoothError:
-      pass
+      self._back_off(now)
+    profiler.add(stage, _monotonic() - now)
 
-  def _connect(self):
-    """connect to the bluetooth device."""
-    self.last_connected = time.time()
+  def _connect(self, now):
+    """start connecting to the bluetooth device."""
+    self.rssi_reader.forget(self.mac)
+    metrics.increment("lazyblue_reconnects_total", (("device", self.mac),))
+    self.state = _CONNECTING
+    self.connect_started = now
     self.sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM, bluez.btsocket())
-    self.sock.settimeout(0.01)
-    time.sleep(0.1) # grrrr necessary to avoid "fd in bad state" errors
-    self.sock.connect((self.mac, self.channel))
+    self.sock.setblocking(False)
+    if self.adapter is not None:
+      try:
+        # Looked up every time, as the adapter may be unplugged and back.
+        self.sock.bind((_adapter_address(self.adapter), 0))
+      except IOError, ex:
+        raise bluetooth.btcommon.BluetoothError(str(ex))
+    error = self.sock.connect_ex((self.mac, self.channel))
+    if error == 0:
+      self.state = _CONNECTED
+    elif error not in (errno.EINPROGRESS, errno.EAGAIN):
+      raise bluetooth.btcommon.BluetoothError(os.strerror(error))
+
+  def _check_connecting(self, now):
+    """the socket becomes writable once the connect is done one way or the
+       other."""
+    if select.select([], [self.sock], [], 0)[1]:
+      error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if error:
+        raise bluetooth.btcommon.BluetoothError(os.strerror(error))
+      self.state = _CONNECTED
+    elif now - self.connect_started >= config.connect_timeout:
+      raise bluetooth.btcommon.BluetoothError("timed out")
+
+  def _check_connected(self):
+    """the socket becomes readable with an error or end of file when the
+       connection drops."""
+    if select.select([self.sock], [], [], 0)[0] and not self.sock.recv(1):
+      raise bluetooth.btcommon.BluetoothError("connection closed")
+
+  def close(self):
+    """drop the connection for good."""
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+    self.rssi_reader.forget(self.mac)
+    self.state = _BACKING_OFF
+    self.next_attempt = float("inf")
+
+  def _back_off(self, now):
+    """close the socket and wait before connecting again, doubling the wait
+       after each failed connect up to max_connect_interval. The wait is
+       randomized so several devices don't retry in lockstep."""
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+    if self.state == _CONNECTED:
+      self.failures = 0
+    else:
+      metrics.increment("lazyblue_reconnect_failures_total",
+                        (("device", self.mac),))
+    delay = min(config.connect_interval * 2 ** min(self.failures, 30),
+                config.max_connect_interval)
+    self.failures += 1
+    self.next_attempt = now + random.uniform(delay / 2.0, delay)
+    self.state = _BACKING_OFF
 
   def get_signal_strength(self):
     """get the device's current signal strength, reestablishing the connection
        if necessary"""
-    reconnect = False
-    if self.sock is None:
-      reconnect = True
+    self._advance()
+    start = _monotonic()
+    strength = self.rssi_reader.read(self.mac)
+    elapsed = _monotonic() - start
+    metrics.observe("lazyblue_rssi_read_seconds", elapsed,
+                    (("device", self.mac),))
+    profiler.add("rssi_read", elapsed)
+    if strength is None:
+      return _NOT_CONNECTED
+    else:
+      # The device is in range, even if it refuses the connection, so
+      # there's no reason to wait longer between attempts.
+      self.failures = 0
+      return strength
+
+  def watch_fds(self):
+    """file descriptors that become readable when the connection drops.
+       Called from the main thread while a worker may be closing the
+       socket, so the socket is only read once and may already be closed."""
+    sock = self.sock
+    if self.state != _CONNECTED or sock is None:
+      return []
+    try:
+      fd = sock.fileno()
+    except (socket.error, bluetooth.btcommon.BluetoothError):
+      return []
+    return [fd] if fd >= 0 else []
+
+class MultiConnection(object):
+  """reads a device's signal strength through several connections at once,
+     one per local adapter, each on its own worker thread, and fuses the
+     readings by taking their max or mean. A connection that fails or takes
+     longer than timeout to read drops out until it recovers, so the others
+     carry on without a gap."""
+  def __init__(self, connections, fusion="max", timeout=1):
+    self.connections = connections
+    self.fusion = fusion
+    self.timeout = timeout
+    self.workers = [WorkerPool(1) for _ in connections]
+    # Whether each connection is still busy with an earlier read, which
+    # then counts as failed rather than being queued behind.
+    self.pending = [False] * len(connections)
+    self.generation = 0
+    self.results = Queue.Queue()
+
+  def _read(self, index, generation):
+    try:
+      result = self.connections[index].get_signal_strength()
+    except Exception:
+      result = sys.exc_info()
+    self.results.put((index, generation, result))
+
+  def get_signal_strength(self):
+    self.generation += 1
+    # Take in stalled reads that have finished since, so their connections
+    # are read again, even if no read was started to wait for this time.
+    while True:
+      try:
+        index = self.results.get_nowait()[0]
+      except Queue.Empty:
+        break
+      self.pending[index] = False
+    waiting = 0
+    for (index, workers) in enumerate(self.workers):
+      if not self.pending[index]:
+        self.pending[index] = True
+        workers.submit(self._read, index, self.generation)
+        waiting += 1
+    strengths = []
+    deadline = _monotonic() + self.timeout
+    while waiting:
+      try:
+        index, generation, result = self.results.get(
+            timeout=max(0, deadline - _monotonic()))
+      except Queue.Empty:
+        break
+      self.pending[index] = False
+      if generation != self.generation:
+        # A stalled read from an earlier poll, finally done.
+        continue
+      waiting -= 1
+      if isinstance(result, tuple):
+        # Leave the adapter out of this poll, as for a stalled one.
+        sys.stderr.write("Reading through %s failed: %s" % (
+            self.connections[index].adapter,
+            "".join(traceback.format_exception_only(result[0], result[1]))))
+      elif result != _NOT_CONNECTED:
+        strengths.append(result)
+    if not strengths:
+      return _NOT_CONNECTED
+    elif self.fusion == "mean":
+      return int(round(float(sum(strengths)) / len(strengths)))
     else:
+      return max(strengths)
+
+  def watch_fds(self):
+    return sum((connection.watch_fds() for connection in self.connections),
+               [])
+
+  def close(self):
+    for (connection, workers) in zip(self.connections, self.workers):
+      workers.submit(connection.close)
+      workers.stop()
+
+# HCI LE controller commands and events, as in the Bluetooth Core spec.
+_OGF_LE_CTL = 0x08
+_OCF_LE_SET_SCAN_PARAMETERS = 0x000B
+_OCF_LE_SET_SCAN_ENABLE = 0x000C
+_HCI_EVENT_PKT = 0x04
+_EVT_LE_META_EVENT = 0x3E
+_EVT_LE_ADVERTISING_REPORT = 0x02
+# Passive scanning, 10ms interval and window (in 0.625ms units) so the
+# radio listens all the time, public own address, no whitelist.
+_LE_SCAN_PARAMETERS = struct.pack("<BHHBB", 0x00, 0x0010, 0x0010, 0x00, 0x00)
+
+def _parse_le_advertising_reports(packet):
+  """return the (mac, rssi) of each report in an HCI LE Advertising Report
+     event packet, or [] for any other packet. Reports are laid out one
+     after another, as BlueZ reads them."""
+  if (len(packet) < 5 or ord(packet[0]) != _HCI_EVENT_PKT or
+      ord(packet[1]) != _EVT_LE_META_EVENT or
+      ord(packet[3]) != _EVT_LE_ADVERTISING_REPORT):
+    return []
+  reports = []
+  offset = 5
+  for _ in range(ord(packet[4])):
+    # Event type, address type, address, data length, data, RSSI.
+    if offset + 9 > len(packet):
+      break
+    address = packet[offset + 2:offset + 8]
+    length = ord(packet[offset + 8])
+    rssi_offset = offset + 9 + length
+    if rssi_offset >= len(packet):
+      break
+    mac = ":".join("%02X" % ord(byte) for byte in reversed(address))
+    reports.append((mac, struct.unpack("b", packet[rssi_offset])[0]))
+    offset = rssi_offset + 1
+  return reports
+
+class PresenceTable(object):
+  """the latest signal strength heard from each device, with when it was
+     heard."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.readings = {}
+
+  def update(self, mac, strength, now=None):
+    if now is None:
+      now = _monotonic()
+    with self.lock:
+      self.readings[mac.upper()] = (strength, now)
+
+  def read(self, mac, max_age, now=None):
+    """the device's latest signal strength, or None if it has not been heard
+       from in max_age seconds."""
+    if now is None:
+      now = _monotonic()
+    with self.lock:
+      reading = self.readings.get(mac.upper())
+    if reading is None or now - reading[1] > max_age:
+      return None
+    return reading[0]
+
+class BleScanner(object):
+  """passively scans for LE advertisements on a raw HCI socket from a
+     background thread, recording the signal strength of the given devices
+     in a PresenceTable. Needs the devices to advertise from their public or
+     a static address. If the adapter fails, scanning starts again once it
+     is back; meanwhile no readings arrive, so the devices time out as
+     gone."""
+  def __init__(self, macs, table=None, dev_id=None):
+    _import_bluetooth()
+    self.macs = set(mac.upper() for mac in macs)
+    self.table = table if table is not None else PresenceTable()
+    if dev_id is None:
+      dev_id = bluez.hci_get_route()
+    self.dev_id = dev_id
+    self._open()
+    self.thread = None
+
+  def _open(self):
+    self.sock = bluez.hci_open_dev(self.dev_id)
+    event_filter = bluez.hci_filter_new()
+    bluez.hci_filter_set_ptype(event_filter, bluez.HCI_EVENT_PKT)
+    bluez.hci_filter_set_event(event_filter, _EVT_LE_META_EVENT)
+    self.sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, event_filter)
+
+  def _enable(self):
+    """start scanning, without filtering duplicate advertisements as each
+       one is a new reading."""
+    bluez.hci_send_cmd(self.sock, _OGF_LE_CTL, _OCF_LE_SET_SCAN_PARAMETERS,
+                       _LE_SCAN_PARAMETERS)
+    bluez.hci_send_cmd(self.sock, _OGF_LE_CTL, _OCF_LE_SET_SCAN_ENABLE,
+                       struct.pack("<BB", 1, 0))
+
+  def start(self):
+    self._enable()
+    self.thread = threading.Thread(target=self._scan)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    try:
+      bluez.hci_send_cmd(self.sock, _OGF_LE_CTL, _OCF_LE_SET_SCAN_ENABLE,
+                         struct.pack("<BB", 0, 0))
+    except bluez.error:
+      pass
+
+  def _scan(self):
+    failures = 0
+    while True:
       try:
-        self.sock.recv(1)
-      except bluetooth.btcommon.BluetoothError, ex:
-        if ex.message != "timed out":
-          reconnect = True
-    if reconnect:
-      self._attempt_reconnect()
-    devices = list(os.popen("hcitool rssi " + self.mac + " 2>/dev/null", "r"))
-    if devices and ":" in devices[0]:
-      return int(devices[0].split(":")[1].strip())
+        if self.sock is None:
+          self._open()
+          self._enable()
+        self.handle_packet(self.sock.recv(258))
+        failures = 0
+      except (IOError, OSError, bluez.error), ex:
+        if failures == 0:
+          sys.stderr.write("BLE scanning failed, reopening the adapter: %s\n"
+                           % ex)
+        if self.sock is not None:
+          self.sock.close()
+          self.sock = None
+        time.sleep(min(config.connect_interval * 2 ** min(failures, 30),
+                       config.max_connect_interval))
+        failures += 1
+
+  def handle_packet(self, packet):
+    now = _monotonic()
+    for (mac, strength) in _parse_le_advertising_reports(packet):
+      if mac in self.macs:
+        self.table.update(mac, strength, now)
+
+_EVT_CONN_COMPLETE = 0x03
+_EVT_DISCONN_COMPLETE = 0x05
+_ACL_LINK_TYPE = 0x01
+
+def _parse_link_event(packet):
+  """return ("up", handle, mac) for an HCI Connection Complete event that
+     brought an ACL link up, ("down", handle, None) for a Disconnection
+     Complete event, or None for any other packet."""
+  if len(packet) < 3 or ord(packet[0]) != _HCI_EVENT_PKT:
+    return None
+  event = ord(packet[1])
+  if event == _EVT_CONN_COMPLETE and len(packet) >= 14:
+    # Status, handle, address, link type, encryption.
+    status, handle = struct.unpack("<BH", packet[3:6])
+    if status != 0 or ord(packet[12]) != _ACL_LINK_TYPE:
+      return None
+    mac = ":".join("%02X" % ord(byte) for byte in reversed(packet[6:12]))
+    return ("up", handle & 0x0FFF, mac)
+  elif event == _EVT_DISCONN_COMPLETE and len(packet) >= 7:
+    # Status, handle, reason.
+    status, handle = struct.unpack("<BH", packet[3:6])
+    if status != 0:
+      return None
+    return ("down", handle & 0x0FFF, None)
+  return None
+
+class LinkWatcher(object):
+  """watches a raw HCI socket from a background thread for the given
+     devices' links going down, and makes a per-device fd readable when one
+     does. Links are matched to devices by their ACL handle, learnt from the
+     Connection Complete event or, for links already up, looked up at
+     startup. If the adapter fails, every known link counts as down and the
+     socket is reopened with back-off."""
+  def __init__(self, macs, dev_id=None):
+    _import_bluetooth()
+    self.macs = set(mac.upper() for mac in macs)
+    if dev_id is None:
+      dev_id = bluez.hci_get_route()
+    self.dev_id = dev_id
+    self.lock = threading.Lock()
+    self.handles = {}
+    self._open()
+    # (read, write) ends of each device's pipe.
+    self.pipes = {}
+    for mac in self.macs:
+      self.pipes[mac] = os.pipe()
+      for fd in self.pipes[mac]:
+        _set_nonblocking(fd)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    self.thread = None
+
+  def _open(self):
+    self.sock = bluez.hci_open_dev(self.dev_id)
+    event_filter = bluez.hci_filter_new()
+    bluez.hci_filter_set_ptype(event_filter, bluez.HCI_EVENT_PKT)
+    bluez.hci_filter_set_event(event_filter, _EVT_CONN_COMPLETE)
+    bluez.hci_filter_set_event(event_filter, _EVT_DISCONN_COMPLETE)
+    self.sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, event_filter)
+    handles = {}
+    for mac in self.macs:
+      try:
+        handles[_acl_handle(self.sock, mac)] = mac
+      except IOError:
+        pass
+    with self.lock:
+      self.handles = handles
+
+  def start(self):
+    self.thread = threading.Thread(target=self._watch)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _watch(self):
+    failures = 0
+    while True:
+      try:
+        if self.sock is None:
+          self._open()
+        self.handle_packet(self.sock.recv(258))
+        failures = 0
+      except (IOError, OSError, bluez.error), ex:
+        if failures == 0:
+          sys.stderr.write("watching links failed, reopening the adapter: %s\n"
+                           % ex)
+        if self.sock is not None:
+          self.sock.close()
+          self.sock = None
+        # Disconnections may be missed while the socket is down.
+        with self.lock:
+          lost = self.handles.values()
+          self.handles = {}
+        for mac in lost:
+          self._signal(mac)
+        time.sleep(min(config.connect_interval * 2 ** min(failures, 30),
+                       config.max_connect_interval))
+        failures += 1
+
+  def handle_packet(self, packet):
+    event = _parse_link_event(packet)
+    if event is None:
+      return
+    kind, handle, mac = event
+    with self.lock:
+      if kind == "up":
+        if mac in self.macs:
+          self.handles[handle] = mac
+        return
+      mac = self.handles.pop(handle, None)
+    if mac is not None:
+      self._signal(mac)
+
+  def _signal(self, mac):
+    try:
+      os.write(self.pipes[mac][1], "x")
+    except OSError:
+      # Full, so already readable.
+      pass
+
+  def fileno(self, mac):
+    """an fd that becomes readable when the device's link goes down."""
+    return self.pipes[mac.upper()][0]
+
+  def take_lost(self, mac):
+    """whether the device's link has gone down since last asked."""
+    try:
+      return bool(os.read(self.fileno(mac), 4096))
+    except OSError:
+      return False
+
+class BleConnection(object):
+  """presents a device's latest advertisement signal strength from a
+     PresenceTable as a Connection would, with no I/O."""
+  def __init__(self, mac, table):
+    self.mac = mac
+    self.table = table
+
+  def get_signal_strength(self):
+    strength = self.table.read(self.mac, config.ble_timeout)
+    if strength is None:
+      return _NOT_CONNECTED
+    else:
+      return strength
+
+  def watch_fds(self):
+    return []
+
+# Characters that mean a command needs a shell rather than being split into
+# an argv list and exec'd directly.
+_SHELL_CHARACTERS = frozenset("|&;<>()$`*?[]#~{}\n")
+
+def _command_argv(command):
+  """turn a command string into an argv list, running it through sh only if
+     it uses shell syntax. Commands shlex can't split, such as ones with
+     unbalanced quotes, are left for sh to fail, as os.system did."""
+  try:
+    argv = shlex.split(command)
+  except ValueError:
+    return ["/bin/sh", "-c", command]
+  if (not argv or "=" in argv[0] or
+      _SHELL_CHARACTERS.intersection(command)):
+    return ["/bin/sh", "-c", command]
+  return argv
+
+# Runs the rest of its arguments once a line arrives on stdin. A standby
+# process is forked ahead of time, so starting the command is one write.
+_STANDBY_ARGV = ["/bin/sh", "-c", 'read -r _ && exec "$@"', "lazyblue-standby"]
+
+# Commands that run until the screen is unlocked, or for good, rather than
+# doing one thing and exiting. They are killed in the normal course of
+# things and run for hours, so they are left out of command metrics and
+# failure reports.
+_HELD_COMMANDS = ("foreground lock", "vlock", "watch")
+
+class Command(object):
+  """a child process started by a CommandRunner."""
+  def __init__(self, name, process, started, timeout):
+    self.name = name
+    self.process = process
+    self.started = started
+    self.deadline = started + timeout if timeout else None
+    self.returncode = None
+    self.duration = None
+    self.timed_out = False
+
+  def failed(self):
+    """whether the command exited unsuccessfully or had to be killed."""
+    return self.timed_out or self.returncode != 0
+
+class CommandRunner(object):
+  """runs commands in the background with their stdio on /dev/null, reaping
+     them without blocking and killing any that outlive their timeout."""
+  def __init__(self):
+    self.running = []
+    self.finished = []
+    # (command, process) waiting to run each command prewarmed, by name.
+    self.standby = {}
+
+  def prewarm(self, name, command):
+    """fork a standby process that runs command as soon as run is called
+       with the same name and command, and fork a new one each time it is
+       used."""
+    devnull = open(os.devnull, "r+")
+    try:
+      process = subprocess.Popen(_STANDBY_ARGV + _command_argv(command),
+                                 stdin=subprocess.PIPE, stdout=devnull,
+                                 stderr=devnull, close_fds=True)
+    except OSError:
+      return
+    finally:
+      devnull.close()
+    self.standby[name] = (command, process)
+
+  def _run_standby(self, name, command, timeout):
+    """start command through its standby process, returning the Command, or
+       None if there is no live standby for it."""
+    standby_command, process = self.standby.pop(name, (None, None))
+    if process is None:
+      return None
+    if standby_command != command or process.poll() is not None:
+      # Stale (the config was reloaded) or dead.
+      if process.poll() is None:
+        process.kill()
+        process.wait()
+      self.prewarm(name, command)
+      return None
+    try:
+      process.stdin.write("\n")
+      process.stdin.close()
+    except IOError:
+      # Died since the poll above.
+      self.prewarm(name, command)
+      return None
+    result = Command(name, process, _monotonic(), timeout)
+    self.running.append(result)
+    # The command is already under way, so this costs it nothing.
+    self.prewarm(name, command)
+    return result
+
+  def run(self, name, command, timeout=None, capture=False):
+    """start command and return the Command tracking it. If capture is set,
+       the command's stdout is a non-blocking pipe."""
+    if name in self.standby and not capture:
+      start = _monotonic()
+      result = self._run_standby(name, command, timeout)
+      if result is not None:
+        profiler.add("command_start", _monotonic() - start)
+        return result
+    now = _monotonic()
+    argv = _command_argv(command)
+    devnull = open(os.devnull, "r+")
+    try:
+      try:
+        process = self._spawn(argv, devnull, capture)
+      except OSError:
+        # Not an executable (a shell builtin, say); let the shell deal with
+        # it as os.system would.
+        argv = ["/bin/sh", "-c", command]
+        process = self._spawn(argv, devnull, capture)
+    except OSError:
+      result = Command(name, None, now, None)
+      result.returncode = 127
+      result.duration = 0
+      self.finished.append(result)
+      return result
+    finally:
+      devnull.close()
+    result = Command(name, process, now, timeout)
+    self.running.append(result)
+    profiler.add("command_start", _monotonic() - now)
+    return result
+
+  def _spawn(self, argv, devnull, capture):
+    process = subprocess.Popen(argv, stdin=devnull,
+                               stdout=subprocess.PIPE if capture else devnull,
+                               stderr=devnull, close_fds=True)
+    if capture:
+      _set_nonblocking(process.stdout.fileno())
+    return process
+
+  def reap(self):
+    """collect commands that have exited, without blocking, and kill any that
+       are past their timeout. Returns the commands that finished since the
+       last call."""
+    now = _monotonic()
+    for command in list(self.running):
+      if command.process.poll() is None:
+        if command.deadline is not None and now >= command.deadline:
+          # Collected on a later reap once the kill lands.
+          command.timed_out = True
+          command.deadline = None
+          command.process.kill()
+      else:
+        command.returncode = command.process.returncode
+        command.duration = now - command.started
+        self.running.remove(command)
+        self.finished.append(command)
+    finished = self.finished
+    self.finished = []
+    for command in finished:
+      if command.name in _HELD_COMMANDS:
+        continue
+      metrics.observe("lazyblue_command_seconds", command.duration,
+                      (("command", command.name),))
+      if command.failed():
+        metrics.increment("lazyblue_command_failures_total",
+                          (("command", command.name),))
+    return finished
+
+  def next_deadline(self):
+    """the earliest time a running command will time out, or None."""
+    deadlines = [command.deadline for command in self.running
+                 if command.deadline is not None]
+    if deadlines:
+      return min(deadlines)
     else:
-      return -255
+      return None
 
 class ScreenLocker(object):
   """controls the actual screen locking and unlocking via user-specified
      commands."""
+  def __init__(self, runner=None):
+    self.runner = runner if runner is not None else CommandRunner()
+    self.locking = None
+    self.status = None
+    self.status_checked = None
+    self.watch = None
+    self.watch_buffer = ""
+    # Set once watch_command's output ends, until it is restarted.
+    self.watch_eof = False
+    self.watch_started = None
+    # How many times in a row the watch has exited soon after starting.
+    self.watch_failures = 0
+    self.locked = True
+
+  def prewarm(self):
+    """keep a process standing by to run the lock command at once."""
+    self.runner.prewarm("lock", config.lock_command)
+
   def unlock_screen(self):
     """execute the screen unlock command"""
-    os.system(config.unlock_command)
+    self.runner.run("unlock", config.unlock_command, config.command_timeout)
 
   def lock_screen(self):
     """execute the screen lock command"""
-    os.system(config.lock_command)
+    # Forget the answer of any status check from before this lock, and any
+    # watch events already pending.
+    self._read_watch()
+    self.status = None
+    self.status_checked = None
+    self.locked = True
+    self.locking = self.runner.run("lock", config.lock_command,
+                                   config.command_timeout)
 
   def simulate_activity(self):
     """run this command every poll step user is nearby if screen is unlocked."""
-    os.system(config.activity_command)
+    self.runner.run("activity", config.activity_command,
+                    config.command_timeout)
 
   def is_locked(self):
-    """returns whether there is a running screenlock. When unsure, trust the
-       monitor and return True."""
-    return not config.status_command or os.system(config.status_command)
+    """returns whether there is a running screenlock. Learns about changes
+       from watch_command's output if there is one, and otherwise from the
+       last status_command to finish, running another once its answer is
+       older than status_ttl. When unsure, trust the monitor and return
+       True."""
+    if config.watch_command:
+      now = _monotonic()
+      if self.watch is None and (self.watch_started is None or
+                                 now - self.watch_started >= config.status_ttl):
+        # Restarted at most once every status_ttl, so one that keeps
+        # exiting isn't forked in a loop.
+        self.watch_started = now
+        self.watch = self.runner.run("watch", config.watch_command,
+                                     capture=True)
+        self.watch_eof = False
+      if self.watch is not None:
+        self._read_watch()
+        return self.locked
+      # Until the watch is restarted, fall back on status_command if there
+      # is one.
+    if not config.status_command:
+      return True
+    if (self.status is None and self.locking is None and
+        (self.status_checked is None or
+         _monotonic() - self.status_checked >= config.status_ttl)):
+      self.status = self.runner.run("status", config.status_command,
+                                    config.command_timeout)
+    return self.locked
+
+  def _read_watch(self):
+    """update self.locked from any new lines of watch_command output."""
+    if self.watch is None or self.watch.process is None:
+      return
+    if self.watch_eof:
+      return
+    try:
+      while True:
+        data = os.read(self.watch.process.stdout.fileno(), 4096)
+        if not data:
+          self.watch_eof = True
+          break
+        self.watch_buffer += data
+    except OSError, ex:
+      if ex.errno != errno.EAGAIN:
+        raise
+    lines = self.watch_buffer.split("\n")
+    self.watch_buffer = lines.pop()
+    for line in lines:
+      if re.search(config.watch_unlock_pattern, line):
+        self.locked = False
+      elif re.search(config.watch_lock_pattern, line):
+        self.locked = True
+
+  def stop_watch(self):
+    """kill watch_command, if it is running, and forget what it said, so
+       the next is_locked starts afresh with the current settings."""
+    if self.watch is not None and self.watch.process is not None:
+      try:
+        self.watch.process.kill()
+      except OSError:
+        # Already exited.
+        pass
+      self.watch.process.stdout.close()
+    self.watch = None
+    self.watch_buffer = ""
+    self.watch_eof = False
+    self.watch_started = None
+    self.watch_failures = 0
+    self.locked = True
+
+  def watch_fds(self):
+    """file descriptors that become readable when the lock state may have
+       changed. watch_command's output stays readable once it ends, so it is
+       left out from then on."""
+    if (self.watch is not None and self.watch.process is not None and
+        not self.watch_eof):
+      return [self.watch.process.stdout.fileno()]
+    else:
+      return []
+
+  def reap(self):
+    """collect finished commands without blocking and return them. Reads
+       any watch_command output too, whatever the lock state, as its fd is
+       always waited on."""
+    self._read_watch()
+    finished = self.runner.reap()
+    for command in finished:
+      if command is self.locking:
+        self.locking = None
+      elif command is self.status:
+        self.status = None
+        self.status_checked = _monotonic()
+        self.locked = command.timed_out or command.returncode != 0
+      elif command is self.watch:
+        # Restarted by the next is_locked.
+        self._read_watch()
+        if command.process is not None:
+          command.process.stdout.close()
+        self.watch = None
+        if command.duration < config.status_ttl:
+          self.watch_failures += 1
+          if self.watch_failures == 3:
+            sys.stderr.write("watch_command keeps exiting (status %s); "
+                             "restarting it every %ss and relying on %s "
+                             "meanwhile.\n" %
+                             (command.returncode, config.status_ttl,
+                              "status_command" if config.status_command
+                              else "the screen staying locked"))
+        else:
+          self.watch_failures = 0
+    return finished
+
+  def next_deadline(self):
+    """the earliest time a running command will time out, or None."""
+    return self.runner.next_deadline()
 
 class DryRunScreenLocker(ScreenLocker):
   """don't actually run commands, just log what would happen."""
+  def prewarm(self):
+    pass
+
   def unlock_screen(self):
     """execute the screen unlock command"""
     self._print_event("unlock screen")
@@ -164,22 +1697,40 @@ class DryRunScreenLocker(ScreenLocker):
 
 class ForegroundScreenLocker(ScreenLocker):
   """Locks the screen with a given program and sends SIGTERM to unlock."""
-  def __init__(self):
+  def __init__(self, runner=None):
+    ScreenLocker.__init__(self, runner)
     self.lock_shell = None
+    self.lock_pidfd = None
 
   def unlock_screen(self):
     """execute the screen unlock command"""
-    self.lock_shell.terminate()
-    self.lock_shell = None
+    if self.lock_shell is not None:
+      if self.lock_pidfd is not None:
+        try:
+          _pidfd_send_signal(self.lock_pidfd, signal.SIGTERM)
+        except OSError:
+          # Already exited.
+          pass
+      else:
+        self.lock_shell.terminate()
+    self._forget_lock_shell()
+
+  def prewarm(self):
+    """keep a process standing by to run the lock command at once."""
+    self.runner.prewarm("foreground lock", config.lock_command)
 
   def lock_screen(self):
     """execute the screen lock command"""
-    self.lock_shell = subprocess.Popen(
-        config.lock_command,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-      )
+    self._start_lock_shell("foreground lock", config.lock_command)
+
+  def _start_lock_shell(self, name, command):
+    """run the command that keeps the screen locked until it exits, keeping
+       a pidfd for it to wait on and signal where the kernel has them."""
+    self._forget_lock_shell()
+    # Runs until unlocked, so no timeout.
+    self.lock_shell = self.runner.run(name, command).process
+    if self.lock_shell is not None:
+      self.lock_pidfd = _pidfd_open(self.lock_shell.pid)
 
   def is_locked(self):
     """returns whether there is a running screenlock."""
@@ -190,44 +1741,43 @@ class ForegroundScreenLocker(ScreenLocker):
       if self.lock_shell.returncode is None:
         return True
       else:
-        self.lock_shell = None
+        self._forget_lock_shell()
         return False
 
-class VlockScreenLocker(ForegroundScreenLocker):
-  """uses vlock to lock and unlock the screen."""
-  def __init__(self):
-    self.lock_shell = None
-    self.lock_pid = None
+  def watch_fds(self):
+    """file descriptors that become readable when the lock state may have
+       changed. Without pidfd support, lock exit is noticed through SIGCHLD
+       instead."""
+    if self.lock_pidfd is not None:
+      return [self.lock_pidfd]
+    else:
+      return []
 
-  def unlock_screen(self):
-    """execute the screen unlock command"""
-    os.system("sudo kill %i" % self.lock_pid)
+  def _forget_lock_shell(self):
     self.lock_shell = None
-    ForegroundScreenLocker.unlock_screen(self)
+    if self.lock_pidfd is not None:
+      os.close(self.lock_pidfd)
+      self.lock_pidfd = None
+
+class VlockScreenLocker(ForegroundScreenLocker):
+  """uses vlock to lock and unlock the screen."""
+  def prewarm(self):
+    """keep a process standing by to run vlock at once."""
+    self.runner.prewarm("vlock", _VLOCK_COMMAND % os.getlogin())
 
   def lock_screen(self):
     """execute the screen lock command"""
-    self.lock_shell = subprocess.Popen(
-        _VLOCK_COMMAND % os.getlogin(),
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True,
-      )
-    self.lock_pid = int(self.lock_shell.stdout.readline())
-    ForegroundScreenLocker.lock_screen(self)
-
-  def is_locked(self):
-    # Major kludge given pids can be reused and dependency on vlock
-    # implementation details. See if we can improve this later.
-    return "vlock-main" in os.popen("ps %i" % self.lock_pid, "r").read()
+    self._start_lock_shell("vlock", _VLOCK_COMMAND % os.getlogin())
 
 class Monitor(object):
   """responsible for controlling bluetooth polling, state transitions and
      coordinating locking."""
-  def __init__(self, connection, screenlocker):
+  def __init__(self, connection, screenlocker, settings=None, clock=None):
     self.connection = connection
+    self.settings = settings if settings is not None else DeviceConfig()
+    self.clock = clock
     self.last_poll = 0
+    self.last_sample = None
     self.count = 0
     self.last_locked = 0
     self.screenlocker = screenlocker
@@ -236,100 +1786,1395 @@ class Monitor(object):
     self.last_rearm = 0
     self.min_strength = None
     self.max_strength = None
+    self.interval = None
+    self.last_signal_state = None
+    self.filter = _make_filter(self.settings)
+    self.trend = TrendEstimator(self.settings.predict_window)
+    self.calibration = Calibration()
+    self.last_calibrated = None
+    self.recorder = None
+    self.event_log = None
+    self.link_watcher = None
+    self.link_lost_at = None
+    self.count_started = None
+    self.lock_gone_since = None
+
+  def _now(self):
+    """the current time on the monitor's clock, monotonic by default."""
+    if self.clock is not None:
+      return self.clock()
+    else:
+      return _monotonic()
 
   def poll(self):
-    """poll the system once and execute any necessary actions, respecting
-       config.poll_interval by sleeping until it is time for the next poll."""
-    delta = time.time() - self.last_poll
-    if delta < config.poll_interval:
-      time.sleep(config.poll_interval - delta)
-    self.last_poll = time.time()
+    """poll the system once and execute any necessary actions, sleeping until
+       the earliest of the next poll, lock, unlock, harden or rearm deadlines.
+       Lock state events that arrive while sleeping are handled at once."""
+    while True:
+      delta = self.next_deadline() - self._now()
+      if delta <= 0 or not _wait(delta, self.watch_fds()):
+        break
+      self.handle_events(self._now())
+    profiler.call(self.poll_now)
+
+  def poll_now(self):
+    """poll the system once and execute any necessary actions without
+       waiting for the next poll to be due."""
+    start = _monotonic()
+    now = self.last_poll = self._now()
+    self.handle_events(now)
+    handled = _monotonic()
+    strength = self.connection.get_signal_strength()
+    read = _monotonic()
+    self.update(strength, now)
+    done = _monotonic()
+    metrics.observe("lazyblue_poll_seconds", done - start, self._labels())
+    metrics.write_if_due()
+    if self.recorder is not None:
+      self.recorder.flush_if_due()
+    if self.event_log is not None:
+      self.event_log.flush_if_due()
+    if profiler.enabled:
+      profiler.add("poll", done - start)
+      profiler.add("events", handled - start)
+      profiler.add("signal", read - handled)
+      profiler.add("update", done - read)
+      profiler.write_if_due()
+
+  def handle_events(self, now):
+    """act on finished commands and on the screen being unlocked manually."""
+    for command in self.screenlocker.reap() + self.vlock.reap():
+      self.command_finished(command)
+
+    if (self.link_watcher is not None and
+        self.link_watcher.take_lost(self.settings.device_mac)):
+      self.link_lost(now)
+
+    # Has user manually unlocked?
+    start = _monotonic()
+    if self.state == _HARDENED:
+      if not self.vlock.is_locked():
+        self._unharden(now)
+      elif self.screenlocker.watch_fds():
+        # Take in the screen locker's events too, such as its lock program
+        # exiting under vlock, or its fds stay readable and waits spin.
+        self.screenlocker.is_locked()
+    if self.state == _LOCKED and not self.screenlocker.is_locked():
+      if self.settings.rearm_cooldown == 0:
+        sys.exit()
+      else:
+        self.state = _UNLOCKED
+        self.last_rearm = now
+    profiler.add("is_locked", _monotonic() - start)
+
+  def watch_fds(self):
+    """file descriptors to wake up for while waiting for the next deadline."""
+    fds = self.screenlocker.watch_fds() + self.vlock.watch_fds()
+    if self.link_watcher is not None:
+      fds.append(self.link_watcher.fileno(self.settings.device_mac))
+    return fds
+
+  def link_lost(self, now):
+    """the device's link has just gone down, the surest sign it has left:
+       count it as gone at once, and lock after link_loss_grace seconds
+       rather than lock_time unless it comes back."""
+    metrics.increment("lazyblue_link_losses_total", self._labels())
+    if self.event_log is not None:
+      self.event_log.log("link_lost", device=self.settings.device_mac,
+                         state=self.state)
+    self.link_lost_at = now
+    if self.last_sample is None:
+      elapsed = None
+    else:
+      elapsed = now - self.last_sample
+    self.last_sample = now
+    self.transition(_GONE, elapsed, now)
+
+  def update(self, strength, now=None):
+    """perform actions based on an observation of given strength."""
+    if now is None:
+      now = self._now()
+    if self.last_sample is None:
+      elapsed = None
+    else:
+      elapsed = now - self.last_sample
+    self.last_sample = now
+
+    filtered = self.filter.update(strength)
+    signal_state = _strength_to_state(filtered, self.settings)
+    if signal_state != _GONE:
+      self.link_lost_at = None
+    predicted = False
+    if self.settings.predictive_lock:
+      if strength == _NOT_CONNECTED:
+        # Left to the count; there's no trend through a disconnect.
+        self.trend.clear()
+      else:
+        self.trend.append(now, strength)
+        predicted = (self.state == _UNLOCKED and signal_state != _HERE and
+                     self.trend.predicts_departure(self.settings))
+    if self.settings.calibrate != "off":
+      # Sketched by the state the reading was taken in, before it acts.
+      self._calibrate(strength, now)
+    self.transition(signal_state, elapsed, now, predicted)
+    self._adapt_interval(signal_state)
+    if self.recorder is not None:
+      self.recorder.record(time.time(), strength, self.state)
+    if self.event_log is not None:
+      self.event_log.reading(self.settings.device_mac, strength, filtered,
+                             signal_state, self.state, now)
+    self.min_strength = (strength if self.min_strength is None
+                          else min(self.min_strength, strength))
+    self.max_strength = (strength if self.max_strength is None
+                          else max(self.max_strength, strength))
+    if (self.settings.harden_time is not None and self.state == _LOCKED and
+        now - self.last_locked >= self.settings.harden_time):
+      self.vlock.lock_screen()
+      self.state = _HARDENED
+
+    if self.settings.verbose:
+      print (("device: %s\tlock_state: %s\tbluetooth_state: %s\t"
+              "change_time: %.2f\tlast_locked: %i\tsignal_strength: %i\t"
+              "filtered_strength: %.1f\tmax_strength: %i\tmin_strength: %i" %
+              (self.settings.device_mac,
+              self.state,
+              signal_state,
+              self.count,
+              self.last_locked,
+              strength,
+              filtered,
+              self.max_strength,
+              self.min_strength)))
+
+  def _calibrate(self, strength, now):
+    """add a reading to the calibration sketches and, every
+       calibrate_interval, report the thresholds they suggest, and with
+       calibrate apply, switch to them."""
+    self.calibration.add(self.state, strength)
+    if self.last_calibrated is None:
+      self.last_calibrated = now
+    if now - self.last_calibrated < self.settings.calibrate_interval:
+      return
+    self.last_calibrated = now
+    suggestion = self.calibration.suggest(self.settings)
+    if suggestion is None:
+      return
+    lock_strength, unlock_strength = suggestion
+    apply = (self.settings.calibrate == "apply" and
+             suggestion != (self.settings.lock_strength,
+                            self.settings.unlock_strength))
+    if apply:
+      self.settings.overrides.update(lock_strength=lock_strength,
+                                     unlock_strength=unlock_strength)
+    if self.settings.verbose:
+      print ("device: %s\tcalibrated lock_strength: %i\tunlock_strength: %i"
+             "\t%s" % (self.settings.device_mac, lock_strength,
+                       unlock_strength, "applied" if apply else "suggested"))
+    if self.event_log is not None:
+      self.event_log.log("calibration", device=self.settings.device_mac,
+                         lock_strength=lock_strength,
+                         unlock_strength=unlock_strength, applied=apply,
+                         readings=len(self.calibration.sketches[_UNLOCKED]) +
+                                  len(self.calibration.sketches[_LOCKED]))
+
+  def transition(self, signal_state, elapsed=None, now=None, predicted=False):
+    """performs state machine transition and necessary actions. elapsed is the
+       time since the previous observation. predicted means the signal's
+       trend says the device is leaving, so lock without waiting for
+       lock_time."""
+    if now is None:
+      now = self._now()
+    if signal_state is _NEITHER and not predicted:
+      # Signal not either way.
+      self.count = 0
+    elif self.state == _HARDENED:
+      # Don't do anything until unlocked manually
+      if not self.vlock.is_locked():
+        self._unharden(now)
+    elif ((self.state == _UNLOCKED and signal_state == _HERE) or
+        (self.state == _LOCKED and signal_state == _GONE)):
+      # Stay in same state.
+      self.count = 0
+    else:
+      # Consider changing lock state. Count the real time between readings,
+      # so a slow read or reconnect doesn't stretch lock_time; the first
+      # reading stands for one poll interval, since we know nothing about the
+      # time before it.
+      if elapsed is None or self.count <= 0:
+        elapsed = self._poll_interval()
+        self.count_started = now
+      self.count += elapsed
+
+      if self.state == _LOCKED and self.count >= self.settings.unlock_time:
+        self.count = 0
+        self.screenlocker.unlock_screen()
+        self.state = _UNLOCKED
+        metrics.increment("lazyblue_unlocks_total", self._labels())
+      elif (self.state == _UNLOCKED and
+            (self.count >= self._lock_time() or predicted)):
+        if (self.last_locked + self.settings.lock_cooldown <= now and
+            self.last_rearm + self.settings.rearm_cooldown <= now):
+          self.screenlocker.lock_screen()
+          self.state = _LOCKED
+          self.count = 0
+          self.last_locked = now
+          self.link_lost_at = None
+          metrics.increment("lazyblue_locks_total", self._labels())
+          self._lock_started(now)
+
+  def _lock_time(self):
+    """how long the device must be gone before locking: lock_time, or
+       link_loss_grace if that is shorter and the link has gone down."""
+    if (self.link_lost_at is not None and
+        self.settings.link_loss_grace is not None):
+      return min(self.settings.lock_time, self.settings.link_loss_grace)
+    return self.settings.lock_time
+
+  def _lock_started(self, now):
+    """note when the device first read as gone before this lock, to measure
+       the lock latency once the lock command finishes. Lockers that run no
+       lock command to completion are locked as soon as it starts."""
+    self.lock_gone_since = self.count_started
+    if getattr(self.screenlocker, "locking", None) is None:
+      self._lock_completed(now)
+
+  def _lock_completed(self, now):
+    if self.lock_gone_since is not None:
+      metrics.observe("lazyblue_lock_latency_seconds",
+                      now - self.lock_gone_since, self._labels(),
+                      _LOCK_LATENCY_BUCKETS)
+      self.lock_gone_since = None
+
+  def _labels(self):
+    """metric labels identifying this monitor's device."""
+    return (("device", self.settings.device_mac),)
+
+  def _unharden(self, now):
+    """vlock has exited, so the user unlocked by hand: unlock the screen
+       under it too and start over."""
+    self.vlock.unlock_screen()
+    self.screenlocker.unlock_screen()
+    self.last_rearm = now
+    self.count = 0
+    self.state = _UNLOCKED
+    metrics.increment("lazyblue_unlocks_total", self._labels())
+
+  def command_finished(self, command):
+    """act on the exit status of a command run by the screen locker."""
+    if (command.failed() and self.settings.verbose and
+        command.name not in _HELD_COMMANDS):
+      print ("%s command %s after %.2fs" %
+             (command.name,
+              "timed out" if command.timed_out
+              else "failed with status %s" % command.returncode,
+              command.duration))
+    if command.name == "lock" and command.failed() and self.state == _LOCKED:
+      # The screen never locked. Go back to unlocked with the lock due, so it
+      # is retried once lock_cooldown allows.
+      self.state = _UNLOCKED
+      self.count = self.settings.lock_time
+      self.lock_gone_since = None
+    elif (command.name == "vlock" and command.failed() and
+          self.state == _HARDENED):
+      # vlock never took hold (sudo refused, say), rather than the user
+      # unlocking it. The screen locker is still up, so stay locked, and
+      # retry after another harden_time. Its pidfd would stay readable.
+      if self.settings.verbose:
+        print ("vlock failed with status %s after %.2fs" %
+               (command.returncode, command.duration))
+      self.vlock._forget_lock_shell()
+      self.state = _LOCKED
+      self.last_locked = self._now()
+    elif command.name == "lock" and not command.failed():
+      self._lock_completed(self._now())
+
+  def deadlines(self):
+    """the times of upcoming events by name: the next poll, and any lock,
+       unlock, harden or rearm that is pending. Events due before the last
+       poll have already had their chance and are left out."""
+    deadlines = {"poll": self.last_poll + self._poll_interval()}
+    if self.count > 0 and self.last_sample is not None:
+      if self.state == _LOCKED:
+        deadlines["unlock"] = (self.last_sample + self.settings.unlock_time -
+                               self.count)
+      elif self.state == _UNLOCKED:
+        deadlines["lock"] = (self.last_sample + self._lock_time() -
+                             self.count)
+        deadlines["rearm"] = max(
+            self.last_locked + self.settings.lock_cooldown,
+            self.last_rearm + self.settings.rearm_cooldown)
+    if self.state == _LOCKED and self.settings.harden_time is not None:
+      deadlines["harden"] = self.last_locked + self.settings.harden_time
+    for screenlocker in (self.screenlocker, self.vlock):
+      command_deadline = screenlocker.next_deadline()
+      if command_deadline is not None:
+        deadlines["command"] = min(command_deadline,
+                                   deadlines.get("command", command_deadline))
+    return dict((name, deadline) for (name, deadline) in deadlines.items()
+                if name == "poll" or deadline > self.last_poll)
+
+  def next_deadline(self):
+    """the time of the earliest upcoming event."""
+    return min(self.deadlines().values())
+
+  def _poll_interval(self):
+    """the time between the last poll and the next one."""
+    if self.settings.adaptive_poll and self.interval is not None:
+      return self.interval
+    else:
+      return self.settings.poll_interval
+
+  def _adapt_interval(self, signal_state):
+    """in adaptive mode, sample rapidly while the signal is near the thresholds
+       or a lock state change is being considered, and back off exponentially
+       while it stays put."""
+    if not self.settings.adaptive_poll:
+      return
+    if signal_state == _NEITHER or self.count > 0:
+      self.interval = self.settings.min_poll_interval
+    elif signal_state == self.last_signal_state:
+      self.interval = min(self._poll_interval() * 2,
+                          self.settings.max_poll_interval)
+    else:
+      self.interval = self.settings.poll_interval
+    self.last_signal_state = signal_state
+
+  def poll_loop(self, count=None):
+    """poll repeatedly the specified number of times, or forever if
+       count=None."""
+    while count is None or count > 0:
+      if _reload_requested:
+        reload_config([self])
+      if _cprofile_requested:
+        _toggle_cprofile()
+      self.poll()
+      if count is not None:
+        count -= 1
+
+class WorkerPool(object):
+  """a fixed number of daemon threads running submitted jobs."""
+  def __init__(self, size):
+    self.jobs = Queue.Queue()
+    self.size = size
+    for _ in range(size):
+      worker = threading.Thread(target=self._work)
+      worker.daemon = True
+      worker.start()
+
+  def submit(self, function, *args):
+    """run function(*args) on the next free worker."""
+    self.jobs.put((function, args))
+
+  def stop(self):
+    """have the workers exit once the jobs already submitted are done."""
+    for _ in range(self.size):
+      self.jobs.put(None)
+
+  def _work(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        return
+      function, args = job
+      function(*args)
+
+class MonitorPool(object):
+  """polls several monitors concurrently through a bounded pool of workers,
+     so that a slow or disconnected device does not delay the others. Lock
+     state and link events of monitors not being polled are handled as they
+     arrive, as Monitor.poll does."""
+  def __init__(self, monitors, workers):
+    self.monitors = monitors
+    self.workers = WorkerPool(min(workers, len(monitors)))
+    self.done = Queue.Queue()
+    # Written to whenever a poll is done, so the scheduler can wait for
+    # that and for events in one _wait.
+    self.done_fd, self.done_write_fd = os.pipe()
+    for fd in (self.done_fd, self.done_write_fd):
+      _set_nonblocking(fd)
+      fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+  def _poll(self, monitor):
+    """poll a monitor on a worker and report back to the scheduler."""
+    try:
+      profiler.call(monitor.poll_now)
+      self.done.put((monitor, None))
+    except SystemExit:
+      # User unlocked manually with rearm disabled; stop watching this
+      # device but keep watching the others.
+      self.done.put((monitor, SystemExit))
+    except Exception:
+      self.done.put((monitor, sys.exc_info()))
+    os.write(self.done_write_fd, "x")
+
+  def _finished(self):
+    """the (monitor, error) of each poll done since last called."""
+    try:
+      while os.read(self.done_fd, 4096):
+        pass
+    except OSError, ex:
+      if ex.errno != errno.EAGAIN:
+        raise
+    finished = []
+    while True:
+      try:
+        finished.append(self.done.get_nowait())
+      except Queue.Empty:
+        return finished
+
+  def poll_loop(self):
+    """poll each monitor whenever it is due, until all of them have exited."""
+    idle = list(self.monitors)
+    active = len(self.monitors)
+    while active:
+      if _reload_requested and len(idle) == active:
+        # No polls in flight, so none sees a mix of old and new settings.
+        reload_config(self.monitors)
+      if _cprofile_requested and len(idle) == active:
+        _toggle_cprofile()
+      now = _monotonic()
+      for monitor in [m for m in idle if m.next_deadline() <= now]:
+        idle.remove(monitor)
+        self.workers.submit(self._poll, monitor)
+
+      if idle:
+        timeout = max(0, min(m.next_deadline() for m in idle) - _monotonic())
+      else:
+        # Long timeout rather than none so KeyboardInterrupt gets through.
+        timeout = 3600
+      watched = [(m, m.watch_fds()) for m in idle]
+      readable = _wait(timeout, sum((fds for (_, fds) in watched),
+                                    [self.done_fd]))
+
+      # No poll is in flight for idle monitors, so their events can be
+      # handled here.
+      for (monitor, fds) in watched:
+        if set(fds).intersection(readable):
+          try:
+            monitor.handle_events(_monotonic())
+          except SystemExit:
+            idle.remove(monitor)
+            active -= 1
+
+      for (monitor, error) in self._finished():
+        if error is SystemExit:
+          active -= 1
+        elif error is not None:
+          raise error[0], error[1], error[2]
+        else:
+          idle.append(monitor)
+
+class EventLoop(object):
+  """calls back when file descriptors become readable and when timers fall
+     due, waiting for both in one _wait, so nothing waits on anything else.
+     Signals wake it up too, and call the wakeup callbacks."""
+  def __init__(self, clock=None):
+    self.clock = clock if clock is not None else _monotonic
+    # Heap of [time, sequence, callback]; cancelled timers lose their
+    # callback and are dropped when they reach the top.
+    self.timers = []
+    self.sequence = itertools.count()
+    self.readers = {}
+    self.wakeup_callbacks = []
+    self.running = False
+
+  def call_at(self, when, callback):
+    """call callback() at when, returning a timer that cancel takes."""
+    timer = [when, next(self.sequence), callback]
+    heapq.heappush(self.timers, timer)
+    return timer
+
+  def cancel(self, timer):
+    timer[2] = None
+
+  def add_reader(self, fd, callback):
+    """call callback() whenever fd is readable."""
+    self.readers[fd] = callback
+
+  def remove_reader(self, fd):
+    self.readers.pop(fd, None)
+
+  def run_once(self):
+    """wait for the next timer, readable fd or signal, and call back for
+       whatever happened."""
+    while self.timers and self.timers[0][2] is None:
+      heapq.heappop(self.timers)
+    if self.timers:
+      timeout = max(0, self.timers[0][0] - self.clock())
+    else:
+      # Long timeout rather than none so KeyboardInterrupt gets through.
+      timeout = 3600
+    readable = _wait(timeout, self.readers.keys())
+    if _wakeup_fd is not None and _wakeup_fd in readable:
+      for callback in list(self.wakeup_callbacks):
+        callback()
+    for fd in readable:
+      # An earlier callback may have removed it.
+      callback = self.readers.get(fd)
+      if callback is not None:
+        callback()
+    now = self.clock()
+    while self.timers and self.timers[0][0] <= now:
+      callback = heapq.heappop(self.timers)[2]
+      if callback is not None:
+        callback()
+
+  def run(self):
+    """run until stop is called."""
+    self.running = True
+    while self.running:
+      self.run_once()
+
+  def stop(self):
+    self.running = False
+
+class MonitorTask(object):
+  """drives a Monitor from an EventLoop: polls it when its next deadline
+     comes, and handles finished commands, lock state changes and the
+     connection dropping as soon as they happen rather than at the next
+     poll. Monitor.update and transition still make every decision."""
+  def __init__(self, loop, monitor, on_exit):
+    self.loop = loop
+    self.monitor = monitor
+    self.on_exit = on_exit
+    self.timer = None
+    self.fds = []
+
+  def schedule(self):
+    """(re)arm the poll timer and the fds to watch, which change as the
+       monitor locks, unlocks and reconnects."""
+    if self.timer is not None:
+      self.loop.cancel(self.timer)
+    for fd in self.fds:
+      self.loop.remove_reader(fd)
+    event_fds = self.monitor.watch_fds()
+    connection_fds = self.monitor.connection.watch_fds()
+    for fd in event_fds:
+      self.loop.add_reader(fd, self.handle_events)
+    for fd in connection_fds:
+      self.loop.add_reader(fd, self.poll)
+    self.fds = event_fds + connection_fds
+    self.timer = self.loop.call_at(self.monitor.next_deadline(), self.poll)
+
+  def poll(self):
+    self._step(profiler.call, self.monitor.poll_now)
+
+  def handle_events(self):
+    self._step(self.monitor.handle_events, self.monitor._now())
+
+  def _step(self, function, *args):
+    try:
+      function(*args)
+    except SystemExit:
+      # User unlocked manually with rearm disabled; stop watching this
+      # device but keep watching the others.
+      self.stop()
+      self.on_exit(self)
+      return
+    self.schedule()
+
+  def stop(self):
+    if self.timer is not None:
+      self.loop.cancel(self.timer)
+      self.timer = None
+    for fd in self.fds:
+      self.loop.remove_reader(fd)
+    self.fds = []
+
+def run_event_loop(monitors, loop=None):
+  """watch monitors from one EventLoop until all of them have exited."""
+  if loop is None:
+    loop = EventLoop()
+  tasks = []
+
+  def task_exited(task):
+    tasks.remove(task)
+    if not tasks:
+      loop.stop()
+
+  def woken():
+    # Nothing runs between callbacks, so a reload never lands mid-poll.
+    if _reload_requested:
+      reload_config(monitors)
+    if _cprofile_requested:
+      _toggle_cprofile()
+    # SIGCHLD, say; commands may have finished.
+    for task in list(tasks):
+      task.handle_events()
+
+  for monitor in monitors:
+    task = MonitorTask(loop, monitor, task_exited)
+    tasks.append(task)
+    task.schedule()
+  loop.wakeup_callbacks.append(woken)
+  loop.run()
+
+# Subscribers may name any device, so only accept what looks like a MAC.
+_MAC_PATTERN = re.compile(r"([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$")
+# Python 2's socket module lacks it; this is its value on Linux.
+_SO_PEERCRED = 17
+_UCRED = struct.Struct("3i")
+
+def _peer_uid(sock):
+  """the uid of the process at the other end of a Unix socket."""
+  return _UCRED.unpack(sock.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED,
+                                       _UCRED.size))[1]
+
+def _user_id(user):
+  """the uid of a user given by name or number. Raises KeyError if there
+     is no such user."""
+  if user.isdigit():
+    return int(user)
+  return pwd.getpwnam(user).pw_uid
+
+def _listening(path):
+  """whether something accepts connections on the Unix socket at path."""
+  probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    probe.connect(path)
+    return True
+  except socket.error:
+    return False
+  finally:
+    probe.close()
+
+class Broker(object):
+  """shares one set of device connections between several lazyblue
+     clients, such as one per user. Clients connect to a Unix socket and
+     send SUBSCRIBE MAC lines; each subscribed device is connected to once
+     and sampled once every poll_interval however many clients want it, and
+     each reading is pushed to its subscribers as a "MAC STRENGTH" line. A
+     device is let go once its last subscriber leaves. Runs on an
+     EventLoop.
+
+     The socket is open to every user, but only root, the broker's own user
+     and the given uids are let in. Each client may only subscribe to a few
+     devices, as each one makes the broker hold a connection open."""
+  def __init__(self, path, loop, make_connection, uids=()):
+    self.path = path
+    self.loop = loop
+    self.make_connection = make_connection
+    self.uids = set(uids) | set([0, os.getuid()])
+    if os.path.exists(path):
+      if _listening(path):
+        raise socket.error(errno.EADDRINUSE,
+                           "another broker is listening on %s" % path)
+      # Left behind by a broker that didn't exit cleanly.
+      os.unlink(path)
+    self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.listener.bind(path)
+    # Every user's lazyblue connects as that user.
+    os.chmod(path, 0666)
+    self.listener.listen(16)
+    self.listener.setblocking(False)
+    loop.add_reader(self.listener.fileno(), self._accept)
+    # Per client fd: [socket, unparsed input, subscribed MACs].
+    self.clients = {}
+    self.connections = {}
+    self.subscribers = {}
+    self.timer = loop.call_at(_monotonic(), self._sample)
+
+  def _accept(self):
+    try:
+      sock = self.listener.accept()[0]
+    except socket.error:
+      return
+    sock.setblocking(False)
+    if _peer_uid(sock) not in self.uids:
+      try:
+        sock.send("ERROR not allowed\n")
+      except socket.error:
+        pass
+      sock.close()
+      return
+    fd = sock.fileno()
+    self.clients[fd] = [sock, "", set()]
+    self.loop.add_reader(fd, lambda: self._read(fd))
+
+  def _read(self, fd):
+    client = self.clients[fd]
+    try:
+      data = client[0].recv(4096)
+    except socket.error, ex:
+      if ex.args[0] in (errno.EAGAIN, errno.EINTR):
+        return
+      data = ""
+    if not data:
+      self._drop(fd)
+      return
+    lines = (client[1] + data).split("\n")
+    client[1] = lines.pop()
+    for line in lines:
+      self._command(fd, line.split())
+    if len(client[1]) > 4096:
+      self._drop(fd)
+
+  def _command(self, fd, words):
+    if len(words) == 2 and words[0] == "SUBSCRIBE" and _MAC_PATTERN.match(
+        words[1]):
+      mac = words[1].upper()
+      if mac in self.clients[fd][2]:
+        return
+      if len(self.clients[fd][2]) >= config.broker_max_subscriptions:
+        self._send(fd, "ERROR too many subscriptions\n")
+        return
+      if (mac not in self.connections and
+          len(self.connections) >= config.broker_max_devices):
+        self._send(fd, "ERROR too many devices\n")
+        return
+      if mac not in self.connections:
+        self.connections[mac] = self.make_connection(mac)
+        self.subscribers[mac] = set()
+      self.subscribers[mac].add(fd)
+      self.clients[fd][2].add(mac)
+    elif words:
+      self._send(fd, "ERROR expected SUBSCRIBE MAC\n")
+
+  def _send(self, fd, line):
+    """send line to a client, dropping the client rather than waiting if
+       it has stopped reading."""
+    try:
+      if self.clients[fd][0].send(line) == len(line):
+        return
+    except socket.error:
+      pass
+    self._drop(fd)
+
+  def _drop(self, fd):
+    client = self.clients.pop(fd, None)
+    if client is None:
+      return
+    self.loop.remove_reader(fd)
+    client[0].close()
+    for mac in client[2]:
+      self.subscribers[mac].discard(fd)
+      if not self.subscribers[mac]:
+        del self.subscribers[mac]
+        self.connections.pop(mac).close()
+
+  def _sample(self):
+    """read each subscribed device once and push the reading to all its
+       subscribers."""
+    for (mac, connection) in self.connections.items():
+      line = "%s %i\n" % (mac, connection.get_signal_strength())
+      for fd in list(self.subscribers.get(mac, ())):
+        self._send(fd, line)
+    self.timer = self.loop.call_at(_monotonic() + config.poll_interval,
+                                   self._sample)
+
+  def close(self):
+    for fd in self.clients.keys():
+      self._drop(fd)
+    self.listener.close()
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
+
+class BrokerClient(object):
+  """subscribes to devices from a Broker from a background thread, keeping
+     their latest readings in a PresenceTable. Reconnects whenever the
+     broker goes away, waiting longer after each try that brought no
+     readings, such as when the broker refuses us. ERROR replies are
+     reported on stderr and in the event log."""
+  def __init__(self, path, macs, table=None, event_log=None):
+    self.path = path
+    self.macs = [mac.upper() for mac in macs]
+    self.table = table if table is not None else PresenceTable()
+    self.event_log = event_log
+    self.thread = None
+    self.failures = 0
+    # ERROR replies reported since the last reading, so a broker that keeps
+    # refusing us isn't reported on every try.
+    self.errors = set()
+
+  def start(self):
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      try:
+        self.receive()
+      except socket.error:
+        pass
+      time.sleep(min(config.connect_interval * 2 ** min(self.failures, 30),
+                     config.max_connect_interval))
+      self.failures += 1
+
+  def receive(self):
+    """connect, subscribe and record readings until the broker hangs up."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self.path)
+      sock.sendall("".join("SUBSCRIBE %s\n" % mac for mac in self.macs))
+      for line in sock.makefile("r"):
+        self.handle_line(line)
+    finally:
+      sock.close()
+
+  def handle_line(self, line):
+    words = line.split()
+    if words and words[0] == "ERROR":
+      self._report_error(" ".join(words[1:]))
+      return
+    if len(words) != 2 or words[0] not in self.macs:
+      return
+    try:
+      self.table.update(words[0], int(words[1]))
+    except ValueError:
+      return
+    self.failures = 0
+    self.errors.clear()
+
+  def _report_error(self, message):
+    if message in self.errors:
+      return
+    self.errors.add(message)
+    sys.stderr.write("The broker on %s replied: %s.\n" % (self.path, message))
+    if self.event_log is not None:
+      self.event_log.log("broker_error", message=message)
+
+class BrokerConnection(object):
+  """presents a device's latest reading from a Broker, as kept in a
+     PresenceTable by a BrokerClient, as a Connection would."""
+  def __init__(self, mac, table):
+    self.mac = mac
+    self.table = table
+
+  def get_signal_strength(self):
+    strength = self.table.read(self.mac, config.broker_timeout)
+    if strength is None:
+      return _NOT_CONNECTED
+    else:
+      return strength
+
+  def watch_fds(self):
+    return []
+
+def run_broker(path, ready_fd=None):
+  """serve readings to clients on the Unix socket at path until killed,
+     reporting readiness once clients can connect."""
+  loop = EventLoop()
+  try:
+    broker = Broker(path, loop, _connection_factory(),
+                    [_user_id(user) for user in config.broker_user_names])
+  except socket.error, ex:
+    sys.stderr.write("Can't serve the broker on %s: %s.\n" %
+                     (path, ex.args[-1]))
+    sys.exit(1)
+  atexit.register(broker.close)
+  _notify_ready(ready_fd)
+  loop.run()
+
+_TRACE_HEADER = struct.Struct("<4sH")
+_TRACE_MAGIC = "LZBT"
+_TRACE_VERSION = 1
+# Wall clock time, signal strength, index into _TRACE_STATES.
+_TRACE_RECORD = struct.Struct("<dhB")
+_TRACE_STATES = (_UNLOCKED, _LOCKED, _HARDENED)
+
+def _rotate_file(path, backups):
+  """move path to path.1, path.1 to path.2 and so on, keeping at most
+     backups old files."""
+  for index in range(backups - 1, 0, -1):
+    if os.path.exists("%s.%i" % (path, index)):
+      os.rename("%s.%i" % (path, index), "%s.%i" % (path, index + 1))
+  if backups > 0 and os.path.exists(path):
+    os.rename(path, path + ".1")
+  elif os.path.exists(path):
+    os.unlink(path)
+
+class RotatingWriter(object):
+  """appends to a file through a buffer, rotating the file once it would
+     grow past max_bytes. A file left over max_bytes by an earlier run is
+     rotated on opening. Call flush_if_due regularly so records don't sit
+     in the buffer while few arrive."""
+  # Flush once this many records or seconds are buffered.
+  FLUSH_RECORDS = 256
+  FLUSH_SECONDS = 10
+
+  def __init__(self, path, max_bytes=0, backups=0):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.backups = backups
+    self.pending = []
+    self.last_flush = _monotonic()
+    self._open()
+
+  def _open(self):
+    self.fd = open(self.path, "ab")
+    self.size = os.fstat(self.fd.fileno()).st_size
+    self.header_size = 0
+    if self.max_bytes and self.size >= self.max_bytes:
+      self.fd.close()
+      _rotate_file(self.path, self.backups)
+      self.fd = open(self.path, "ab")
+      self.size = 0
+
+  def _write(self, data):
+    """buffer data, flushing if enough is buffered or it has been a while."""
+    self.pending.append(data)
+    if (len(self.pending) >= self.FLUSH_RECORDS or
+        _monotonic() - self.last_flush >= self.FLUSH_SECONDS):
+      self.flush()
+
+  def flush_if_due(self):
+    """flush if FLUSH_SECONDS have passed since the last flush."""
+    if _monotonic() - self.last_flush >= self.FLUSH_SECONDS:
+      self.flush()
+
+  def flush(self):
+    """write out buffered records, rotating the file first if need be."""
+    self.last_flush = _monotonic()
+    if not self.pending:
+      return
+    data = "".join(self.pending)
+    self.pending = []
+    if (self.max_bytes and self.size > self.header_size and
+        self.size + len(data) > self.max_bytes):
+      self.fd.close()
+      _rotate_file(self.path, self.backups)
+      self._open()
+    self.fd.write(data)
+    self.fd.flush()
+    self.size += len(data)
+
+  def close(self):
+    """flush and close the file."""
+    self.flush()
+    self.fd.close()
+
+class TraceWriter(RotatingWriter):
+  """appends fixed width (time, signal strength, lock state) records to a
+     binary trace file."""
+  def _open(self):
+    RotatingWriter._open(self)
+    self.header_size = _TRACE_HEADER.size
+    if self.size == 0:
+      self.fd.write(_TRACE_HEADER.pack(_TRACE_MAGIC, _TRACE_VERSION))
+      self.fd.flush()
+      self.size = _TRACE_HEADER.size
+
+  def record(self, timestamp, strength, state):
+    """buffer one observation."""
+    self._write(_TRACE_RECORD.pack(timestamp, strength,
+                                   _TRACE_STATES.index(state)))
+
+class EventLog(RotatingWriter):
+  """logs what monitors see and do as newline-delimited JSON. In "all" mode
+     every reading is logged; in "changes" mode only readings that change
+     the lock or signal state, plus a summary of each device's readings
+     every summary_interval seconds. Shared by all monitors."""
+  def __init__(self, path, max_bytes=0, backups=0, mode="changes",
+               summary_interval=60):
+    RotatingWriter.__init__(self, path, max_bytes, backups)
+    self.mode = mode
+    self.summary_interval = summary_interval
+    self.lock = threading.Lock()
+    # Per device: the last (lock state, signal state) logged, and the
+    # [count, sum, min, max, start] of readings since the last summary.
+    self.states = {}
+    self.summaries = {}
+
+  def log(self, event, **fields):
+    """log an event with the given fields, and the time."""
+    fields["event"] = event
+    fields["time"] = round(time.time(), 3)
+    line = json.dumps(fields, sort_keys=True, separators=(",", ":")) + "\n"
+    with self.lock:
+      self._write(line)
+
+  def flush_if_due(self):
+    with self.lock:
+      RotatingWriter.flush_if_due(self)
+
+  def reading(self, device, strength, filtered, signal_state, state, now):
+    """note a monitor's reading and the states it left the monitor in."""
+    if self.mode == "all":
+      self.log("reading", device=device, strength=strength,
+               filtered=round(filtered, 1), signal=signal_state, state=state)
+      return
+    if self.states.get(device) != (state, signal_state):
+      self.states[device] = (state, signal_state)
+      self.log("change", device=device, strength=strength,
+               filtered=round(filtered, 1), signal=signal_state, state=state)
+    summary = self.summaries.get(device)
+    if summary is None:
+      summary = self.summaries[device] = [0, 0, strength, strength, now]
+    summary[0] += 1
+    summary[1] += strength
+    summary[2] = min(summary[2], strength)
+    summary[3] = max(summary[3], strength)
+    if now - summary[4] >= self.summary_interval:
+      self.log("summary", device=device, readings=summary[0],
+               mean_strength=round(float(summary[1]) / summary[0], 1),
+               min_strength=summary[2], max_strength=summary[3], state=state)
+      del self.summaries[device]
+
+def read_trace(path):
+  """return the (time, signal strength, lock state) records of a trace
+     file."""
+  with open(path, "rb") as fd:
+    data = fd.read()
+  if (len(data) < _TRACE_HEADER.size or
+      _TRACE_HEADER.unpack_from(data) != (_TRACE_MAGIC, _TRACE_VERSION)):
+    raise ValueError("%s is not a lazyblue trace" % path)
+  unpack = _TRACE_RECORD.unpack_from
+  records = []
+  for offset in xrange(_TRACE_HEADER.size,
+                       len(data) - _TRACE_RECORD.size + 1,
+                       _TRACE_RECORD.size):
+    timestamp, strength, state = unpack(data, offset)
+    records.append((timestamp, strength, _TRACE_STATES[state]))
+  return records
+
+class VirtualClock(object):
+  """a clock that only moves when told to, for replaying traces."""
+  def __init__(self):
+    self.now = 0
+
+  def __call__(self):
+    return self.now
+
+class ReplayScreenLocker(DryRunScreenLocker):
+  """records the (event, time) of each lock and unlock a replay causes."""
+  def __init__(self, clock, events, lock_event="lock", unlock_event="unlock"):
+    DryRunScreenLocker.__init__(self)
+    self.clock = clock
+    self.events = events
+    self.lock_event = lock_event
+    self.unlock_event = unlock_event
+
+  def lock_screen(self):
+    self.events.append((self.lock_event, self.clock()))
+
+  def unlock_screen(self):
+    self.events.append((self.unlock_event, self.clock()))
+
+  def simulate_activity(self):
+    pass
+
+def _replay_monitor(settings):
+  """a Monitor on a virtual clock with lockers that record the (event, time)
+     of each lock and unlock. Returns the monitor, clock and event list."""
+  clock = VirtualClock()
+  events = []
+  monitor = Monitor(None, ReplayScreenLocker(clock, events), settings, clock)
+  monitor.vlock = ReplayScreenLocker(clock, events, "harden", "unharden")
+  return monitor, clock, events
+
+def replay(records, settings=None):
+  """feed recorded (time, signal strength, lock state) records through a
+     Monitor on a virtual clock, as fast as they can be processed. Returns the
+     list of (event, time) lock and unlock events that resulted."""
+  monitor, clock, events = _replay_monitor(settings)
+  _replay_into(monitor, clock, records)
+  return events
+
+def _replay_into(monitor, clock, records):
+  """feed records through monitor, moving clock along with them."""
+  update = monitor.update
+  for (timestamp, strength, _) in records:
+    # Wall clock times; never let them run backwards.
+    if timestamp > clock.now:
+      clock.now = timestamp
+    monitor.last_poll = clock.now
+    update(strength, clock.now)
+
+def _replay_main():
+  """replay the trace files given with --replay and summarise the result."""
+  records = []
+  for path in config.replay:
+    records.extend(read_trace(path))
+  monitor, clock, events = _replay_monitor(None)
+  start = _monotonic()
+  _replay_into(monitor, clock, records)
+  elapsed = _monotonic() - start
+  for (event, timestamp) in events:
+    print "%s\t%s" % (time.strftime("%Y-%m-%d %H:%M:%S",
+                                     time.localtime(timestamp)), event)
+  span = records[-1][0] - records[0][0] if records else 0
+  print ("replayed %i readings covering %.0f seconds in %.2f seconds: "
+         "%i locks, %i unlocks" %
+         (len(records), span, elapsed,
+          len([e for e in events if e[0] == "lock"]),
+          len([e for e in events if e[0] == "unlock"])))
+  if config.calibrate != "off":
+    suggestion = monitor.calibration.suggest(monitor.settings)
+    if suggestion is None:
+      print ("too few readings to calibrate from; calibrate_min_samples is "
+             "%i" % config.calibrate_min_samples)
+    else:
+      print "calibration suggests lock_strength %i, unlock_strength %i" % (
+          suggestion)
+
+# Options the tuner searches over, in the order of a candidate tuple.
+_TUNED_OPTIONS = ("lock_strength", "unlock_strength", "lock_time",
+                  "unlock_time")
+
+def _parse_range(text):
+  """parse LO:HI or LO:HI:STEP into the list of integers it covers."""
+  parts = [int(part) for part in text.split(":")]
+  if len(parts) == 2:
+    parts.append(1)
+  if len(parts) != 3 or parts[2] < 1 or parts[0] > parts[1]:
+    raise ValueError(text)
+  return range(parts[0], parts[1] + 1, parts[2])
+
+def _median(values):
+  """the median of a list of numbers, or None if it is empty."""
+  if not values:
+    return None
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  else:
+    return (values[middle - 1] + values[middle]) / 2.0
+
+# Traces being tuned against, set in each tuning worker.
+_tune_times = None
+_tune_strengths = None
+_tune_changes = None
+_tune_departures = None
+
+def _tune_init(records):
+  """set up the traces a tuning worker replays. records are already
+     filtered, with times made monotonic as replay does."""
+  global _tune_times, _tune_strengths, _tune_changes, _tune_departures
+  _tune_times = [record[0] for record in records]
+  _tune_strengths = [record[1] for record in records]
+  # Indices where the reading differs from the one before.
+  _tune_changes = [0] + [index for index in xrange(1, len(records))
+                         if _tune_strengths[index] !=
+                            _tune_strengths[index - 1]]
+  # Ground truth for departures: the device staying disconnected for longer
+  # than false_lock_window.
+  _tune_departures = []
+  start = None
+  for (timestamp, strength) in itertools.izip(_tune_times, _tune_strengths):
+    if strength == _NOT_CONNECTED:
+      if start is None:
+        start = timestamp
+    else:
+      if start is not None and timestamp - start >= config.false_lock_window:
+        _tune_departures.append((start, timestamp))
+      start = None
+
+def _replay_runs(starts, settings):
+  """replay the tuning traces through a Monitor like replay(), but only feed
+     it the readings that can change its state. starts are the indices at
+     which the classification of the readings changes. Within a run of
+     readings classified the same way, once the monitor's count is zero the
+     rest of the run would leave it untouched, so is skipped. Returns the
+     (event, time) list."""
+  monitor, clock, events = _replay_monitor(settings)
+  update = monitor.update
+  times = _tune_times
+  strengths = _tune_strengths
+  ends = starts[1:] + [len(times)]
+  for (index, end) in itertools.izip(starts, ends):
+    while index < end:
+      clock.now = monitor.last_poll = times[index]
+      update(strengths[index], clock.now)
+      if not monitor.count:
+        break
+      index += 1
+  return events
+
+def _run_start(index, still_running):
+  """the time of the first of the consecutive readings ending at index for
+     which still_running(strength) holds."""
+  while index > 0 and still_running(_tune_strengths[index - 1]):
+    index -= 1
+  return _tune_times[index]
+
+def _evaluate_strengths(task):
+  """replay the traces with each candidate sharing one lock and unlock
+     strength, and measure how they do. task is ((lock_strength,
+     unlock_strength), [(lock_time, unlock_time), ...]). Returns a list of
+     (candidate, results)."""
+  (lock_strength, unlock_strength), times = task
+  classes = [2 if strength >= unlock_strength else
+             0 if strength < lock_strength else 1
+             for strength in (_tune_strengths[index]
+                              for index in _tune_changes)]
+  starts = [index for (index, previous, current) in
+            itertools.izip(_tune_changes, [None] + classes, classes)
+            if previous != current]
+  results = []
+  for (lock_time, unlock_time) in times:
+    candidate = (lock_strength, unlock_strength, lock_time, unlock_time)
+    overrides = dict(zip(_TUNED_OPTIONS, candidate))
+    # Readings were filtered once up front, and the skipping in _replay_runs
+    # relies on nothing but readings changing the monitor's state.
+    overrides.update(filter="none", verbose=False, harden_time=None,
+                     adaptive_poll=False, predictive_lock=False,
+                     calibrate="off")
+    events = _replay_runs(starts, DeviceConfig(overrides))
+    results.append((candidate, _score_events(events, candidate)))
+  return results
 
-    # Has user manually unlocked?
-    if self.state == _LOCKED and not self.screenlocker.is_locked():
-      if config.rearm_cooldown == 0:
-        sys.exit()
-      else:
-        self.state = _UNLOCKED
-        self.last_rearm = time.time()
+def _score_events(events, candidate):
+  """measure how well the lock and unlock events of a replay match the
+     tuning traces."""
+  lock_strength, unlock_strength = candidate[:2]
+  event_times = [timestamp for (_, timestamp) in events]
+  false_locks = 0
+  lock_latencies = []
+  unlock_latencies = []
+  for (position, (event, timestamp)) in enumerate(events):
+    index = bisect.bisect_right(_tune_times, timestamp) - 1
+    if event == "lock":
+      # From when the device stopped reading as here.
+      lock_latencies.append(timestamp - _run_start(
+          index, lambda strength: strength < unlock_strength))
+      following = events[position + 1:position + 2]
+      if (following and following[0][0] == "unlock" and
+          following[0][1] - timestamp < config.false_lock_window):
+        false_locks += 1
+    elif event == "unlock":
+      unlock_latencies.append(timestamp - _run_start(
+          index, lambda strength: strength >= lock_strength))
 
-    self.update(self.connection.get_signal_strength())
+  missed_locks = 0
+  for (start, end) in _tune_departures:
+    position = bisect.bisect_left(event_times, end) - 1
+    if position < 0 or events[position][0] != "lock":
+      missed_locks += 1
 
-  def update(self, strength):
-    """perform actions based on an observation of given strength."""
-    self.transition(_strength_to_state(strength))
-    self.min_strength = (strength if self.min_strength is None
-                          else min(self.min_strength, strength))
-    self.max_strength = (strength if self.max_strength is None
-                          else max(self.max_strength, strength))
-    if (config.harden_time is not None and self.state == _LOCKED and
-        time.time() - self.last_locked >= config.harden_time):
-      self.vlock.lock_screen()
-      self.state = _HARDENED
+  return {
+      "locks": len([event for event in events if event[0] == "lock"]),
+      "false_locks": false_locks,
+      "missed_locks": missed_locks,
+      "lock_latency": _median(lock_latencies),
+      "unlock_latency": _median(unlock_latencies),
+    }
 
-    if config.verbose:
-      print (("lock_state: %s\tbluetooth_state: %s\tchange_time: %.2f\t"
-              "last_locked: %i\tsignal_strength: %i\tmax_strength: %i\t"
-              "min_strength: %i" %
-              (self.state,
-              _strength_to_state(strength),
-              self.count,
-              self.last_locked,
-              strength,
-              self.max_strength,
-              self.min_strength)))
+def _tune_score(result):
+  """sort key for tuning results: fewest false and missed locks, then the
+     fastest locking and unlocking."""
+  candidate, results = result
+  return (results["false_locks"] + results["missed_locks"],
+          results["lock_latency"] is None, results["lock_latency"],
+          results["unlock_latency"] is None, results["unlock_latency"])
 
-  def transition(self, signal_state):
-    """performs state machine transition and necessary actions."""
-    if signal_state is _NEITHER:
-      # Signal not either way.
-      self.count = 0
-    elif self.state == _HARDENED:
-      # Don't do anything until unlocked manually
-      if not self.vlock.is_locked():
-        self.last_rearm = time.time()
-        self.screenlocker.unlock_screen()
-        self.state = _UNLOCKED
-    elif ((self.state == _UNLOCKED and signal_state == _HERE) or
-        (self.state == _LOCKED and signal_state == _GONE)):
-      # Stay in same state.
-      self.count = 0
+def _tune_candidates(strengths):
+  """the settings to try, given the signal strengths seen in the traces."""
+  low, high = min(strengths), max(strengths)
+  ranges = []
+  for option in _TUNED_OPTIONS:
+    text = getattr(config, "tune_" + option)
+    if text:
+      ranges.append(_parse_range(text))
+    elif option.endswith("strength"):
+      ranges.append(range(low, high + 2))
+    elif option == "lock_time":
+      ranges.append(range(1, 11))
     else:
-      # Consider changing lock state.
-      self.count += config.poll_interval
+      ranges.append(range(1, 4))
+  candidates = [candidate for candidate in itertools.product(*ranges)
+                if candidate[0] < candidate[1]]
+  if config.tune_samples and config.tune_samples < len(candidates):
+    candidates = random.sample(candidates, config.tune_samples)
+  return candidates
 
-      if self.state == _LOCKED and self.count >= config.unlock_time:
-        self.count = 0
-        self.screenlocker.unlock_screen()
-        self.state = _UNLOCKED
-      elif (self.state == _UNLOCKED and self.count >= config.lock_time):
-        if (self.last_locked + config.lock_cooldown <= time.time() and
-            self.last_rearm + config.rearm_cooldown <= time.time()):
-          self.screenlocker.lock_screen()
-          self.state = _LOCKED
-          self.count = 0
-          self.last_locked = time.time()
+def _tune_main():
+  """search for the best thresholds for the traces given with --tune, print
+     the best candidates and write out the best as a config."""
+  signal_filter = _make_filter(config)
+  records = []
+  now = None
+  for path in config.tune:
+    for (timestamp, strength, state) in read_trace(path):
+      now = timestamp if now is None else max(now, timestamp)
+      records.append((now, signal_filter.update(strength), state))
+  strengths = [int(record[1]) for record in records
+               if record[1] != _NOT_CONNECTED]
+  if not strengths:
+    sys.stderr.write("No connected readings in the traces.\n")
+    sys.exit(1)
+  candidates = _tune_candidates(strengths)
+  if not candidates:
+    sys.stderr.write("No candidates with lock_strength < unlock_strength.\n")
+    sys.exit(1)
 
-  def poll_loop(self, count=None):
-    """poll repeatedly the specified number of times, or forever if
-       count=None."""
-    while count is None or count > 0:
-      self.poll()
-      if count is not None:
-        count -= 1
+  # Classifying the readings depends only on the strengths, so candidates
+  # sharing them are evaluated together.
+  tasks = {}
+  for candidate in candidates:
+    tasks.setdefault(candidate[:2], []).append(candidate[2:])
+
+  import multiprocessing
+  start = _monotonic()
+  pool = multiprocessing.Pool(config.tune_processes or None, _tune_init,
+                              (records,))
+  try:
+    results = []
+    for task_results in pool.imap_unordered(_evaluate_strengths,
+                                            sorted(tasks.items())):
+      results.extend(task_results)
+  finally:
+    pool.terminate()
+  results.sort(key=_tune_score)
+
+  sys.stderr.write("Tried %i settings against %i readings in %.1f seconds.\n" %
+                   (len(candidates), len(records), _monotonic() - start))
+  sys.stderr.write("%s\tlocks\tfalse_locks\tmissed_locks\t"
+                   "lock_latency\tunlock_latency\n" %
+                   "\t".join(_TUNED_OPTIONS))
+  for (candidate, result) in results[:10]:
+    sys.stderr.write("%s\t%i\t%i\t%i\t%s\t%s\n" % (
+        "\t".join(str(value) for value in candidate), result["locks"],
+        result["false_locks"], result["missed_locks"],
+        result["lock_latency"], result["unlock_latency"]))
+
+  for (option, value) in zip(_TUNED_OPTIONS, results[0][0]):
+    setattr(config, option, value)
+  if config.write_config:
+    with open(config.write_config, "w") as fd:
+      _write_config(fd)
+  else:
+    _write_config(sys.stdout)
+
+def _write_config(fd):
+  """write the current configuration to fd in config file format."""
+  out = ConfigParser.SafeConfigParser()
+  out.add_section("Defaults")
+  for (key, value) in config._get_kwargs():
+    if (key not in ("write_config", "conf_file", "device_macs",
+                    "device_overrides", "adapter_names", "broker_user_names",
+                    "replay", "tune") and
+        not key.startswith("tune_") and value is not None):
+      out.set("Defaults", key, str(value))
+  for (mac, overrides) in sorted(config.device_overrides.items()):
+    section = "Device %s" % mac
+    out.add_section(section)
+    for (key, value) in sorted(overrides.items()):
+      out.set(section, key, str(value))
+  out.write(fd)
 
-def parse_arguments():
+def parse_arguments(argv=None):
   conf_parser = argparse.ArgumentParser(add_help=False)
   conf_parser.add_argument("-c", "--conf_file",
                            help="Specify config file", metavar="FILE")
-  args, remaining_argv = conf_parser.parse_known_args()
+  args, remaining_argv = conf_parser.parse_known_args(argv)
   defaults = DEFAULT_OPTIONS.copy()
+  device_overrides = {}
 
   if args.conf_file:
     config = ConfigParser.SafeConfigParser()
-    config.read([args.conf_file])
+    if not config.read([args.conf_file]):
+      sys.stderr.write("Can't read config file %s.\n" % args.conf_file)
+      sys.exit(1)
     for (key, value) in config.items("Defaults"):
       defaults[key] = {"True":True, "False":False, "None":None}.get(value, value)
+    for section in config.sections():
+      if section.startswith("Device "):
+        device_overrides[section[len("Device "):].strip()] = dict(
+            config.items(section))
 
   parser = argparse.ArgumentParser(
       parents=[conf_parser],
@@ -339,9 +3184,26 @@ def parse_arguments():
 
   parser.set_defaults(**defaults)
 
-  parser.add_argument("-m", "--device_mac", metavar="MAC",
+  parser.add_argument("-m", "--device_mac", metavar="MAC", nargs="+",
       help=("mac address of your phone or other bluetooth device "
-            "that you wish to use for locking. Must already be paired.")
+            "that you wish to use for locking. Must already be paired. "
+            "Several devices may be given to monitor them all from one "
+            "process; thresholds may be overridden per device in a "
+            "[Device MAC] section of the config file.")
+    )
+
+  parser.add_argument("--poll_workers", metavar="N", type=int,
+      help=("when monitoring several devices, poll at most N of them at "
+            "once.")
+    )
+
+  parser.add_argument("--event_loop", action="store_true",
+      help=("watch every device from one event loop that reacts to a "
+            "command finishing, the screen lock changing or a connection "
+            "dropping as it happens, rather than at the next poll. Signal "
+            "strength reads run on the loop too, so use it with the native "
+            "rssi_backend or --presence_source ble, whose reads don't "
+            "block.")
     )
 
   parser.add_argument("-S", "--lock_strength", metavar="STRENGTH", type=int,
@@ -375,9 +3237,129 @@ def parse_arguments():
       help="poll signal strength once per SECONDS."
     )
 
+  parser.add_argument("--adaptive_poll", action="store_true",
+      help=("vary the poll interval with the signal: back off towards "
+            "--max_poll_interval while the device stays clearly here or gone, "
+            "and poll every --min_poll_interval while the signal is between "
+            "the thresholds or the screen is about to be locked or unlocked.")
+    )
+
+  parser.add_argument("--min_poll_interval", metavar="SECONDS", type=float,
+      help="shortest poll interval in --adaptive_poll mode."
+    )
+
+  parser.add_argument("--max_poll_interval", metavar="SECONDS", type=float,
+      help="longest poll interval in --adaptive_poll mode."
+    )
+
+  parser.add_argument("--filter", metavar="FILTER",
+      help=("smooth signal strength before comparing it to the thresholds: "
+            "none, ewma (exponential moving average), median (of the last "
+            "--filter_window readings) or kalman. Smoothing lets you use a "
+            "shorter lock_time without noise causing false locks.")
+    )
+
+  parser.add_argument("--filter_window", metavar="N", type=int,
+      help="number of recent readings the filter keeps."
+    )
+
+  parser.add_argument("--ewma_alpha", metavar="ALPHA", type=float,
+      help="weight of the newest reading for --filter ewma, in (0, 1]."
+    )
+
+  parser.add_argument("--kalman_process_noise", metavar="VARIANCE",
+      type=float,
+      help="how fast the true signal drifts per reading, for --filter kalman."
+    )
+
+  parser.add_argument("--kalman_measurement_noise", metavar="VARIANCE",
+      type=float,
+      help="variance of the reading noise, for --filter kalman."
+    )
+
   parser.add_argument("-I", "--connect_interval", metavar="SECONDS", type=int,
-      help=("if device is not connected, attempt to connect "
-            "at most once per SECONDS.")
+      help=("if device is not connected, wait SECONDS before attempting to "
+            "connect again, doubling the wait after each failed attempt.")
+    )
+
+  parser.add_argument("--max_connect_interval", metavar="SECONDS", type=int,
+      help="wait at most SECONDS between attempts to connect."
+    )
+
+  parser.add_argument("--connect_timeout", metavar="SECONDS", type=int,
+      help="give up on an attempt to connect after SECONDS."
+    )
+
+  parser.add_argument("--rssi_backend", metavar="BACKEND",
+      help=("how to read signal strength: native (raw HCI socket, no forking), "
+            "hcitool (run hcitool rssi every poll) or auto (native if "
+            "available, else hcitool).")
+    )
+
+  parser.add_argument("--adapters", metavar="ADAPTER", nargs="+",
+      help=("local bluetooth adapters to use, such as hci0 hci1, rather "
+            "than the default one. With several, each device is connected "
+            "through all of them at once and read through each on every "
+            "poll, and an adapter that fails or stalls is left out until it "
+            "recovers.")
+    )
+
+  parser.add_argument("--adapter_fusion", metavar="FUSION",
+      help=("how to combine the signal strengths read through several "
+            "--adapters: max (the best signal) or mean.")
+    )
+
+  parser.add_argument("--adapter_timeout", metavar="SECONDS", type=float,
+      help=("leave an adapter out of a poll if reading the signal strength "
+            "through it takes longer than SECONDS.")
+    )
+
+  parser.add_argument("--presence_source", metavar="SOURCE",
+      help=("how to tell the device is near: rfcomm (hold a classic "
+            "connection and read its signal strength), ble (passively "
+            "scan for its Bluetooth LE advertisements, which needs it to "
+            "advertise from its own, not a random, address) or broker "
+            "(take readings from a lazyblue --serve_broker at "
+            "--broker_socket).")
+    )
+
+  parser.add_argument("--serve_broker", metavar="SOCKET",
+      help=("rather than locking anything, connect to devices on behalf of "
+            "other lazyblue instances run with --presence_source broker, "
+            "such as one per user, so that they share one connection and "
+            "one reading per poll_interval of each device. Clients connect "
+            "to the Unix socket SOCKET.")
+    )
+
+  parser.add_argument("--broker_users", metavar="USER", nargs="+",
+      help=("users, by name or uid, allowed to take readings from the "
+            "--serve_broker. Other users are turned away, as a broker lets "
+            "its clients connect to any device and see whether it is near. "
+            "Root and the broker's own user are always allowed.")
+    )
+
+  parser.add_argument("--broker_max_subscriptions", metavar="N", type=int,
+      help=("the most devices each client of the --serve_broker may "
+            "subscribe to.")
+    )
+
+  parser.add_argument("--broker_max_devices", metavar="N", type=int,
+      help=("the most devices the --serve_broker connects to at once, "
+            "over all its clients.")
+    )
+
+  parser.add_argument("--broker_socket", metavar="SOCKET",
+      help="the Unix socket of the broker, for --presence_source broker."
+    )
+
+  parser.add_argument("--broker_timeout", metavar="SECONDS", type=float,
+      help=("with --presence_source broker, count the device as gone if "
+            "the broker has sent no reading for SECONDS.")
+    )
+
+  parser.add_argument("--ble_timeout", metavar="SECONDS", type=float,
+      help=("with --presence_source ble, consider the device disconnected "
+            "if no advertisement was heard from it in SECONDS.")
     )
 
   parser.add_argument("-E", "--lock_command", metavar="CMD",
@@ -399,6 +3381,33 @@ def parse_arguments():
             " work. May not be combined with --vlock.")
     )
 
+  parser.add_argument("--command_timeout", metavar="SECONDS", type=int,
+      help=("kill lock, unlock, status and activity commands that run longer "
+            "than SECONDS. 0 to let them run forever.")
+    )
+
+  parser.add_argument("--status_ttl", metavar="SECONDS", type=int,
+      help=("reuse the answer of status_command for SECONDS before running "
+            "it again.")
+    )
+
+  parser.add_argument("--watch_command", metavar="CMD",
+      help=("long running command whose output reports lock state changes, "
+            "used instead of polling status_command (eg "
+            "\"xscreensaver-command -watch\"). If it exits, it is restarted "
+            "at most once every status_ttl seconds, with status_command "
+            "used in between.")
+    )
+
+  parser.add_argument("--watch_lock_pattern", metavar="REGEX",
+      help="watch_command output lines matching REGEX mean the screen locked."
+    )
+
+  parser.add_argument("--watch_unlock_pattern", metavar="REGEX",
+      help=("watch_command output lines matching REGEX mean the screen "
+            "unlocked.")
+    )
+
   parser.add_argument("--foreground_lock", action="store_true",
       help=("run the lock command and kill it to unlock rather than running "
             "a command to unlock (eg xtrlock). May not use with --vlock or "
@@ -427,26 +3436,222 @@ def parse_arguments():
       help="daemonize (detach from terminal and run in background)."
     )
 
+  parser.add_argument("--predictive_lock", action="store_true",
+      help=("also lock as soon as the signal strength has fallen steadily "
+            "over the last predict_window readings, at predict_slope or "
+            "faster, and is on course to drop below lock_strength within "
+            "predict_horizon seconds, rather than waiting lock_time.")
+    )
+
+  parser.add_argument("--predict_window", metavar="N", type=int,
+      help="fit the signal strength trend to the last N readings."
+    )
+
+  parser.add_argument("--predict_slope", metavar="STRENGTH_PER_SECOND",
+      type=float,
+      help=("how fast the signal strength must fall for --predictive_lock, "
+            "as a negative number.")
+    )
+
+  parser.add_argument("--predict_horizon", metavar="SECONDS", type=float,
+      help="how far ahead --predictive_lock projects the trend."
+    )
+
+  parser.add_argument("--calibrate", metavar="MODE",
+      help=("learn thresholds from the signal: off; suggest, to report "
+            "every calibrate_interval seconds the lock_strength and "
+            "unlock_strength that the readings seen while unlocked and "
+            "locked suggest; or apply, to also switch to them, within "
+            "--calibrate_range.")
+    )
+
+  parser.add_argument("--calibrate_range", metavar="LO:HI",
+      help=("keep calibrated thresholds between LO and HI. Needed for "
+            "--calibrate apply. Write negative ranges as "
+            "--calibrate_range=-20:0.")
+    )
+
+  parser.add_argument("--calibrate_quantile", metavar="FRACTION", type=float,
+      help=("the fraction of readings while unlocked that may fall under "
+            "the calibrated lock_strength, and of readings while locked that "
+            "may reach the calibrated unlock_strength.")
+    )
+
+  parser.add_argument("--calibrate_min_samples", metavar="N", type=int,
+      help="readings to take while unlocked before calibrating."
+    )
+
+  parser.add_argument("--calibrate_interval", metavar="SECONDS", type=float,
+      help="how often to calibrate."
+    )
+
+  parser.add_argument("--prewarm", action="store_true",
+      help=("keep a process forked and waiting to run the lock command (and "
+            "vlock, with --harden_time), so that locking takes one write to "
+            "a pipe rather than starting a process from scratch.")
+    )
+
+  parser.add_argument("--link_loss_grace", metavar="SECONDS", type=float,
+      help=("watch the adapter for the device's link going down, and when "
+            "it does, lock once the device has stayed gone SECONDS (0 to "
+            "lock at once) rather than lock_time.")
+    )
+
   parser.add_argument("-H", "--harden_time", metavar="SECONDS",
       help=("lock screen with vlock after screen has been locked "
             "for harden_time SECONDS.")
     )
 
+  parser.add_argument("--metrics_file", metavar="FILE",
+      help=("every metrics_interval seconds, write counters and latency "
+            "histograms of signal strength reads, reconnects, commands, "
+            "locks and unlocks to FILE in the Prometheus text format, eg "
+            "for node_exporter's textfile collector.")
+    )
+
+  parser.add_argument("--metrics_interval", metavar="SECONDS", type=float,
+      help="how often to write --metrics_file."
+    )
+
+  parser.add_argument("--profile", metavar="FILE",
+      help=("time each stage of polling (the signal strength read, "
+            "reconnects, checking the connection and the screen lock, the "
+            "state machine and starting commands) and write a table of the "
+            "totals to FILE every profile_interval seconds. Send SIGUSR1 to "
+            "start running polls under cProfile, and again to stop and "
+            "write the profile to FILE.pstats.")
+    )
+
+  parser.add_argument("--profile_interval", metavar="SECONDS", type=float,
+      help="how often to write --profile."
+    )
+
+  parser.add_argument("--record", metavar="FILE",
+      help=("append every signal strength reading and lock state to the "
+            "binary trace FILE (FILE.MAC when monitoring several devices), "
+            "for later --replay.")
+    )
+
+  parser.add_argument("--record_max_bytes", metavar="BYTES", type=int,
+      help="rotate the trace file when it reaches BYTES. 0 to never rotate."
+    )
+
+  parser.add_argument("--record_backups", metavar="N", type=int,
+      help="keep N rotated trace files."
+    )
+
+  parser.add_argument("--event_log", metavar="FILE",
+      help=("log readings and lock state changes to FILE as JSON, one event "
+            "per line. Unlike -v, this is buffered and works with --daemon.")
+    )
+
+  parser.add_argument("--event_log_mode", metavar="MODE",
+      help=("all to log every reading, or changes to log only readings "
+            "that change the lock or signal state, plus a summary of the "
+            "readings every event_log_summary_interval seconds.")
+    )
+
+  parser.add_argument("--event_log_summary_interval", metavar="SECONDS",
+      type=int,
+      help="in changes mode, how often to log a summary of the readings."
+    )
+
+  parser.add_argument("--event_log_max_bytes", metavar="BYTES", type=int,
+      help="rotate the event log when it reaches BYTES. 0 to never rotate."
+    )
+
+  parser.add_argument("--event_log_backups", metavar="N", type=int,
+      help="keep N rotated event logs."
+    )
+
+  parser.add_argument("--replay", metavar="FILE", nargs="+",
+      help=("feed the given trace files, oldest first, through the lock "
+            "logic with the current settings as fast as possible, print the "
+            "locks and unlocks that would have happened and exit.")
+    )
+
+  parser.add_argument("--tune", metavar="FILE", nargs="+",
+      help=("search for the lock/unlock strengths and times that work best "
+            "on the given trace files, print the best candidates and write "
+            "the best settings in config file format to --write_config FILE "
+            "or stdout. A candidate does badly if it locks and then unlocks "
+            "within --false_lock_window, or is not locked at the end of a "
+            "disconnection longer than that; among the rest the quickest to "
+            "lock and unlock wins.")
+    )
+
+  for option in _TUNED_OPTIONS:
+    parser.add_argument("--tune_" + option, metavar="LO:HI[:STEP]",
+        help=("values of %s for --tune to try. Write negative ranges as "
+              "--tune_%s=-20:-5.") % (option, option)
+      )
+
+  parser.add_argument("--tune_samples", metavar="N", type=int,
+      help=("try N random candidates rather than every combination of the "
+            "--tune ranges. 0 to try them all.")
+    )
+
+  parser.add_argument("--tune_processes", metavar="N", type=int,
+      help="evaluate candidates in N processes. 0 for one per CPU."
+    )
+
+  parser.add_argument("--false_lock_window", metavar="SECONDS", type=int,
+      help=("for --tune, count a lock followed by an unlock within SECONDS "
+            "as false.")
+    )
+
   parser.add_argument("--write_config", metavar="FILE",
       help="write current configuration to FILE and exit."
     )
 
   config = parser.parse_args(remaining_argv)
+  # Reloads must find the config file after daemonizing changes directory.
+  if config.conf_file:
+    config.conf_file = os.path.abspath(config.conf_file)
 
   # Validate arguments
   valid = True
-  if config.device_mac is None:
+  if isinstance(config.device_mac, list):
+    config.device_mac = " ".join(config.device_mac)
+  config.device_macs = (config.device_mac or "").replace(",", " ").split()
+  for mac in sorted(device_overrides):
+    if mac not in config.device_macs:
+      config.device_macs.append(mac)
+  config.device_overrides = device_overrides
+  if not config.device_macs and not (config.replay or config.tune or
+                                     config.serve_broker):
     sys.stderr.write("You must specify the MAC address of your device.\n")
     valid = False
 
+  if isinstance(config.adapters, list):
+    config.adapters = " ".join(config.adapters)
+  config.adapter_names = config.adapters.replace(",", " ").split()
+  for adapter in config.adapter_names:
+    if not re.match(r"hci[0-9]+$", adapter):
+      sys.stderr.write("adapters must be named like hci0, not %s.\n" %
+                       adapter)
+      valid = False
+  if config.adapter_names and config.presence_source != "rfcomm":
+    sys.stderr.write("--adapters only works with --presence_source rfcomm.\n")
+    valid = False
+
+  if config.adapter_fusion not in ("max", "mean"):
+    sys.stderr.write("adapter_fusion must be max or mean, not %s.\n" %
+                     config.adapter_fusion)
+    valid = False
+
   if config.dry_run:
     config.verbose = True
 
+  if config.daemon:
+    # Our stdout is /dev/null, so don't spend time formatting for it.
+    config.verbose = False
+
+  if config.event_log_mode not in ("all", "changes"):
+    sys.stderr.write("event_log_mode must be all or changes, not %s.\n" %
+                     config.event_log_mode)
+    valid = False
+
   if config.foreground_lock and (config.vlock or config.unlock_command):
     sys.stderr.write("--foreground_lock conflicts with vlock and unlock_command.\n")
     valid = False
@@ -459,11 +3664,68 @@ def parse_arguments():
     sys.stderr.write("May not use both --vlock and --status_command.\n")
     valid = False
 
+  for arg in ("watch_lock_pattern", "watch_unlock_pattern"):
+    try:
+      re.compile(getattr(config, arg))
+    except re.error, ex:
+      sys.stderr.write("%s is not a valid regular expression: %s.\n" %
+                       (arg, ex))
+      valid = False
+
   if config.harden_time is not None:
     config.harden_time = int(config.harden_time)
 
+  if config.link_loss_grace is not None:
+    try:
+      config.link_loss_grace = float(config.link_loss_grace)
+      if config.link_loss_grace < 0:
+        raise ValueError()
+    except ValueError:
+      sys.stderr.write("link_loss_grace must be a positive number, not %s.\n"
+                       % config.link_loss_grace)
+      valid = False
+    if config.presence_source != "rfcomm" or len(config.adapter_names) > 1:
+      # Over BLE there's no link, and through several adapters a link going
+      # down on one doesn't mean the device has left.
+      sys.stderr.write("--link_loss_grace needs --presence_source rfcomm and "
+                       "at most one adapter.\n")
+      valid = False
+
+  if config.presence_source not in ("rfcomm", "ble", "broker"):
+    sys.stderr.write("presence_source must be rfcomm, ble or broker, not "
+                     "%s.\n" % config.presence_source)
+    valid = False
+
+  if config.serve_broker and config.presence_source != "rfcomm":
+    sys.stderr.write("--serve_broker reads devices over rfcomm; it can't use "
+                     "--presence_source %s.\n" % config.presence_source)
+    valid = False
+
+  if isinstance(config.broker_users, list):
+    config.broker_users = " ".join(config.broker_users)
+  config.broker_user_names = config.broker_users.replace(",", " ").split()
+  for user in config.broker_user_names:
+    try:
+      _user_id(user)
+    except KeyError:
+      sys.stderr.write("broker_users: there is no user %s.\n" % user)
+      valid = False
+
+  if config.rssi_backend not in ("auto", "native", "hcitool"):
+    sys.stderr.write("rssi_backend must be auto, native or hcitool, not %s.\n" %
+                     config.rssi_backend)
+    valid = False
+
   for arg in ("lock_time", "unlock_time", "lock_cooldown",
-              "rearm_cooldown", "connect_interval"):
+              "rearm_cooldown", "connect_interval", "max_connect_interval",
+              "connect_timeout", "poll_workers",
+              "command_timeout", "status_ttl", "filter_window",
+              "record_max_bytes", "record_backups", "event_log_max_bytes",
+              "event_log_backups", "event_log_summary_interval",
+              "predict_window", "calibrate_min_samples",
+              "tune_samples", "broker_max_subscriptions",
+              "broker_max_devices",
+              "tune_processes", "false_lock_window"):
     value = getattr(config, arg)
     try:
       setattr(config, arg, int(value))
@@ -474,11 +3736,73 @@ def parse_arguments():
                        (arg, value))
       valid = False
 
-  try:
-    config.poll_interval = float(config.poll_interval)
-  except ValueError:
-    sys.stderr.write("poll_interval must be a number, not %s.\n" %
-                     config.poll_interval)
+  for arg in ("poll_interval", "min_poll_interval", "max_poll_interval",
+              "ewma_alpha", "kalman_process_noise",
+              "kalman_measurement_noise", "metrics_interval", "ble_timeout",
+              "adapter_timeout", "broker_timeout",
+              "predict_slope", "predict_horizon", "calibrate_quantile",
+              "calibrate_interval", "profile_interval"):
+    value = getattr(config, arg)
+    try:
+      setattr(config, arg, float(value))
+    except ValueError:
+      sys.stderr.write("%s must be a number, not %s.\n" % (arg, value))
+      valid = False
+
+  for option in _TUNED_OPTIONS:
+    value = getattr(config, "tune_" + option)
+    if value:
+      try:
+        _parse_range(value)
+      except ValueError:
+        sys.stderr.write("tune_%s must look like LO:HI or LO:HI:STEP, not "
+                         "%s.\n" % (option, value))
+        valid = False
+
+  if config.calibrate not in ("off", "suggest", "apply"):
+    sys.stderr.write("calibrate must be off, suggest or apply, not %s.\n" %
+                     config.calibrate)
+    valid = False
+
+  if config.calibrate_range:
+    try:
+      _parse_strength_range(config.calibrate_range)
+    except ValueError:
+      sys.stderr.write("calibrate_range must look like LO:HI with LO < HI, "
+                       "not %s.\n" % config.calibrate_range)
+      valid = False
+  elif config.calibrate == "apply":
+    sys.stderr.write("--calibrate apply needs --calibrate_range.\n")
+    valid = False
+
+  if not 0 < config.calibrate_quantile < 0.5:
+    sys.stderr.write("calibrate_quantile must be in (0, 0.5).\n")
+    valid = False
+
+  if config.filter not in _FILTERS:
+    sys.stderr.write("filter must be one of %s, not %s.\n" %
+                     (", ".join(sorted(_FILTERS)), config.filter))
+    valid = False
+
+  if config.predict_window < 3:
+    sys.stderr.write("predict_window must be at least 3.\n")
+    valid = False
+
+  if config.filter_window < 1:
+    sys.stderr.write("filter_window must be at least 1.\n")
+    valid = False
+
+  if not 0 < config.ewma_alpha <= 1:
+    sys.stderr.write("ewma_alpha must be in (0, 1].\n")
+    valid = False
+
+  if config.kalman_process_noise <= 0 or config.kalman_measurement_noise <= 0:
+    sys.stderr.write("Kalman filter noise variances must be positive.\n")
+    valid = False
+
+  if (config.adaptive_poll and
+      not 0 < config.min_poll_interval <= config.max_poll_interval):
+    sys.stderr.write("Need 0 < min_poll_interval <= max_poll_interval.\n")
     valid = False
 
   for arg in ("lock_strength", "unlock_strength"):
@@ -493,52 +3817,290 @@ def parse_arguments():
     sys.stderr.write("Lock strength must be < unlock strength.\n")
     valid = False
 
+  if config.poll_workers < 1:
+    sys.stderr.write("poll_workers must be at least 1.\n")
+    valid = False
+
+  for (mac, overrides) in sorted(device_overrides.items()):
+    for (key, value) in overrides.items():
+      if key not in _DEVICE_OPTIONS:
+        sys.stderr.write("%s may not be set for device %s.\n" % (key, mac))
+        valid = False
+        continue
+      try:
+        overrides[key] = int(value)
+      except ValueError:
+        sys.stderr.write("%s for device %s must be an integer, not %s.\n" %
+                         (key, mac, value))
+        valid = False
+    if (overrides.get("lock_strength", config.lock_strength) >=
+        overrides.get("unlock_strength", config.unlock_strength)):
+      sys.stderr.write("Lock strength must be < unlock strength for device "
+                       "%s.\n" % mac)
+      valid = False
+
   if not valid:
     sys.exit()
 
   return config
 
-if __name__ == "__main__":
+def _make_screenlocker():
+  """build the screen locker selected by the configuration."""
+  if config.dry_run:
+    return DryRunScreenLocker()
+  elif config.vlock:
+    return VlockScreenLocker()
+  elif config.foreground_lock:
+    return ForegroundScreenLocker()
+  else:
+    return ScreenLocker()
+
+def _connection_factory():
+  """a function building an RFCOMM connection to a device, through each of
+     the configured adapters. The connections share a signal strength
+     reader per adapter."""
+  if len(config.adapter_names) > 1:
+    readers = [_make_rssi_reader(adapter) for adapter in config.adapter_names]
+    return lambda mac: MultiConnection(
+        [Connection(mac, 1, reader, adapter)
+         for (reader, adapter) in zip(readers, config.adapter_names)],
+        config.adapter_fusion, config.adapter_timeout)
+  adapter = config.adapter_names[0] if config.adapter_names else None
+  rssi_reader = _make_rssi_reader(adapter)
+  return lambda mac: Connection(mac, 1, rssi_reader, adapter)
+
+def _make_connections(event_log=None):
+  """build a connection to each configured device. All devices share one
+     signal strength reader, LE scan or broker subscription."""
+  if config.presence_source == "ble":
+    scanner = BleScanner(config.device_macs)
+    scanner.start()
+    atexit.register(scanner.stop)
+    return [BleConnection(mac, scanner.table) for mac in config.device_macs]
+  if config.presence_source == "broker":
+    client = BrokerClient(config.broker_socket, config.device_macs,
+                          event_log=event_log)
+    client.start()
+    return [BrokerConnection(mac, client.table) for mac in config.device_macs]
+  make_connection = _connection_factory()
+  return [make_connection(mac) for mac in config.device_macs]
+
+def _make_monitors(event_log=None):
+  """build a monitor for each configured device, all logging to
+     event_log if given."""
+  monitors = []
+  for (mac, connection) in zip(config.device_macs,
+                               _make_connections(event_log)):
+    overrides = dict(config.device_overrides.get(mac, {}), device_mac=mac)
+    monitor = Monitor(connection, _make_screenlocker(),
+                      DeviceConfig(overrides))
+    monitor.event_log = event_log
+    monitors.append(monitor)
+  if config.link_loss_grace is not None:
+    watcher = LinkWatcher(config.device_macs,
+                          int(config.adapter_names[0][3:])
+                          if config.adapter_names else None)
+    watcher.start()
+    for monitor in monitors:
+      monitor.link_watcher = watcher
+  return monitors
+
+# Options that can't change without restarting, as they decide which devices
+# are watched and how, or were used to set things up at startup.
+_RESTART_OPTIONS = ("device_macs", "daemon", "dry_run", "vlock",
+                    "foreground_lock", "rssi_backend", "presence_source",
+                    "adapters", "link_loss_grace", "serve_broker",
+                    "broker_socket",
+                    "poll_workers", "event_loop", "prewarm", "profile",
+                    "record", "record_max_bytes", "record_backups",
+                    "event_log", "event_log_mode", "event_log_max_bytes",
+                    "event_log_backups", "event_log_summary_interval")
+# Options whose change restarts watch_command on reload.
+_WATCH_OPTIONS = ("watch_command", "watch_lock_pattern",
+                  "watch_unlock_pattern")
+_FILTER_OPTIONS = ("filter", "filter_window", "ewma_alpha",
+                   "kalman_process_noise", "kalman_measurement_noise")
+
+# Set by SIGHUP, acted on by the poll loop between polls.
+_reload_requested = False
+
+def _request_reload(signum, frame):
+  global _reload_requested
+  _reload_requested = True
+
+# Set by SIGUSR1 with --profile, acted on by the poll loop between polls.
+_cprofile_requested = False
+
+def _request_cprofile(signum, frame):
+  global _cprofile_requested
+  _cprofile_requested = True
+
+def _toggle_cprofile():
+  """start profiling polls, or stop and write the profile to the --profile
+     file with .pstats added."""
+  global _cprofile_requested
+  _cprofile_requested = False
+  profiler.toggle_cprofile(config.profile + ".pstats")
+
+def reload_config(monitors):
+  """re-read the config file and command line and, if they are valid, swap
+     the new settings in under the running monitors, keeping their
+     connections and state. Signal filters and trend estimators are rebuilt
+     only if their options changed. Returns whether the new settings were
+     taken."""
+  global config, _reload_requested
+  _reload_requested = False
+  argv = sys.argv[1:]
+  if config.conf_file:
+    # The last --conf_file given wins, and this one is absolute.
+    argv += ["--conf_file", config.conf_file]
+  try:
+    new_config = parse_arguments(argv)
+  except (SystemExit, ConfigParser.Error), ex:
+    sys.stderr.write("Not reloading, the new configuration is invalid%s.\n" %
+                     (": %s" % ex if isinstance(ex, ConfigParser.Error)
+                      else ""))
+    return False
+  changed = [option for option in _RESTART_OPTIONS
+             if getattr(new_config, option) != getattr(config, option)]
+  if changed:
+    sys.stderr.write("Not reloading, changing %s needs a restart.\n" %
+                     ", ".join(changed))
+    return False
+
+  filters = [[getattr(monitor.settings, option) for option in _FILTER_OPTIONS]
+             for monitor in monitors]
+  windows = [monitor.settings.predict_window for monitor in monitors]
+  watch_changed = [option for option in _WATCH_OPTIONS
+                   if getattr(new_config, option) != getattr(config, option)]
+  config = new_config
+  if watch_changed:
+    for monitor in monitors:
+      monitor.screenlocker.stop_watch()
+  for (monitor, old_filter, old_window) in zip(monitors, filters, windows):
+    mac = monitor.settings.device_mac
+    monitor.settings.overrides = dict(config.device_overrides.get(mac, {}),
+                                      device_mac=mac)
+    if old_filter != [getattr(monitor.settings, option)
+                      for option in _FILTER_OPTIONS]:
+      monitor.filter = _make_filter(monitor.settings)
+    if old_window != monitor.settings.predict_window:
+      monitor.trend = TrendEstimator(monitor.settings.predict_window)
+  return True
+
+def _notify_ready(ready_fd=None):
+  """tell whoever started us that monitoring has started: systemd through
+     $NOTIFY_SOCKET, and with --daemon the parent waiting on ready_fd."""
+  path = os.environ.get("NOTIFY_SOCKET")
+  if path:
+    if path.startswith("@"):
+      # Abstract socket namespace.
+      path = "\0" + path[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+      sock.sendto("READY=1\nMAINPID=%i" % os.getpid(), path)
+    except socket.error:
+      pass
+    finally:
+      sock.close()
+  if ready_fd is not None:
+    try:
+      os.write(ready_fd, "READY=1\n")
+    except OSError:
+      pass
+    os.close(ready_fd)
+
+def _daemonize():
+  """detach from the terminal into a daemon. The original process stays
+     until the daemon reports it is ready through the returned fd, so that
+     whatever started lazyblue knows monitoring has begun once it exits,
+     and exits nonzero if the daemon dies first."""
+  ready_read, ready_write = os.pipe()
+  if os.fork() != 0:
+    os.close(ready_write)
+    ready = os.read(ready_read, 64)
+    os._exit(0 if ready else 1)
+  os.close(ready_read)
+  os.setsid()
+  if os.fork() != 0:
+    os._exit(0)
+  os.chdir("/")
+  os.umask(0)
+  # Safe upper bound on number of fds we could possibly have opened.
+  for fd in range(64):
+    if fd == ready_write:
+      continue
+    try:
+      os.close(fd)
+    except OSError:
+      pass
+  os.open(os.devnull, os.O_RDWR)
+  os.dup2(0, 1)
+  os.dup2(0, 2)
+  return ready_write
+
+def main():
+  global config
   config = parse_arguments()
 
-  if config.write_config:
-    out = ConfigParser.SafeConfigParser()
-    out.add_section("Defaults")
-    for (key, value) in config._get_kwargs():
-      if key not in ("write_config", "conf_file") and value is not None:
-        out.set("Defaults", key, str(value))
+  if config.tune:
+    _tune_main()
+  elif config.write_config:
     with open(config.write_config, "w") as fd:
-      out.write(fd)
+      _write_config(fd)
+  elif config.replay:
+    _replay_main()
   else:
-    if config.dry_run:
-      locker = DryRunScreenLocker()
-    elif config.vlock:
-      locker = VlockScreenLocker()
-    elif config.foreground_lock:
-      locker = ForegroundScreenLocker()
-    else:
-      locker = ScreenLocker()
-    connection = Connection(config.device_mac, 1)
-    monitor = Monitor(connection, locker)
-
+    ready_fd = None
     if config.daemon:
-      if os.fork() == 0:
-        os.setsid()
-        if os.fork() == 0:
-          os.chdir("/")
-          os.umask(0)
-          # Safe upper bound on number of fds we could possibly have opened.
-          for fd in range(64):
-            try:
-              os.close(fd)
-            except OSError:
-              pass
-          os.open(os.devnull, os.O_RDWR)
-          os.dup2(0, 1)
-          os.dup2(0, 2)
+      ready_fd = _daemonize()
+
+    # Only open sockets once daemonized, or closing the inherited fds above
+    # would close them too.
+    _install_signal_wakeup()
+    # Exit cleanly on SIGTERM so that buffered trace records are written.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    signal.signal(signal.SIGHUP, _request_reload)
+    signal.siginterrupt(signal.SIGHUP, False)
+    if config.serve_broker:
+      run_broker(config.serve_broker, ready_fd)
+      return
+    event_log = None
+    if config.event_log:
+      event_log = EventLog(config.event_log, config.event_log_max_bytes,
+                           config.event_log_backups, config.event_log_mode,
+                           config.event_log_summary_interval)
+      atexit.register(event_log.close)
+    monitors = _make_monitors(event_log)
+    if config.record:
+      for monitor in monitors:
+        if len(monitors) == 1:
+          path = config.record
         else:
-          os._exit(0)
-      else:
-        os._exit(0)
+          path = "%s.%s" % (config.record,
+                            monitor.settings.device_mac.replace(":", ""))
+        monitor.recorder = TraceWriter(path, config.record_max_bytes,
+                                       config.record_backups)
+        atexit.register(monitor.recorder.close)
+    if config.prewarm:
+      for monitor in monitors:
+        monitor.screenlocker.prewarm()
+        if config.harden_time is not None:
+          monitor.vlock.prewarm()
+    if config.metrics_file:
+      atexit.register(metrics.write, config.metrics_file)
+    if config.profile:
+      profiler.enabled = True
+      atexit.register(profiler.write, config.profile)
+      signal.signal(signal.SIGUSR1, _request_cprofile)
+      signal.siginterrupt(signal.SIGUSR1, False)
+    _notify_ready(ready_fd)
+    if config.event_loop:
+      run_event_loop(monitors)
+    elif len(monitors) == 1:
+      monitors[0].poll_loop()
+    else:
+      MonitorPool(monitors, config.poll_workers).poll_loop()
 
-    monitor.poll_loop()
+if __name__ == "__main__":
+  main()
@@ -1,11 +1,26 @@
 import bluetooth
+import errno
+import json
 import mock
+import os
+import pstats
+import shutil
+import signal
+import socket
 import StringIO
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
 
 import lazyblue
 
+# So that tests can patch what lazyblue uses of it.
+lazyblue._import_bluetooth()
+
 class Config(dict):
   def __getattr__(self, key):
     return self.get(key, None)
@@ -24,106 +39,806 @@ class test_helpers(unittest.TestCase):
     self.assertEqual(lazyblue._GONE, lazyblue._strength_to_state(-11))
     self.assertEqual(lazyblue._GONE, lazyblue._strength_to_state(-255))
 
+    settings = lazyblue.DeviceConfig({"lock_strength": -20})
+    self.assertEqual(lazyblue._NEITHER, lazyblue._strength_to_state(-11, settings))
+    self.assertEqual(lazyblue._GONE, lazyblue._strength_to_state(-21, settings))
+
+  def test_device_config(self):
+    settings = lazyblue.DeviceConfig({"lock_time": 30})
+    self.assertEqual(settings.lock_time, 30)
+    lazyblue.config.unlock_time = 4
+    self.assertEqual(settings.unlock_time, 4)
+
+class test_SampleWindow(unittest.TestCase):
+  def test_window(self):
+    window = lazyblue.SampleWindow(3, "i")
+    self.assertEqual(window.values(), [])
+    window.append(1)
+    window.append(2)
+    self.assertEqual(window.values(), [1, 2])
+    for value in (3, 4, 5):
+      window.append(value)
+    self.assertEqual(window.values(), [3, 4, 5])
+    self.assertEqual(len(window), 3)
+    self.assertEqual(len(window.samples), 3)
+    window.clear()
+    self.assertEqual(window.values(), [])
+
+class test_SignalFilter(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+
+  def _run(self, name, readings):
+    lazyblue.config.filter = name
+    signal_filter = lazyblue._make_filter(lazyblue.config)
+    return [signal_filter.update(reading) for reading in readings]
+
+  def test_none(self):
+    self.assertEqual(self._run("none", [1, -5, 3]), [1, -5, 3])
+
+  def test_ewma(self):
+    lazyblue.config.ewma_alpha = 0.5
+    self.assertEqual(self._run("ewma", [0, -4, -4]), [0, -2, -3])
+
+  def test_median(self):
+    lazyblue.config.filter_window = 3
+    self.assertEqual(self._run("median", [0, -10, -1, -12, 0, 0]),
+                     [0, -5, -1, -10, -1, 0])
+
+  def test_kalman(self):
+    filtered = self._run("kalman", [0, -20, 0, 0, 0])
+    # an outlier moves the estimate only part of the way
+    self.assertLess(filtered[1], 0)
+    self.assertGreater(filtered[1], -20)
+    # and it converges back
+    self.assertGreater(filtered[4], filtered[2])
+
+  def test_disconnect_resets(self):
+    lazyblue.config.ewma_alpha = 0.5
+    self.assertEqual(self._run("ewma", [0, -255, -4]), [0, -255, -4])
+
+class test_Calibration(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+    lazyblue.config.calibrate_min_samples = 100
+
+  def test_sketch(self):
+    sketch = lazyblue.StrengthSketch()
+    self.assertIsNone(sketch.quantile(0.5))
+    for strength in range(-10, 0) + [-500, 500]:
+      sketch.add(strength)
+    self.assertEqual(len(sketch), 12)
+    self.assertEqual(sketch.quantile(0.01), -128)
+    self.assertEqual(sketch.quantile(0.5), -6)
+    self.assertEqual(sketch.quantile(1), 127)
+    self.assertEqual(len(sketch.counts), 256)
+
+  def test_suggest(self):
+    calibration = lazyblue.Calibration()
+    # at the desk: mostly -2..0, with an outlier and a departure
+    for index in range(100):
+      calibration.add(lazyblue._UNLOCKED, -(index % 3))
+    calibration.add(lazyblue._UNLOCKED, -40)
+    self.assertIsNone(lazyblue.Calibration().suggest(lazyblue.config))
+    self.assertEqual(calibration.suggest(lazyblue.config), (-2, -1))
+
+    # away: around -12, and disconnected readings which don't count
+    for index in range(100):
+      calibration.add(lazyblue._LOCKED, -12 + index % 3)
+      calibration.add(lazyblue._HARDENED, lazyblue._NOT_CONNECTED)
+    self.assertEqual(len(calibration.sketches[lazyblue._LOCKED]), 100)
+    self.assertEqual(calibration.suggest(lazyblue.config), (-2, -1))
+    lazyblue.config.calibrate_quantile = 0.4
+    self.assertEqual(calibration.suggest(lazyblue.config), (-1, 0))
+
+    # unlock above the away readings, but no higher than the median here
+    lazyblue.config.calibrate_quantile = 0.05
+    calibration = lazyblue.Calibration()
+    for index in range(100):
+      calibration.add(lazyblue._UNLOCKED, -10 + index % 10)
+      calibration.add(lazyblue._LOCKED, -9)
+    self.assertEqual(calibration.suggest(lazyblue.config), (-10, -8))
+    for index in range(100):
+      calibration.add(lazyblue._LOCKED, 0)
+    self.assertEqual(calibration.suggest(lazyblue.config), (-10, -6))
+
+    lazyblue.config.calibrate_range = "-8:-7"
+    self.assertEqual(calibration.suggest(lazyblue.config), (-8, -7))
+
+  def test_monitor_applies(self):
+    lazyblue.config.update(calibrate="apply", calibrate_range="-20:0",
+                           calibrate_interval=60, lock_strength=-30,
+                           unlock_strength=-25)
+    screenlocker = mock.Mock(lazyblue.ScreenLocker, autospec=True)
+    monitor = lazyblue.Monitor(None, screenlocker)
+    for now in range(60):
+      monitor.update(-3 - now % 2, now)
+    self.assertEqual(monitor.settings.lock_strength, -30)
+    for now in range(60, 121):
+      monitor.update(-3 - now % 2, now)
+    self.assertEqual(monitor.settings.lock_strength, -4)
+    self.assertEqual(monitor.settings.unlock_strength, -3)
+    self.assertEqual(lazyblue.config.lock_strength, -30)
+
+    # suggest leaves the thresholds be
+    monitor.settings.overrides.clear()
+    lazyblue.config.calibrate = "suggest"
+    for now in range(121, 200):
+      monitor.update(-3, now)
+    self.assertEqual(monitor.settings.lock_strength, -30)
+
+class test_BleScanner(unittest.TestCase):
+  # LE Advertising Report events as captured with hcidump -R.
+  ONE_REPORT = "043e0f0201000066554433221103020106c3".decode("hex")
+  TWO_REPORTS = ("043e1a0202000066554433221103020106c3"
+                 "0401aabbccddeeff00b0").decode("hex")
+  COMMAND_COMPLETE = "040e0401200c00".decode("hex")
+
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+
+  def test_parse(self):
+    parse = lazyblue._parse_le_advertising_reports
+    self.assertEqual(parse(self.ONE_REPORT), [("11:22:33:44:55:66", -61)])
+    self.assertEqual(parse(self.TWO_REPORTS), [("11:22:33:44:55:66", -61),
+                                               ("FF:EE:DD:CC:BB:AA", -80)])
+    self.assertEqual(parse(self.COMMAND_COMPLETE), [])
+    self.assertEqual(parse(self.ONE_REPORT[:-1]), [])
+    self.assertEqual(parse(self.TWO_REPORTS[:-1]),
+                     [("11:22:33:44:55:66", -61)])
+
+  @mock.patch("lazyblue._monotonic")
+  @mock.patch("lazyblue.bluez")
+  def test_presence(self, bluez, clock):
+    lazyblue.config.ble_timeout = 10
+    clock.return_value = 100
+    scanner = lazyblue.BleScanner(["11:22:33:44:55:66"])
+    connection = lazyblue.BleConnection("11:22:33:44:55:66", scanner.table)
+    self.assertEqual(connection.get_signal_strength(), lazyblue._NOT_CONNECTED)
+
+    # only the devices being watched are recorded
+    scanner.handle_packet(self.TWO_REPORTS)
+    self.assertEqual(connection.get_signal_strength(), -61)
+    self.assertEqual(scanner.table.readings.keys(), ["11:22:33:44:55:66"])
+
+    clock.return_value = 111
+    self.assertEqual(connection.get_signal_strength(), lazyblue._NOT_CONNECTED)
+
+  @mock.patch("sys.stderr")
+  @mock.patch("time.sleep")
+  @mock.patch("lazyblue.bluez")
+  def test_adapter_failure(self, bluez, sleep, stderr):
+    bluez.error = IOError
+    old_sock = bluez.hci_open_dev.return_value
+    new_sock = mock.Mock()
+    scanner = lazyblue.BleScanner(["11:22:33:44:55:66"])
+    bluez.hci_open_dev.side_effect = [IOError(errno.ENODEV, "gone"),
+                                      new_sock]
+    old_sock.recv.side_effect = IOError(errno.ENETDOWN, "down")
+    # StopIteration ends the scanning thread's loop for the test
+    new_sock.recv.side_effect = [self.ONE_REPORT, StopIteration()]
+    self.assertRaises(StopIteration, scanner._scan)
+    old_sock.close.assert_called()
+    self.assertEqual(sleep.call_count, 2)
+    self.assertEqual(stderr.write.call_count, 1)
+    # scanning is enabled again on the reopened adapter
+    self.assertIs(bluez.hci_send_cmd.call_args[0][0], new_sock)
+    self.assertEqual(scanner.table.readings.keys(), ["11:22:33:44:55:66"])
+
+class test_LinkWatcher(unittest.TestCase):
+  # Connection Complete and Disconnection Complete events for handle 12.
+  CONNECTED = "04030b000c0066554433221101" "00".decode("hex")
+  SCO_CONNECTED = "04030b000d0066554433221100" "00".decode("hex")
+  DISCONNECTED = "040504000c0013".decode("hex")
+  FAILED = "040504020c0013".decode("hex")
+
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+
+  def test_parse(self):
+    parse = lazyblue._parse_link_event
+    self.assertEqual(parse(self.CONNECTED), ("up", 12, "11:22:33:44:55:66"))
+    self.assertEqual(parse(self.DISCONNECTED), ("down", 12, None))
+    self.assertIsNone(parse(self.SCO_CONNECTED))
+    self.assertIsNone(parse(self.FAILED))
+    self.assertIsNone(parse(self.CONNECTED[:-1]))
+    self.assertIsNone(parse(test_BleScanner.ONE_REPORT))
+
+  @mock.patch("lazyblue._acl_handle")
+  @mock.patch("lazyblue.bluez")
+  def test_watch(self, bluez, acl_handle):
+    # one device's link is already up at startup, the other's isn't
+    def handle(sock, mac):
+      if mac != "AA:BB:CC:DD:EE:FF":
+        raise IOError()
+      return 40
+    acl_handle.side_effect = handle
+    watcher = lazyblue.LinkWatcher(["11:22:33:44:55:66", "aa:bb:cc:dd:ee:ff"])
+    self.assertEqual(watcher.handles, {40: "AA:BB:CC:DD:EE:FF"})
+    self.assertFalse(watcher.take_lost("11:22:33:44:55:66"))
+
+    # unknown links going down are ignored
+    watcher.handle_packet(self.DISCONNECTED)
+    watcher.handle_packet(self.CONNECTED)
+    watcher.handle_packet(self.DISCONNECTED)
+    watcher.handle_packet("\x04\x05\x04\x00\x28\x00\x13")
+    self.assertTrue(watcher.take_lost("11:22:33:44:55:66"))
+    self.assertFalse(watcher.take_lost("11:22:33:44:55:66"))
+    self.assertTrue(watcher.take_lost("AA:BB:CC:DD:EE:FF"))
+    self.assertEqual(watcher.handles, {})
+
+  @mock.patch("sys.stderr")
+  @mock.patch("time.sleep")
+  @mock.patch("lazyblue._acl_handle")
+  @mock.patch("lazyblue.bluez")
+  def test_adapter_failure(self, bluez, acl_handle, sleep, stderr):
+    bluez.error = IOError
+    acl_handle.return_value = 40
+    old_sock = bluez.hci_open_dev.return_value
+    new_sock = mock.Mock()
+    watcher = lazyblue.LinkWatcher(["AA:BB:CC:DD:EE:FF"])
+    bluez.hci_open_dev.side_effect = [IOError(errno.ENODEV, "gone"),
+                                      new_sock]
+    acl_handle.side_effect = IOError()
+    old_sock.recv.side_effect = IOError(errno.ENETDOWN, "down")
+    # StopIteration ends the watching thread's loop for the test
+    new_sock.recv.side_effect = [self.CONNECTED, StopIteration()]
+    self.assertRaises(StopIteration, watcher._watch)
+    old_sock.close.assert_called()
+    self.assertEqual(sleep.call_count, 2)
+    self.assertEqual(stderr.write.call_count, 1)
+    # the link may have gone down unseen, so it counts as lost
+    self.assertTrue(watcher.take_lost("AA:BB:CC:DD:EE:FF"))
+    self.assertEqual(watcher.handles, {})
+
 class test_Connection(unittest.TestCase):
   def setUp(self):
     lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
 
-  @mock.patch("lazyblue.Connection._connect")
-  def test_attempt_reconnect(self, method):
-    # creating an object should call connect
-    connection = lazyblue.Connection("mac", 1)
-    self.assertEqual(method.call_count, 1)
+  def _connection(self, reader=None):
+    sock = mock.Mock(bluetooth.BluetoothSocket, autospec=True)
+    sock.connect_ex.return_value = lazyblue.errno.EINPROGRESS
+    with mock.patch("bluetooth.BluetoothSocket", return_value=sock), \
+         mock.patch("lazyblue.bluez"), \
+         mock.patch("select.select", return_value=([], [], [])):
+      connection = lazyblue.Connection(
+          "mac", 1, reader or mock.Mock(lazyblue.HciRssiReader, autospec=True))
+    return connection, sock
 
-    # reconnect should close old socket
-    sock = connection.sock = mock.Mock(bluetooth.BluetoothSocket, autospec=True)
-    connection._attempt_reconnect()
-    self.assertEqual(sock.close.call_count, 1)
-    self.assertEqual(method.call_count, 2)
+  @mock.patch("select.select")
+  @mock.patch("lazyblue._monotonic")
+  def test_connect(self, clock, select):
+    clock.return_value = 100
+    connection, sock = self._connection()
+    sock.setblocking.assert_called_with(False)
+    sock.connect_ex.assert_called_with(("mac", 1))
+    self.assertEqual(connection.state, lazyblue._CONNECTING)
 
-    # do not attempt to reconnect if cooldown has not expired
-    connection.last_connected = time.time()
-    connection._attempt_reconnect()
-    self.assertEqual(method.call_count, 2)
+    # still connecting
+    select.return_value = ([], [], [])
+    connection._advance()
+    self.assertEqual(connection.state, lazyblue._CONNECTING)
+    self.assertEqual(connection.watch_fds(), [])
 
-    # should ignore bluetooth errors
-    connection.last_connected = 0
-    method.side_effect = bluetooth.btcommon.BluetoothError()
-    connection._attempt_reconnect()
+    # connected
+    select.return_value = ([], [sock], [])
+    sock.getsockopt.return_value = 0
+    sock.fileno.return_value = 7
+    connection._advance()
+    self.assertEqual(connection.state, lazyblue._CONNECTED)
+    self.assertEqual(connection.watch_fds(), [7])
 
-  @mock.patch("os.popen")
-  @mock.patch("lazyblue.Connection._connect")
-  def test_get_signal_strength_reconnect(self, connect_method, popen):
-    connection = lazyblue.Connection("mac", 1)
-    sock = connection.sock = mock.Mock(bluetooth.BluetoothSocket, autospec=True)
-    popen.side_effect = lambda command, mode: StringIO.StringIO("RSSI return value: -17")
-
-    # if recv returns don't reconnect.
-    sock.recv.return_value = "1"
-    self.assertEqual(connection.get_signal_strength(), -17)
-    self.assertEqual(connect_method.call_count, 1)
-
-    # if recv returns timeout don't reconnect
-    sock.recv.side_effect = bluetooth.btcommon.BluetoothError("timed out")
-    self.assertEqual(connection.get_signal_strength(), -17)
-    self.assertEqual(connect_method.call_count, 1)
-
-    # if recv receives a different error reconnect
+    # closed by a worker thread while still counted as connected
+    sock.fileno.side_effect = bluetooth.btcommon.BluetoothError()
+    self.assertEqual(connection.watch_fds(), [])
+    sock.fileno.side_effect = None
+    sock.fileno.return_value = -1
+    self.assertEqual(connection.watch_fds(), [])
+    sock.fileno.return_value = 7
+    connection.sock = None
+    self.assertEqual(connection.watch_fds(), [])
+    connection.sock = sock
+
+    # nothing to read while the connection is up
+    select.return_value = ([], [], [])
+    connection._advance()
+    self.assertEqual(connection.state, lazyblue._CONNECTED)
+
+    # dropped; back off for connect_interval
+    lazyblue.config.connect_interval = 4
+    select.return_value = ([sock], [], [])
     sock.recv.side_effect = bluetooth.btcommon.BluetoothError()
-    self.assertEqual(connection.get_signal_strength(), -17)
-    self.assertEqual(connect_method.call_count, 2)
+    connection._advance()
+    self.assertEqual(connection.state, lazyblue._BACKING_OFF)
+    self.assertEqual(sock.close.call_count, 1)
+    self.assertTrue(102 <= connection.next_attempt <= 104)
 
-    self.assertEqual(popen.call_count, 3)
+  @mock.patch("select.select")
+  @mock.patch("lazyblue._monotonic")
+  def test_backoff(self, clock, select):
+    lazyblue.config.connect_interval = 1
+    lazyblue.config.max_connect_interval = 6
+    lazyblue.config.connect_timeout = 10
+    select.return_value = ([], [], [])
+    clock.return_value = 0
+    connection, sock = self._connection()
 
-  @mock.patch("os.popen")
-  @mock.patch("lazyblue.Connection._connect")
-  def test_get_signal_strength(self, connect_method, popen):
-    connection = lazyblue.Connection("mac", 1)
-    connection.sock = mock.Mock(bluetooth.BluetoothSocket, autospec=True)
-    connection.sock.recv.side_effect = bluetooth.btcommon.BluetoothError("timed out")
+    # connect attempts time out, doubling the wait each time up to the cap
+    waits = []
+    for _ in range(5):
+      clock.return_value += 11
+      connection._advance()
+      self.assertEqual(connection.state, lazyblue._BACKING_OFF)
+      waits.append(connection.next_attempt - clock.return_value)
+      clock.return_value = connection.next_attempt
+      with mock.patch("bluetooth.BluetoothSocket", return_value=sock):
+        connection._advance()
+      self.assertEqual(connection.state, lazyblue._CONNECTING)
+    for (wait, cap) in zip(waits, [1, 2, 4, 6, 6]):
+      self.assertTrue(cap / 2.0 <= wait <= cap, waits)
+
+    # refused at once
+    with mock.patch("bluetooth.BluetoothSocket", return_value=sock):
+      sock.connect_ex.return_value = lazyblue.errno.ECONNREFUSED
+      clock.return_value = connection.next_attempt = 200
+      connection.state = lazyblue._BACKING_OFF
+      connection._advance()
+    self.assertEqual(connection.state, lazyblue._BACKING_OFF)
 
+    # a reading from the device resets the backoff
+    connection.rssi_reader.read.return_value = -3
+    self.assertEqual(connection.get_signal_strength(), -3)
+    self.assertEqual(connection.failures, 0)
+
+  @mock.patch("select.select")
+  @mock.patch("os.popen")
+  def test_get_signal_strength(self, popen, select):
+    select.return_value = ([], [], [])
+    connection, sock = self._connection(lazyblue.HcitoolRssiReader())
     popen.side_effect = lambda command, mode: StringIO.StringIO("RSSI return value: -15")
     self.assertEqual(connection.get_signal_strength(), -15)
 
     popen.side_effect = lambda command, mode: StringIO.StringIO("Not connected.")
     self.assertEqual(connection.get_signal_strength(), -255)
-    self.assertEqual(connect_method.call_count, 1)
+
+  def test_reconnect_forgets_handle(self):
+    connection, sock = self._connection()
+    connection.rssi_reader.forget.assert_called_with("mac")
+
+  @mock.patch("os.popen")
+  @mock.patch("lazyblue._adapter_address")
+  def test_adapter(self, adapter_address, popen):
+    adapter_address.return_value = "00:1A:7D:DA:71:13"
+    sock = mock.Mock(bluetooth.BluetoothSocket, autospec=True)
+    sock.connect_ex.return_value = lazyblue.errno.EINPROGRESS
+    reader = lazyblue.HcitoolRssiReader("hci1")
+    with mock.patch("bluetooth.BluetoothSocket", return_value=sock), \
+         mock.patch("lazyblue.bluez"), \
+         mock.patch("select.select", return_value=([], [], [])):
+      connection = lazyblue.Connection("mac", 1, reader, "hci1")
+      adapter_address.assert_called_with("hci1")
+      sock.bind.assert_called_with(("00:1A:7D:DA:71:13", 0))
+      self.assertEqual(connection.state, lazyblue._CONNECTING)
+
+      # unplugged
+      adapter_address.side_effect = IOError("No such file or directory")
+      connection = lazyblue.Connection("mac", 1, reader, "hci1")
+      self.assertEqual(connection.state, lazyblue._BACKING_OFF)
+
+    popen.return_value = StringIO.StringIO("RSSI return value: -4")
+    self.assertEqual(reader.read("mac"), -4)
+    self.assertEqual(popen.call_args[0][0],
+                     "hcitool -i hci1 rssi mac 2>/dev/null")
+
+class FakeAdapterConnection(object):
+  """a connection through one adapter, reading whatever read returns."""
+  adapter = "hci9"
+
+  def __init__(self, read):
+    self.read = read
+    self.reads = 0
+
+  def get_signal_strength(self):
+    self.reads += 1
+    return self.read()
+
+  def watch_fds(self):
+    return [self.reads]
+
+class test_MultiConnection(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+
+  def test_fusion(self):
+    strengths = [-3, -8]
+    connections = [FakeAdapterConnection(lambda: strengths[0]),
+                   FakeAdapterConnection(lambda: strengths[1])]
+    connection = lazyblue.MultiConnection(connections)
+    self.assertEqual(connection.get_signal_strength(), -3)
+    connection.fusion = "mean"
+    self.assertEqual(connection.get_signal_strength(), -6)
+    self.assertEqual(connection.watch_fds(), [2, 2])
+
+    # an adapter that has lost the device drops out
+    strengths[0] = lazyblue._NOT_CONNECTED
+    self.assertEqual(connection.get_signal_strength(), -8)
+    strengths[1] = lazyblue._NOT_CONNECTED
+    self.assertEqual(connection.get_signal_strength(), lazyblue._NOT_CONNECTED)
+
+  def test_stalled_adapter(self):
+    unstall = threading.Event()
+
+    def stalled():
+      self.assertTrue(unstall.wait(5))
+      return 0
+
+    slow = FakeAdapterConnection(stalled)
+    fast = FakeAdapterConnection(lambda: -5)
+    connection = lazyblue.MultiConnection([slow, fast], timeout=0.05)
+    start = time.time()
+    self.assertEqual(connection.get_signal_strength(), -5)
+    self.assertEqual(connection.get_signal_strength(), -5)
+    self.assertLess(time.time() - start, 1)
+    # the stalled read isn't queued behind
+    self.assertEqual((slow.reads, fast.reads), (1, 2))
+
+    # once it returns, its late reading is dropped, and it rejoins
+    unstall.set()
+    deadline = time.time() + 5
+    strength = -5
+    while strength == -5 and time.time() < deadline:
+      strength = connection.get_signal_strength()
+    self.assertEqual(strength, 0)
+    self.assertEqual(slow.reads, 2)
+
+  def test_all_stalled(self):
+    unstall = threading.Event()
+
+    def stalled():
+      self.assertTrue(unstall.wait(5))
+      return -2
+
+    connections = [FakeAdapterConnection(stalled),
+                   FakeAdapterConnection(stalled)]
+    connection = lazyblue.MultiConnection(connections, timeout=0.05)
+    self.assertEqual(connection.get_signal_strength(), lazyblue._NOT_CONNECTED)
+    self.assertEqual(connection.get_signal_strength(), lazyblue._NOT_CONNECTED)
+
+    # with every read still pending, none is waited for, but the adapters
+    # are read again once they recover
+    unstall.set()
+    deadline = time.time() + 5
+    strength = lazyblue._NOT_CONNECTED
+    while strength == lazyblue._NOT_CONNECTED and time.time() < deadline:
+      strength = connection.get_signal_strength()
+    self.assertEqual(strength, -2)
+
+  @mock.patch("sys.stderr")
+  def test_error_fails_over(self, stderr):
+    def broken():
+      raise ValueError("radio on fire")
+    connection = lazyblue.MultiConnection(
+        [FakeAdapterConnection(broken), FakeAdapterConnection(lambda: -1)])
+    self.assertEqual(connection.get_signal_strength(), -1)
+    self.assertIn("radio on fire", stderr.write.call_args[0][0])
+
+class test_HciRssiReader(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+
+  @mock.patch("lazyblue._acl_handle")
+  @mock.patch("lazyblue.bluez")
+  def test_read(self, bluez, acl_handle):
+    bluez.error = lazyblue.bluez.error
+    acl_handle.return_value = 12
+    bluez.hci_send_req.return_value = struct.pack("<BHb", 0, 12, -7)
+    reader = lazyblue.HciRssiReader(0)
+    self.assertEqual(reader.read("mac"), -7)
+    self.assertEqual(reader.read("mac"), -7)
+    # handle is looked up once and then cached
+    self.assertEqual(acl_handle.call_count, 1)
+    self.assertEqual(bluez.hci_send_req.call_args[0][5], struct.pack("<H", 12))
+
+    # a failed read forgets the handle so the next read looks it up again
+    bluez.hci_send_req.return_value = struct.pack("<BHb", 2, 12, 0)
+    self.assertIsNone(reader.read("mac"))
+    self.assertEqual(reader.handles, {})
+    bluez.hci_send_req.return_value = struct.pack("<BHb", 0, 12, 3)
+    self.assertEqual(reader.read("mac"), 3)
+    self.assertEqual(acl_handle.call_count, 2)
+
+    # not connected
+    reader.forget("mac")
+    acl_handle.side_effect = IOError()
+    self.assertIsNone(reader.read("mac"))
+
+  @mock.patch("lazyblue._monotonic")
+  @mock.patch("lazyblue._acl_handle")
+  @mock.patch("lazyblue.bluez")
+  def test_adapter_gone(self, bluez, acl_handle, clock):
+    bluez.error = IOError
+    clock.return_value = 100
+    acl_handle.return_value = 12
+    bluez.hci_send_req.return_value = struct.pack("<BHb", 0, 12, -7)
+    reader = lazyblue.HciRssiReader(1)
+    old_sock = reader.sock
+
+    # the adapter is reset: the socket is dropped and reopened next read
+    bluez.hci_send_req.side_effect = [IOError(errno.ENODEV, "gone")]
+    self.assertIsNone(reader.read("mac"))
+    old_sock.close.assert_called()
+    self.assertIsNone(reader.sock)
+    bluez.hci_send_req.side_effect = None
+    self.assertEqual(reader.read("mac"), -7)
+    bluez.hci_open_dev.assert_called_with(1)
+    self.assertEqual(bluez.hci_open_dev.call_count, 2)
+
+    # while it stays gone, reopening backs off
+    bluez.hci_send_req.side_effect = [IOError(errno.ENODEV, "gone")]
+    bluez.hci_open_dev.side_effect = IOError(errno.ENODEV, "gone")
+    self.assertIsNone(reader.read("mac"))
+    self.assertIsNone(reader.read("mac"))
+    self.assertIsNone(reader.read("mac"))
+    self.assertEqual(bluez.hci_open_dev.call_count, 3)
+    bluez.hci_open_dev.side_effect = None
+    clock.return_value = 102
+    bluez.hci_send_req.side_effect = None
+    self.assertEqual(reader.read("mac"), -7)
+
+  @mock.patch("lazyblue.HciRssiReader.__init__")
+  def test_make_rssi_reader(self, init):
+    init.return_value = None
+    self.assertIsInstance(lazyblue._make_rssi_reader(), lazyblue.HciRssiReader)
+
+    init.side_effect = IOError()
+    self.assertIs(type(lazyblue._make_rssi_reader()), lazyblue.HcitoolRssiReader)
+
+    lazyblue.config.rssi_backend = "native"
+    self.assertRaises(IOError, lazyblue._make_rssi_reader)
+
+    lazyblue.config.rssi_backend = "hcitool"
+    self.assertIs(type(lazyblue._make_rssi_reader()), lazyblue.HcitoolRssiReader)
+    self.assertEqual(lazyblue._make_rssi_reader("hci2").adapter, "hci2")
+
+    # native readers open the adapter by number
+    lazyblue.config.rssi_backend = "native"
+    init.side_effect = None
+    lazyblue._make_rssi_reader("hci2")
+    init.assert_called_with(2)
+
+class test_command_argv(unittest.TestCase):
+  def test_command_argv(self):
+    self.assertEqual(lazyblue._command_argv("xscreensaver-command -lock"),
+                     ["xscreensaver-command", "-lock"])
+    self.assertEqual(lazyblue._command_argv("notify-send 'locked now'"),
+                     ["notify-send", "locked now"])
+    for command in ("xtrlock && echo done", "kill $(pidof xtrlock)",
+                    "DISPLAY=:0 xtrlock", "notify-send 'locked", ""):
+      self.assertEqual(lazyblue._command_argv(command),
+                       ["/bin/sh", "-c", command])
+
+class test_CommandRunner(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+    self.runner = lazyblue.CommandRunner()
+
+  def _reap_all(self):
+    finished = []
+    deadline = time.time() + 5
+    while self.runner.running and time.time() < deadline:
+      finished.extend(self.runner.reap())
+      time.sleep(0.01)
+    return finished + self.runner.reap()
+
+  def test_exit_status(self):
+    ok = self.runner.run("lock", "true")
+    bad = self.runner.run("unlock", "exit 3")
+    missing = self.runner.run("status", "/nonexistent/command")
+    finished = self._reap_all()
+    self.assertEqual(sorted(command.name for command in finished),
+                     ["lock", "status", "unlock"])
+    self.assertEqual(ok.returncode, 0)
+    self.assertFalse(ok.failed())
+    self.assertEqual(bad.returncode, 3)
+    self.assertTrue(bad.failed())
+    self.assertEqual(missing.returncode, 127)
+    self.assertEqual(self.runner.reap(), [])
+
+  def test_metrics(self):
+    lazyblue.metrics = lazyblue.Metrics()
+    self.runner.run("unlock", "exit 3")
+    # a lock shell killed to unlock is no failure, and how long the screen
+    # stayed locked is no command run time
+    lock_shell = self.runner.run("foreground lock", "sleep 10").process
+    lock_shell.terminate()
+    self._reap_all()
+    self.assertEqual(lazyblue.metrics.counters,
+                     {("lazyblue_command_failures_total",
+                       (("command", "unlock"),)): 1})
+    self.assertEqual(list(lazyblue.metrics.histograms),
+                     [("lazyblue_command_seconds", (("command", "unlock"),))])
+
+  def test_timeout(self):
+    command = self.runner.run("status", "sleep 10", 0.05)
+    self.assertIsNotNone(self.runner.next_deadline())
+    self.assertEqual(self.runner.reap(), [])
+    time.sleep(0.1)
+    finished = self._reap_all()
+    self.assertEqual(finished, [command])
+    self.assertTrue(command.timed_out)
+    self.assertTrue(command.failed())
+    self.assertIsNone(self.runner.next_deadline())
+
+  def test_prewarm(self):
+    path = tempfile.mktemp()
+    self.addCleanup(lambda: os.path.exists(path) and os.unlink(path))
+    command = "echo locked > %s" % path
+    self.runner.prewarm("lock", command)
+    standby = self.runner.standby["lock"][1]
+    time.sleep(0.05)
+    self.assertFalse(os.path.exists(path))
+    self.assertIsNone(standby.poll())
+
+    result = self.runner.run("lock", command, 5)
+    self.assertIs(result.process, standby)
+    self.assertEqual(self._reap_all(), [result])
+    self.assertEqual(result.returncode, 0)
+    with open(path) as fd:
+      self.assertEqual(fd.read(), "locked\n")
+    # Another is forked ready for the next lock.
+    self.assertIsNot(self.runner.standby["lock"][1], standby)
+    self.runner.standby["lock"][1].kill()
+
+  def test_prewarm_stale(self):
+    self.runner.prewarm("lock", "exit 3")
+    stale = self.runner.standby["lock"][1]
+    result = self.runner.run("lock", "exit 4", 5)
+    self.assertIsNot(result.process, stale)
+    self.assertIsNotNone(stale.poll())
+    self.assertEqual(self._reap_all(), [result])
+    self.assertEqual(result.returncode, 4)
+    self.assertEqual(self.runner.standby["lock"][0], "exit 4")
+    self.runner.standby["lock"][1].kill()
 
 class test_ScreenLocker(unittest.TestCase):
   def setUp(self):
     lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
-    self.screenlocker = lazyblue.ScreenLocker()
+    self.runner = mock.Mock(lazyblue.CommandRunner, autospec=True)
+    self.screenlocker = lazyblue.ScreenLocker(self.runner)
 
-  @mock.patch("os.system")
-  def test_unlock_screen(self, system):
+  def test_lock_screen(self):
     lazyblue.config.lock_command = "xscreensaver-command -l"
     self.screenlocker.lock_screen()
-    system.assert_called_with(lazyblue.config.lock_command)
+    self.runner.run.assert_called_with("lock", lazyblue.config.lock_command, 10)
 
-  @mock.patch("os.system")
-  def test_lock_screen(self, system):
+  def test_unlock_screen(self):
     lazyblue.config.unlock_command = "xscreensaver-command -d"
     self.screenlocker.unlock_screen()
-    system.assert_called_with(lazyblue.config.unlock_command)
+    self.runner.run.assert_called_with("unlock", lazyblue.config.unlock_command,
+                                       10)
 
-  @mock.patch("os.system")
-  def test_simulate_activity(self, system):
+  def test_simulate_activity(self):
     lazyblue.config.activity_command = "xscreensaver-command -p"
     self.screenlocker.simulate_activity()
-    system.assert_called_with(lazyblue.config.activity_command)
+    self.runner.run.assert_called_with("activity",
+                                       lazyblue.config.activity_command, 10)
 
-  @mock.patch("os.system")
-  def test_is_locked(self, system):
+  def _finish(self, command, returncode):
+    command.returncode = returncode
+    command.timed_out = False
+    self.runner.reap.return_value = [command]
+    self.assertEqual(self.screenlocker.reap(), [command])
+
+  def test_is_locked(self):
     lazyblue.config.status_command = "xscreensaver-command -time"
-    system.return_value = True
-    result = self.screenlocker.is_locked()
-    system.assert_called_with(lazyblue.config.status_command)
-    self.assertEqual(result, True)
+    lazyblue.config.status_ttl = 0
+    status = self.runner.run.return_value = mock.Mock(lazyblue.Command)
+
+    # unsure until the status command answers
+    self.assertEqual(self.screenlocker.is_locked(), True)
+    self.runner.run.assert_called_with("status", lazyblue.config.status_command,
+                                       10)
+    # only one status command at a time
+    self.assertEqual(self.screenlocker.is_locked(), True)
+    self.assertEqual(self.runner.run.call_count, 1)
+
+    self._finish(status, 0)
+    self.assertEqual(self.screenlocker.is_locked(), False)
+    self.assertEqual(self.runner.run.call_count, 2)
+
+    # a new lock forgets the old answer and waits for the lock command
+    lock = self.runner.run.return_value = mock.Mock(lazyblue.Command)
+    self.screenlocker.lock_screen()
+    self.runner.run.reset_mock()
+    self.assertEqual(self.screenlocker.is_locked(), True)
+    self.runner.run.assert_not_called()
+    self._finish(lock, 0)
+    self.assertEqual(self.screenlocker.is_locked(), True)
+    self.assertEqual(self.runner.run.call_count, 1)
 
-    system.reset_mock()
+    self.runner.run.reset_mock()
     lazyblue.config.status_command = ""
-    result = self.screenlocker.is_locked()
-    system.assert_not_called()
-    self.assertEqual(result, True)
+    self.assertEqual(self.screenlocker.is_locked(), True)
+    self.runner.run.assert_not_called()
+
+  @mock.patch("lazyblue._monotonic")
+  def test_status_ttl(self, clock):
+    lazyblue.config.status_command = "xscreensaver-command -time"
+    lazyblue.config.status_ttl = 5
+    status = self.runner.run.return_value = mock.Mock(lazyblue.Command)
+    clock.return_value = 100
+    self.screenlocker.is_locked()
+    self._finish(status, 1)
+
+    clock.return_value = 104
+    self.assertEqual(self.screenlocker.is_locked(), True)
+    self.assertEqual(self.runner.run.call_count, 1)
+    clock.return_value = 105
+    self.screenlocker.is_locked()
+    self.assertEqual(self.runner.run.call_count, 2)
+
+  def test_watch_command(self):
+    lazyblue.config.watch_command = ("sleep 0.2; "
+                                     "printf 'BLANK 1\\nLOCK 2\\nUNBLANK 3\\nLO'"
+                                     "; sleep 10")
+    self.screenlocker = lazyblue.ScreenLocker()
+    self.assertEqual(self.screenlocker.is_locked(), True)
+    fds = self.screenlocker.watch_fds()
+    self.assertEqual(len(fds), 1)
+    self.assertEqual(lazyblue._wait(5, fds), fds)
+    self.assertEqual(self.screenlocker.is_locked(), False)
+    self.assertEqual(self.screenlocker.watch_buffer, "LO")
+    self.screenlocker.watch.process.kill()
+
+  @mock.patch("sys.stderr")
+  @mock.patch("lazyblue._monotonic")
+  def test_watch_restart_backoff(self, clock, stderr):
+    lazyblue.config.watch_command = "false"
+    lazyblue.config.status_ttl = 5
+    watch = self.runner.run.return_value = mock.Mock(lazyblue.Command)
+    watch.process = None
+    watch.duration = 0.01
+    for start in (100, 105, 110):
+      clock.return_value = start
+      self.assertEqual(self.screenlocker.is_locked(), True)
+      self._finish(watch, 1)
+      # not restarted until status_ttl has passed, assumed locked meanwhile
+      clock.return_value = start + 4
+      self.assertEqual(self.screenlocker.is_locked(), True)
+    self.assertEqual(self.runner.run.call_count, 3)
+    self.assertIn("watch_command keeps exiting", stderr.write.call_args[0][0])
+
+  def test_stop_watch(self):
+    lazyblue.config.watch_command = "printf 'UNBLANK 1\\n'; sleep 10"
+    self.screenlocker = lazyblue.ScreenLocker()
+    self.screenlocker.is_locked()
+    process = self.screenlocker.watch.process
+    self.screenlocker.stop_watch()
+    self.assertEqual(process.wait(), -9)
+    self.assertEqual(self.screenlocker.watch_fds(), [])
+    self.assertEqual(self.screenlocker.locked, True)
+    # started again by the next is_locked
+    lazyblue.config.watch_command = "sleep 10"
+    self.screenlocker.is_locked()
+    self.assertIsNot(self.screenlocker.watch.process, process)
+    self.screenlocker.watch.process.kill()
+
+  def test_watch_read_when_unlocked(self):
+    # output is read on every reap, not only while locked, and the fd is
+    # no longer waited on once the output ends
+    lazyblue.config.watch_command = ("printf 'UNBLANK 1\\n'; "
+                                     "exec >/dev/null; sleep 10")
+    self.screenlocker = lazyblue.ScreenLocker()
+    self.screenlocker.is_locked()
+    watch = self.screenlocker.watch
+    self.addCleanup(watch.process.kill)
+    deadline = time.time() + 5
+    while self.screenlocker.watch_fds() and time.time() < deadline:
+      lazyblue._wait(0.1, self.screenlocker.watch_fds())
+      self.screenlocker.reap()
+    self.assertEqual(self.screenlocker.watch_fds(), [])
+    self.assertEqual(self.screenlocker.locked, False)
+    self.assertIs(self.screenlocker.watch, watch)
 
 class test_ForgroundScreenLocker(unittest.TestCase):
   def setUp(self):
@@ -145,6 +860,55 @@ class test_ForgroundScreenLocker(unittest.TestCase):
     self.assertIsNone(self.screenlocker.lock_shell)
     terminate.assert_called()
 
+  def test_lock_exit_wakes_up(self):
+    lazyblue.config.lock_command = "sleep 0.05"
+    screenlocker = lazyblue.ForegroundScreenLocker()
+    screenlocker.lock_screen()
+    self.assertEqual(screenlocker.is_locked(), True)
+    fds = screenlocker.watch_fds()
+    if fds:
+      self.assertEqual(lazyblue._wait(5, fds), fds)
+    else:
+      # No pidfd support here.
+      time.sleep(0.1)
+    screenlocker.lock_shell.wait()
+    self.assertEqual(screenlocker.is_locked(), False)
+    self.assertEqual(screenlocker.watch_fds(), [])
+
+  @mock.patch("os.getlogin")
+  @mock.patch("lazyblue._pidfd_open")
+  def test_vlock(self, pidfd_open, getlogin):
+    getlogin.return_value = "user"
+    pidfd_open.return_value = None
+    runner = mock.Mock(lazyblue.CommandRunner, autospec=True)
+    screenlocker = lazyblue.VlockScreenLocker(runner)
+    self.assertEqual(screenlocker.is_locked(), False)
+    screenlocker.lock_screen()
+    runner.run.assert_called_with("vlock", "sudo env USER=user vlock -a -n")
+    process = runner.run.return_value.process
+    process.returncode = None
+    self.assertEqual(screenlocker.is_locked(), True)
+    screenlocker.unlock_screen()
+    process.terminate.assert_called()
+    self.assertEqual(screenlocker.is_locked(), False)
+
+  @mock.patch("lazyblue._pidfd_open")
+  def test_relock_forgets_old_shell(self, pidfd_open):
+    pidfd_open.return_value = None
+    old_pidfd = self.screenlocker.lock_pidfd = os.open(os.devnull, os.O_RDONLY)
+    self.screenlocker.runner = mock.Mock(lazyblue.CommandRunner, autospec=True)
+    self.screenlocker.lock_screen()
+    self.assertIsNone(self.screenlocker.lock_pidfd)
+    self.assertRaises(OSError, os.fstat, old_pidfd)
+
+  @mock.patch("lazyblue._pidfd_send_signal")
+  def test_unlock_through_pidfd(self, pidfd_send_signal):
+    self.screenlocker.lock_pidfd = os.open(os.devnull, os.O_RDONLY)
+    self.screenlocker.unlock_screen()
+    pidfd_send_signal.assert_called()
+    self.assertIsNone(self.screenlocker.lock_pidfd)
+    self.assertIsNone(self.screenlocker.lock_shell)
+
   def test_is_locked(self):
     self.screenlocker.lock_shell.returncode = None
     self.assertEqual(self.screenlocker.is_locked(), True)
@@ -165,11 +929,14 @@ class test_Monitor(unittest.TestCase):
     self.connection = mock.Mock(lazyblue.Connection, autospec=True)
     self.screenlocker = mock.Mock(lazyblue.ScreenLocker, autospec=True)
     self.connection.get_signal_strength.return_value = -1
+    self.screenlocker.reap.return_value = []
+    self.screenlocker.next_deadline.return_value = None
+    self.screenlocker.watch_fds.return_value = []
     self.monitor = lazyblue.Monitor(self.connection, self.screenlocker)
 
   @mock.patch("lazyblue.Monitor.update")
   @mock.patch("time.sleep")
-  @mock.patch("time.time")
+  @mock.patch("lazyblue._monotonic")
   def test_poll(self, clock, sleep, update):
     # if it's time to call again it should.
     last_poll = self.monitor.last_poll = 500
@@ -177,7 +944,7 @@ class test_Monitor(unittest.TestCase):
     self.monitor.poll()
     self.assertEqual(sleep.call_count, 0)
     self.assertGreaterEqual(self.monitor.last_poll, last_poll + 5)
-    update.assertCalledWith(-1)
+    update.assert_called_with(-1, 505)
 
     # verify we block where necessary
     last_poll = self.monitor.last_poll = 515.5
@@ -204,12 +971,248 @@ class test_Monitor(unittest.TestCase):
     self.monitor.poll()
     self.assertEqual(self.monitor.last_rearm, 535)
 
+  @mock.patch("lazyblue.Monitor.poll_now")
+  @mock.patch("lazyblue.Monitor.handle_events")
+  @mock.patch("lazyblue._wait")
+  @mock.patch("lazyblue._monotonic")
+  def test_poll_events(self, clock, wait, handle_events, poll_now):
+    # events while waiting are handled without polling the signal
+    clock.return_value = 100
+    self.monitor.last_poll = 99.5
+    wait.side_effect = [[5], [5], []]
+    self.monitor.poll()
+    self.assertEqual(handle_events.call_count, 2)
+    self.assertEqual(poll_now.call_count, 1)
+    wait.assert_called_with(0.5, [])
+
+  @mock.patch("lazyblue.Monitor.poll_now")
+  @mock.patch("lazyblue.Monitor.next_deadline")
+  def test_child_exit_does_not_poll(self, next_deadline, poll_now):
+    # SIGCHLD interrupting the wait is handled like any event, not taken for
+    # the deadline.
+    self.addCleanup(signal.signal, signal.SIGCHLD,
+                    signal.getsignal(signal.SIGCHLD))
+    self.addCleanup(signal.set_wakeup_fd, -1)
+    self.addCleanup(setattr, lazyblue, "_wakeup_fd", None)
+    lazyblue._install_signal_wakeup()
+    start = lazyblue._monotonic()
+    next_deadline.return_value = start + 0.3
+    child = subprocess.Popen(["sleep", "0.05"])
+    self.addCleanup(child.wait)
+    self.monitor.poll()
+    self.assertGreaterEqual(lazyblue._monotonic() - start, 0.3)
+    self.assertEqual(poll_now.call_count, 1)
+
   @mock.patch("lazyblue.Monitor.transition")
   def test_update(self, transition):
     lazyblue.config.lock_strength = -10
     lazyblue.config.unlock_strength = -3
-    self.monitor.update(-8)
-    transition.assert_called_with(lazyblue._NEITHER)
+    self.monitor.update(-8, 100)
+    transition.assert_called_with(lazyblue._NEITHER, None, 100, False)
+    self.monitor.update(-8, 101.5)
+    transition.assert_called_with(lazyblue._NEITHER, 1.5, 101.5, False)
+
+  def test_predictive_lock(self):
+    lazyblue.config.update(lock_strength=-10, unlock_strength=-3, lock_time=6,
+                           lock_cooldown=0, predictive_lock=True,
+                           predict_window=4, predict_slope=-2,
+                           predict_horizon=3)
+    self.monitor = lazyblue.Monitor(self.connection, self.screenlocker)
+
+    # noise around a steady signal doesn't lock
+    for (now, strength) in enumerate([-4, -8, -5, -9, -4, -8, -6, -9]):
+      self.monitor.update(strength, now)
+    self.assertEqual(self.monitor.state, lazyblue._UNLOCKED)
+
+    # a steady fall locks once it is past unlock_strength and headed below
+    # lock_strength, well before lock_time
+    for (now, strength) in enumerate([-1, -1, -2, -4, -6], 10):
+      self.monitor.update(strength, now)
+      self.assertEqual(self.monitor.state, lazyblue._UNLOCKED)
+    self.monitor.update(-8, 15)
+    self.assertEqual(self.monitor.state, lazyblue._LOCKED)
+    self.assertEqual(self.monitor.last_locked, 15)
+
+  def test_link_lost(self):
+    lazyblue.config.update(lock_strength=-10, unlock_strength=-3, lock_time=6,
+                           lock_cooldown=0, link_loss_grace=2)
+    watcher = mock.Mock(lazyblue.LinkWatcher, autospec=True)
+    watcher.fileno.return_value = 9
+    watcher.take_lost.return_value = False
+    self.monitor.link_watcher = watcher
+    self.monitor.settings.overrides["device_mac"] = "mac"
+    self.assertEqual(self.monitor.watch_fds(), [9])
+    self.monitor.update(-1, 100)
+
+    # the link going down counts as the device gone, locking after the grace
+    watcher.take_lost.return_value = True
+    self.monitor.handle_events(100.5)
+    watcher.take_lost.assert_called_with("mac")
+    self.assertEqual(self.monitor.state, lazyblue._UNLOCKED)
+    self.assertEqual(self.monitor.deadlines()["lock"], 101.5)
+    watcher.take_lost.return_value = False
+    self.monitor.update(lazyblue._NOT_CONNECTED, 101.5)
+    self.assertEqual(self.monitor.state, lazyblue._LOCKED)
+    self.assertIsNone(self.monitor.link_lost_at)
+
+    # the device coming back in the grace period puts off the lock
+    self.monitor.state = lazyblue._UNLOCKED
+    self.monitor.update(-1, 200)
+    self.monitor.link_lost(200.5)
+    self.monitor.update(-1, 201)
+    self.assertIsNone(self.monitor.link_lost_at)
+    self.monitor.update(lazyblue._NOT_CONNECTED, 202)
+    self.monitor.update(lazyblue._NOT_CONNECTED, 204)
+    self.assertEqual(self.monitor.state, lazyblue._UNLOCKED)
+
+    # with no grace, it locks at once
+    lazyblue.config.link_loss_grace = 0
+    self.monitor.link_lost(205)
+    self.assertEqual(self.monitor.state, lazyblue._LOCKED)
+    self.assertEqual(self.monitor.last_locked, 205)
+
+  def test_filtered_update(self):
+    lazyblue.config.lock_strength = -10
+    lazyblue.config.unlock_strength = -3
+    lazyblue.config.filter = "median"
+    lazyblue.config.filter_window = 3
+    self.monitor = lazyblue.Monitor(self.connection, self.screenlocker)
+    # a single noisy reading doesn't start the lock count
+    for strength in (0, 0, -20, 0):
+      self.monitor.update(strength)
+      self.assertEqual(self.monitor.count, 0)
+    self.assertEqual(self.monitor.min_strength, -20)
+
+  def test_adaptive_interval(self):
+    lazyblue.config.lock_strength = -10
+    lazyblue.config.unlock_strength = -3
+    lazyblue.config.poll_interval = 1
+    lazyblue.config.adaptive_poll = True
+    lazyblue.config.min_poll_interval = 0.25
+    lazyblue.config.max_poll_interval = 4
+
+    # back off while the device stays here
+    intervals = []
+    for _ in range(5):
+      self.monitor.update(0)
+      intervals.append(self.monitor._poll_interval())
+    self.assertEqual(intervals, [1, 2, 4, 4, 4])
+
+    # burst near the thresholds
+    self.monitor.update(-5)
+    self.assertEqual(self.monitor._poll_interval(), 0.25)
+
+    # and while a lock is being considered, counting real time
+    self.monitor.update(-20)
+    self.assertEqual(self.monitor._poll_interval(), 0.25)
+    self.assertEqual(self.monitor.count, 0.25)
+
+    # steady again
+    self.monitor.update(0)
+    self.assertEqual(self.monitor._poll_interval(), 1)
+
+    lazyblue.config.adaptive_poll = False
+    self.assertEqual(self.monitor._poll_interval(), 1)
+
+  def test_elapsed_time(self):
+    lazyblue.config.lock_strength = -10
+    lazyblue.config.unlock_strength = -3
+    lazyblue.config.lock_time = 6
+
+    # a slow read counts as the time it took, the first reading as one
+    # poll interval.
+    self.monitor.update(-20, 100)
+    self.assertEqual(self.monitor.count, 1)
+    self.monitor.update(-20, 103.5)
+    self.assertEqual(self.monitor.count, 4.5)
+    self.monitor.update(-20, 105)
+    self.assertEqual(self.monitor.state, lazyblue._LOCKED)
+    self.assertEqual(self.monitor.last_locked, 105)
+
+  def test_command_finished(self):
+    lazyblue.config.lock_time = 6
+    command = lazyblue.Command("lock", None, 0, None)
+    command.returncode = 1
+    self.monitor.state = lazyblue._LOCKED
+    self.monitor.command_finished(command)
+    self.assertEqual(self.monitor.state, lazyblue._UNLOCKED)
+    self.assertEqual(self.monitor.count, 6)
+
+  def test_vlock_failed(self):
+    # vlock failing drops its pidfd, which would stay readable for good.
+    self.monitor.vlock = lazyblue.VlockScreenLocker(
+        mock.Mock(lazyblue.CommandRunner, autospec=True))
+    self.monitor.vlock.lock_shell = mock.Mock(subprocess.Popen)
+    self.monitor.vlock.lock_pidfd = os.open(os.devnull, os.O_RDONLY)
+    self.monitor.state = lazyblue._HARDENED
+    command = lazyblue.Command("vlock", None, 0, None)
+    command.returncode = 1
+    self.monitor.command_finished(command)
+    self.assertEqual(self.monitor.state, lazyblue._LOCKED)
+    self.assertEqual(self.monitor.vlock.watch_fds(), [])
+    self.assertIsNone(self.monitor.vlock.lock_shell)
+
+    # vlock failing to start leaves the screen locked
+    command.name = "vlock"
+    self.monitor.clock = lambda: 50
+    self.monitor.state = lazyblue._HARDENED
+    self.monitor.command_finished(command)
+    self.assertEqual(self.monitor.state, lazyblue._LOCKED)
+    self.assertEqual(self.monitor.last_locked, 50)
+
+    # other commands failing doesn't change state
+    self.monitor.state = lazyblue._LOCKED
+    command.name = "status"
+    self.monitor.command_finished(command)
+    self.assertEqual(self.monitor.state, lazyblue._LOCKED)
+
+  def test_lock_latency(self):
+    lazyblue.metrics = lazyblue.Metrics()
+    lazyblue.config.update(lock_strength=-10, unlock_strength=-3, lock_time=2,
+                           lock_cooldown=0, device_mac="mac")
+    self.monitor.clock = lambda: 104
+    self.screenlocker.locking = object()
+    for now in (99, 100, 101):
+      self.monitor.update(-5 if now == 99 else -20, now)
+    self.assertEqual(self.monitor.state, lazyblue._LOCKED)
+    self.assertEqual(lazyblue.metrics.counters,
+                     {("lazyblue_locks_total", (("device", "mac"),)): 1})
+    self.assertEqual(lazyblue.metrics.histograms, {})
+
+    # Locked once the lock command finishes.
+    command = lazyblue.Command("lock", None, 0, None)
+    command.returncode = 0
+    self.monitor.command_finished(command)
+    histogram = lazyblue.metrics.histograms[
+        ("lazyblue_lock_latency_seconds", (("device", "mac"),))]
+    self.assertEqual(histogram.sum, 4)
+
+  def test_deadlines(self):
+    lazyblue.config.lock_time = 6
+    lazyblue.config.lock_cooldown = 15
+    lazyblue.config.harden_time = 30
+    self.monitor.last_poll = self.monitor.last_sample = 100
+    self.assertEqual(self.monitor.deadlines(), {"poll": 101})
+
+    # pending lock, blocked by cooldown until 115
+    self.monitor.count = 2
+    self.monitor.last_locked = 100
+    self.assertEqual(self.monitor.deadlines(),
+                     {"poll": 101, "lock": 104, "rearm": 115})
+    self.assertEqual(self.monitor.next_deadline(), 101)
+
+    # deadlines that have passed are dropped
+    self.monitor.last_poll = self.monitor.last_sample = 108
+    self.monitor.count = 10
+    self.assertEqual(self.monitor.deadlines(), {"poll": 109, "rearm": 115})
+
+    # hardening
+    self.monitor.count = 0
+    self.monitor.state = lazyblue._LOCKED
+    self.monitor.last_poll = 120
+    self.assertEqual(self.monitor.deadlines(), {"poll": 121, "harden": 130})
+    lazyblue.config.poll_interval = 20
+    self.assertEqual(self.monitor.next_deadline(), 130)
 
   @mock.patch("lazyblue.Monitor.poll")
   def test_poll_loop(self, poll):
@@ -272,7 +1275,7 @@ class test_Monitor(unittest.TestCase):
             self.assertEqual(self.screenlocker.lock_screen.call_count, 0)
             self.assertEqual(self.screenlocker.unlock_screen.call_count, 0)
 
-  @mock.patch("time.time")
+  @mock.patch("lazyblue._monotonic")
   @mock.patch("sys.exit")
   def test_transition_lock_cooldown(self, sys_exit, clock):
     lazyblue.config.lock_time = 6
@@ -311,7 +1314,7 @@ class test_Monitor(unittest.TestCase):
     self.assertEqual(sys_exit.call_count, 0)
 
   @mock.patch("lazyblue.Monitor.transition")
-  @mock.patch("time.time")
+  @mock.patch("lazyblue._monotonic")
   def test_harden_lock(self, clock, transition):
     lazyblue.config.harden_time = 5
     self.monitor.count = 0
@@ -322,14 +1325,14 @@ class test_Monitor(unittest.TestCase):
     clock.return_value = 1027
     self.monitor.update(-255)
     self.monitor.vlock.lock_screen.assert_not_called()
-    transition.assert_called_with(lazyblue._GONE)
+    self.assertEqual(transition.call_args[0][0], lazyblue._GONE)
 
     clock.return_value = 1050
     self.monitor.update(-255)
     self.monitor.vlock.lock_screen.assert_called()
-    transition.assert_called_with(lazyblue._GONE)
+    self.assertEqual(transition.call_args[0][0], lazyblue._GONE)
 
-  @mock.patch("time.time")
+  @mock.patch("lazyblue._monotonic")
   def test_harden_unlock(self, clock):
     lazyblue.config.harden_time = 5
     self.monitor.last_rearm = 0
@@ -352,3 +1355,713 @@ class test_Monitor(unittest.TestCase):
     self.assertEqual(self.monitor.count, 0)
     self.assertEqual(self.monitor.state, lazyblue._UNLOCKED)
     self.monitor.vlock.unlock_screen.assert_called()
+
+  def test_vlock_exit_wakes_up(self):
+    self.monitor.state = lazyblue._HARDENED
+    self.monitor.vlock = mock.Mock(lazyblue.VlockScreenLocker, autospec=True)
+    self.monitor.vlock.reap.return_value = []
+    self.monitor.vlock.is_locked.return_value = False
+    self.monitor.handle_events(7)
+    self.assertEqual(self.monitor.state, lazyblue._UNLOCKED)
+    self.assertEqual(self.monitor.last_rearm, 7)
+    self.monitor.vlock.unlock_screen.assert_called()
+    self.screenlocker.unlock_screen.assert_called()
+
+  def test_hardened_lock_exit(self):
+    # the lock program exiting under vlock is noticed, so its pidfd doesn't
+    # keep waking the monitor.
+    self.monitor.state = lazyblue._HARDENED
+    self.monitor.vlock = mock.Mock(lazyblue.VlockScreenLocker, autospec=True)
+    self.monitor.vlock.reap.return_value = []
+    self.monitor.vlock.is_locked.return_value = True
+    self.screenlocker.watch_fds.return_value = [5]
+    self.monitor.handle_events(7)
+    self.screenlocker.is_locked.assert_called()
+    self.assertEqual(self.monitor.state, lazyblue._HARDENED)
+
+class test_reload(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "lazyblue.cfg")
+    self._write("lock_strength = -10\nfilter = median\n")
+    self.argv = ["lazyblue", "-c", self.path, "-m", "00:11:22:33:44:55"]
+    with mock.patch("sys.argv", self.argv):
+      lazyblue.config = lazyblue.parse_arguments()
+    self.monitor = lazyblue.Monitor(
+        mock.Mock(lazyblue.Connection, autospec=True),
+        mock.Mock(lazyblue.ScreenLocker, autospec=True),
+        lazyblue.DeviceConfig({"device_mac": "00:11:22:33:44:55"}))
+    self.monitor.min_strength = -7
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _write(self, options):
+    with open(self.path, "w") as fd:
+      fd.write("[Defaults]\n" + options)
+
+  def _reload(self):
+    with mock.patch("sys.argv", self.argv), mock.patch("sys.stderr"):
+      return lazyblue.reload_config([self.monitor])
+
+  def test_reload(self):
+    connection = self.monitor.connection
+    signal_filter = self.monitor.filter
+    trend = self.monitor.trend
+    self._write("lock_strength = -12\nfilter = median\n"
+                "[Device 00:11:22:33:44:55]\nlock_time = 3\n")
+    self.assertTrue(self._reload())
+    self.assertEqual(self.monitor.settings.lock_strength, -12)
+    self.assertEqual(self.monitor.settings.lock_time, 3)
+    self.assertIs(self.monitor.connection, connection)
+    self.assertIs(self.monitor.filter, signal_filter)
+    self.assertIs(self.monitor.trend, trend)
+    self.assertEqual(self.monitor.min_strength, -7)
+
+    self._write("lock_strength = -12\nfilter = ewma\npredict_window = 8\n")
+    self.assertTrue(self._reload())
+    self.assertIsInstance(self.monitor.filter, lazyblue.EwmaFilter)
+    self.assertEqual(len(self.monitor.trend.times.samples), 8)
+    self.assertEqual(self.monitor.settings.lock_time, 6)
+    self.monitor.screenlocker.stop_watch.assert_not_called()
+
+  def test_reload_watch(self):
+    # a changed or cleared watch_command is restarted, not left running
+    self._write("lock_strength = -10\nfilter = median\n"
+                "watch_command = xscreensaver-command -watch\n")
+    self.assertTrue(self._reload())
+    self.monitor.screenlocker.stop_watch.assert_called_once()
+    self._write("lock_strength = -10\nfilter = median\n")
+    self.assertTrue(self._reload())
+    self.assertEqual(self.monitor.screenlocker.stop_watch.call_count, 2)
+
+  def test_reject(self):
+    config = lazyblue.config
+    # invalid
+    self._write("lock_strength = -12\nfilter = bogus\n")
+    self.assertFalse(self._reload())
+    # unparseable
+    with open(self.path, "w") as fd:
+      fd.write("lock_strength = -12\n")
+    self.assertFalse(self._reload())
+    # needs a restart
+    self._write("lock_strength = -12\nrssi_backend = hcitool\n")
+    self.assertFalse(self._reload())
+    self.assertIs(lazyblue.config, config)
+    self.assertEqual(self.monitor.settings.lock_strength, -10)
+
+class test_MonitorPool(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+
+  def _monitor(self, poll_now):
+    monitor = mock.Mock(lazyblue.Monitor, autospec=True)
+    monitor.next_deadline.return_value = 0
+    monitor.poll_now.side_effect = poll_now
+    monitor.watch_fds.return_value = []
+    return monitor
+
+  def test_slow_device_does_not_block(self):
+    fast_polled = threading.Event()
+    polls = []
+
+    def slow():
+      # Blocks until the fast device has been polled several times.
+      self.assertTrue(fast_polled.wait(5))
+      raise SystemExit()
+
+    def fast():
+      polls.append(1)
+      if len(polls) == 3:
+        fast_polled.set()
+        raise SystemExit()
+
+    pool = lazyblue.MonitorPool([self._monitor(slow), self._monitor(fast)], 2)
+    pool.poll_loop()
+    self.assertEqual(len(polls), 3)
+
+  def test_errors_propagate(self):
+    def broken():
+      raise ValueError()
+    pool = lazyblue.MonitorPool([self._monitor(broken)], 1)
+    self.assertRaises(ValueError, pool.poll_loop)
+
+  def test_events_while_idle(self):
+    # an event, such as the link going down, is handled as it arrives
+    # rather than at the monitor's next poll
+    read_fd, write_fd = os.pipe()
+    self.addCleanup(os.close, read_fd)
+    self.addCleanup(os.close, write_fd)
+    monitor = self._monitor(None)
+    monitor.next_deadline.return_value = lazyblue._monotonic() + 60
+    monitor.watch_fds.return_value = [read_fd]
+    # the user unlocked by hand with rearm disabled
+    monitor.handle_events.side_effect = SystemExit()
+    writer = threading.Timer(0.02, os.write, (write_fd, "x"))
+    writer.start()
+    self.addCleanup(writer.join)
+    start = time.time()
+    lazyblue.MonitorPool([monitor], 1).poll_loop()
+    self.assertLess(time.time() - start, 5)
+    monitor.handle_events.assert_called_once()
+    monitor.poll_now.assert_not_called()
+
+class test_EventLoop(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+    self.loop = lazyblue.EventLoop()
+
+  def _pipe(self):
+    read_fd, write_fd = os.pipe()
+    self.addCleanup(os.close, read_fd)
+    self.addCleanup(os.close, write_fd)
+    return read_fd, write_fd
+
+  def test_timers(self):
+    calls = []
+    now = time.time()
+    self.loop.clock = time.time
+    self.loop.call_at(now + 0.02, lambda: calls.append(2))
+    self.loop.call_at(now + 0.01, lambda: calls.append(1))
+    cancelled = self.loop.call_at(now, lambda: calls.append(0))
+    self.loop.cancel(cancelled)
+    self.loop.call_at(now + 0.03, self.loop.stop)
+    self.loop.run()
+    self.assertEqual(calls, [1, 2])
+    self.assertGreaterEqual(time.time(), now + 0.03)
+
+  def test_readers(self):
+    read_fd, write_fd = self._pipe()
+    calls = []
+
+    def readable():
+      calls.append(os.read(read_fd, 10))
+      self.loop.remove_reader(read_fd)
+      self.loop.stop()
+
+    self.loop.add_reader(read_fd, readable)
+    self.loop.call_at(lazyblue._monotonic() + 0.01,
+                      lambda: os.write(write_fd, "x"))
+    self.loop.run()
+    self.assertEqual(calls, ["x"])
+    self.assertEqual(self.loop.readers, {})
+
+  def _monitor(self, connection_fds=()):
+    monitor = mock.Mock(lazyblue.Monitor, autospec=True)
+    monitor.connection = mock.Mock(lazyblue.Connection, autospec=True)
+    monitor.connection.watch_fds.return_value = list(connection_fds)
+    monitor.watch_fds.return_value = []
+    return monitor
+
+  def test_polls_when_due(self):
+    monitor = self._monitor()
+    deadline = [lazyblue._monotonic()]
+    polls = []
+
+    def poll_now():
+      polls.append(lazyblue._monotonic())
+      deadline[0] += 0.01
+      if len(polls) == 3:
+        raise SystemExit()
+
+    monitor.next_deadline.side_effect = lambda: deadline[0]
+    monitor.poll_now.side_effect = poll_now
+    lazyblue.run_event_loop([monitor], self.loop)
+    self.assertEqual(len(polls), 3)
+    self.assertGreater(polls[2] - polls[0], 0.015)
+
+  def test_reacts_to_events(self):
+    # the connection dropping polls at once, well before the deadline, and
+    # lock state events are handled without polling
+    drop_read, drop_write = self._pipe()
+    event_read, event_write = self._pipe()
+    monitor = self._monitor([drop_read])
+    monitor.watch_fds.return_value = [event_read]
+    monitor.next_deadline.return_value = lazyblue._monotonic() + 60
+
+    def handle_events(now):
+      os.read(event_read, 1)
+      os.write(drop_write, "x")
+
+    def poll_now():
+      os.read(drop_read, 1)
+      raise SystemExit()
+
+    monitor.handle_events.side_effect = handle_events
+    monitor.poll_now.side_effect = poll_now
+    os.write(event_write, "x")
+    start = time.time()
+    lazyblue.run_event_loop([monitor], self.loop)
+    self.assertLess(time.time() - start, 5)
+    self.assertEqual(monitor.handle_events.call_count, 1)
+    self.assertEqual(monitor.poll_now.call_count, 1)
+    self.assertEqual(self.loop.readers, {})
+
+  def test_errors_propagate(self):
+    monitor = self._monitor()
+    monitor.next_deadline.return_value = 0
+    monitor.poll_now.side_effect = ValueError()
+    self.assertRaises(ValueError, lazyblue.run_event_loop, [monitor],
+                      self.loop)
+
+class FakeBrokeredConnection(object):
+  def __init__(self, mac):
+    self.mac = mac
+    self.strength = -4
+    self.closed = False
+
+  def get_signal_strength(self):
+    return self.strength
+
+  def close(self):
+    self.closed = True
+
+class test_Broker(unittest.TestCase):
+  A = "00:11:22:33:44:55"
+  B = "AA:BB:CC:DD:EE:FF"
+
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+    lazyblue.config.poll_interval = 0.01
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    self.path = os.path.join(directory, "broker.sock")
+    self.connections = []
+    self.loop = lazyblue.EventLoop()
+    self.broker = lazyblue.Broker(self.path, self.loop, self._connection)
+    self.addCleanup(self.broker.close)
+
+  def _connection(self, mac):
+    connection = FakeBrokeredConnection(mac)
+    self.connections.append(connection)
+    return connection
+
+  def _client(self, *lines):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(self.path)
+    sock.sendall("".join(line + "\n" for line in lines))
+    sock.setblocking(False)
+    self.addCleanup(sock.close)
+    return sock
+
+  def _run_until(self, condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+      self.loop.run_once()
+    self.assertTrue(condition())
+
+  def _receive(self, sock, count):
+    """run the broker until count lines have come in on sock."""
+    received = [""]
+
+    def enough():
+      try:
+        received[0] += sock.recv(4096)
+      except socket.error:
+        pass
+      return received[0].count("\n") >= count
+
+    self._run_until(enough)
+    return received[0].splitlines()[:count]
+
+  def _await_line(self, sock, line):
+    """run the broker until line has come in on sock."""
+    received = [""]
+
+    def arrived():
+      try:
+        received[0] += sock.recv(4096)
+      except socket.error:
+        pass
+      return line in received[0].splitlines()
+
+    self._run_until(arrived)
+
+  def test_fan_out(self):
+    first = self._client("SUBSCRIBE " + self.A.lower(), "SUBSCRIBE " + self.B)
+    second = self._client("HELLO", "SUBSCRIBE " + self.A)
+    self.assertEqual(self._receive(second, 1),
+                     ["ERROR expected SUBSCRIBE MAC"])
+    self._run_until(lambda: len(self.broker.subscribers.get(self.A, ())) == 2)
+    # shared devices are connected to and read once
+    self.assertEqual(sorted(c.mac for c in self.connections), [self.A, self.B])
+
+    self.connections[0].strength = -7
+    self.connections[1].strength = lazyblue._NOT_CONNECTED
+    lines = self._receive(first, 40)
+    self.assertIn(self.A + " -7", lines)
+    self.assertIn(self.B + " -255", lines)
+    self.assertIn(self.A + " -7", self._receive(second, 20))
+
+  def test_unsubscribe(self):
+    self._client("SUBSCRIBE " + self.A)
+    self._run_until(lambda: self.A in self.broker.connections)
+    self.broker.clients.values()[0][0].shutdown(socket.SHUT_RDWR)
+    self._run_until(lambda: not self.broker.clients)
+    self.assertEqual(self.broker.connections, {})
+    self.assertTrue(self.connections[0].closed)
+
+  def test_peer_uid(self):
+    first, second = socket.socketpair()
+    self.addCleanup(first.close)
+    self.addCleanup(second.close)
+    self.assertEqual(lazyblue._peer_uid(first), os.getuid())
+
+  @mock.patch("lazyblue._peer_uid")
+  def test_refuses_other_users(self, peer_uid):
+    peer_uid.return_value = 12345
+    refused = self._client("SUBSCRIBE " + self.A)
+    self._await_line(refused, "ERROR not allowed")
+    self.assertEqual(self.broker.clients, {})
+    self.assertEqual(self.broker.connections, {})
+
+    self.broker.uids.add(12345)
+    self._client("SUBSCRIBE " + self.A)
+    self._run_until(lambda: self.A in self.broker.connections)
+
+  def test_limits(self):
+    lazyblue.config.update(broker_max_subscriptions=2, broker_max_devices=3)
+    macs = ["00:00:00:00:00:%02X" % index for index in range(4)]
+    first = self._client(*["SUBSCRIBE " + mac for mac in macs[:3]])
+    self._await_line(first, "ERROR too many subscriptions")
+    second = self._client(*["SUBSCRIBE " + mac for mac in macs[2:]])
+    self._await_line(second, "ERROR too many devices")
+    self.assertEqual(sorted(self.broker.connections), macs[:3])
+
+  def test_existing_socket(self):
+    # a broker already listening is left alone
+    self.assertRaises(socket.error, lazyblue.Broker, self.path,
+                      lazyblue.EventLoop(), self._connection)
+    self._client("SUBSCRIBE " + self.A)
+    self._run_until(lambda: self.A in self.broker.connections)
+
+    # but a socket left behind by one that died is replaced
+    self.broker.listener.close()
+    broker = lazyblue.Broker(self.path, lazyblue.EventLoop(),
+                             self._connection)
+    self.addCleanup(broker.close)
+    self.assertEqual(os.stat(self.path).st_mode & 0777, 0666)
+
+  def test_client(self):
+    client = lazyblue.BrokerClient(self.path, [self.A.lower()])
+    thread = threading.Thread(target=client.receive)
+    thread.daemon = True
+    thread.start()
+    connection = lazyblue.BrokerConnection(self.A, client.table)
+    self._run_until(lambda: connection.get_signal_strength() == -4)
+    # the broker going away ends the subscription
+    self.broker.close()
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+
+  @mock.patch("sys.stderr")
+  @mock.patch("time.sleep")
+  @mock.patch("lazyblue._peer_uid")
+  def test_client_refused(self, peer_uid, sleep, stderr):
+    lazyblue.config.update(connect_interval=1, max_connect_interval=4)
+    peer_uid.return_value = 12345
+    event_log = mock.Mock(lazyblue.EventLog, autospec=True)
+    client = lazyblue.BrokerClient(self.path, [self.A], event_log=event_log)
+    # StopIteration ends the client thread's loop for the test
+    sleep.side_effect = [None] * 5 + [StopIteration()]
+    thread = threading.Thread(target=self.assertRaises,
+                              args=(StopIteration, client._run))
+    thread.daemon = True
+    thread.start()
+    self._run_until(lambda: not thread.is_alive())
+    # retried more and more slowly, and reported once
+    self.assertEqual([c[0][0] for c in sleep.call_args_list],
+                     [1, 2, 4, 4, 4, 4])
+    self.assertEqual(stderr.write.call_count, 1)
+    self.assertIn("not allowed", stderr.write.call_args[0][0])
+    event_log.log.assert_called_once_with("broker_error",
+                                          message="not allowed")
+
+    # a reading resets the back-off
+    client.handle_line(self.A + " -3\n")
+    self.assertEqual(client.failures, 0)
+    client.handle_line("ERROR not allowed\n")
+    self.assertEqual(stderr.write.call_count, 2)
+
+class test_Metrics(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+    self.metrics = lazyblue.Metrics()
+
+  def test_render(self):
+    self.metrics.increment("lazyblue_locks_total", (("device", "a"),))
+    self.metrics.increment("lazyblue_locks_total", (("device", "a"),))
+    self.metrics.observe("lazyblue_rssi_read_seconds", 0.002)
+    self.metrics.observe("lazyblue_rssi_read_seconds", 20)
+    lines = self.metrics.render().splitlines()
+    self.assertIn("# TYPE lazyblue_locks_total counter", lines)
+    self.assertIn('lazyblue_locks_total{device="a"} 2', lines)
+    self.assertIn("# TYPE lazyblue_rssi_read_seconds histogram", lines)
+    self.assertIn('lazyblue_rssi_read_seconds_bucket{le="0.001"} 0', lines)
+    self.assertIn('lazyblue_rssi_read_seconds_bucket{le="0.005"} 1', lines)
+    self.assertIn('lazyblue_rssi_read_seconds_bucket{le="10"} 1', lines)
+    self.assertIn('lazyblue_rssi_read_seconds_bucket{le="+Inf"} 2', lines)
+    self.assertIn("lazyblue_rssi_read_seconds_sum 20.002", lines)
+    self.assertIn("lazyblue_rssi_read_seconds_count 2", lines)
+
+  def test_write_if_due(self):
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, "metrics")
+      lazyblue.config.metrics_file = path
+      self.metrics.increment("lazyblue_locks_total")
+      self.metrics.write_if_due()
+      self.metrics.increment("lazyblue_locks_total")
+      self.metrics.write_if_due()
+      with open(path) as fd:
+        self.assertIn("lazyblue_locks_total 1\n", fd.read())
+      self.assertEqual(os.listdir(directory), ["metrics"])
+    finally:
+      shutil.rmtree(directory)
+
+class test_Profiler(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+    self.profiler = lazyblue.Profiler()
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+
+  def test_disabled(self):
+    self.profiler.add("poll", 1)
+    self.assertEqual(self.profiler.stages, {})
+
+  def test_render(self):
+    self.profiler.enabled = True
+    self.profiler.add("poll", 0.004)
+    self.profiler.add("poll", 0.002)
+    self.profiler.add("rssi_read", 0.001)
+    lines = self.profiler.render().splitlines()
+    self.assertEqual(len(lines), 3)
+    self.assertEqual(lines[1].split(), ["poll", "2", "0.006", "3.000", "4.000"])
+    self.assertEqual(lines[2].split(),
+                     ["rssi_read", "1", "0.001", "1.000", "1.000"])
+
+  @mock.patch("lazyblue.profiler", new_callable=lazyblue.Profiler)
+  def test_poll_stages(self, profiler):
+    profiler.enabled = True
+    lazyblue.config.profile = os.path.join(self.directory, "profile")
+    connection = mock.Mock(lazyblue.Connection, autospec=True)
+    connection.get_signal_strength.return_value = -1
+    screenlocker = mock.Mock(lazyblue.ScreenLocker, autospec=True)
+    screenlocker.reap.return_value = []
+    monitor = lazyblue.Monitor(connection, screenlocker)
+    monitor.vlock = screenlocker
+    monitor.poll_now()
+    monitor.poll_now()
+    self.assertEqual(sorted(profiler.stages),
+                     ["events", "is_locked", "poll", "signal", "update"])
+    self.assertEqual(profiler.stages["poll"][0], 2)
+    with open(lazyblue.config.profile) as fd:
+      self.assertIn("  signal", fd.read())
+
+  def test_cprofile(self):
+    path = os.path.join(self.directory, "profile.pstats")
+    self.assertEqual(self.profiler.call(sum, [1, 2]), 3)
+    self.profiler.toggle_cprofile(path)
+    thread = threading.Thread(target=self.profiler.call, args=(sum, [3]))
+    thread.start()
+    thread.join()
+    self.assertEqual(self.profiler.call(sum, [1, 2]), 3)
+    self.assertEqual(len(self.profiler.profiles), 2)
+    self.profiler.toggle_cprofile(path)
+    self.assertIsNone(self.profiler.profiles)
+    stats = pstats.Stats(path)
+    self.assertEqual(
+        sum(calls for ((_, _, name), (_, calls, _, _, _))
+            in stats.stats.items() if "sum" in name), 2)
+
+class test_trace(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "trace")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_round_trip(self):
+    writer = lazyblue.TraceWriter(self.path)
+    writer.record(1000.5, -3, lazyblue._UNLOCKED)
+    writer.record(1001.5, -255, lazyblue._LOCKED)
+    # buffered until flushed
+    self.assertEqual(lazyblue.read_trace(self.path), [])
+    writer.close()
+    self.assertEqual(lazyblue.read_trace(self.path),
+                     [(1000.5, -3, lazyblue._UNLOCKED),
+                      (1001.5, -255, lazyblue._LOCKED)])
+
+    # appends to an existing trace
+    writer = lazyblue.TraceWriter(self.path)
+    writer.record(1002.5, 0, lazyblue._HARDENED)
+    writer.close()
+    self.assertEqual(len(lazyblue.read_trace(self.path)), 3)
+
+  def test_rotation(self):
+    record_size = lazyblue._TRACE_RECORD.size
+    writer = lazyblue.TraceWriter(self.path, 6 + 2 * record_size, 2)
+    for index in range(5):
+      writer.record(index, 0, lazyblue._UNLOCKED)
+      writer.flush()
+    writer.close()
+    self.assertEqual([r[0] for r in lazyblue.read_trace(self.path)], [4])
+    self.assertEqual([r[0] for r in lazyblue.read_trace(self.path + ".1")],
+                     [2, 3])
+    self.assertEqual([r[0] for r in lazyblue.read_trace(self.path + ".2")],
+                     [0, 1])
+    self.assertFalse(os.path.exists(self.path + ".3"))
+
+  @mock.patch("lazyblue._monotonic")
+  def test_flush_if_due(self, clock):
+    clock.return_value = 100
+    writer = lazyblue.TraceWriter(self.path)
+    writer.record(1000.5, -3, lazyblue._UNLOCKED)
+    writer.flush_if_due()
+    self.assertEqual(lazyblue.read_trace(self.path), [])
+    # flushed once FLUSH_SECONDS pass, even with no more records
+    clock.return_value = 100 + writer.FLUSH_SECONDS
+    writer.flush_if_due()
+    self.assertEqual(lazyblue.read_trace(self.path),
+                     [(1000.5, -3, lazyblue._UNLOCKED)])
+    writer.close()
+
+  def test_bad_trace(self):
+    with open(self.path, "w") as fd:
+      fd.write("not a trace")
+    self.assertRaises(ValueError, lazyblue.read_trace, self.path)
+
+  def test_replay(self):
+    lazyblue.config.lock_strength = -10
+    lazyblue.config.unlock_strength = -3
+    lazyblue.config.lock_time = 6
+    lazyblue.config.unlock_time = 1
+    lazyblue.config.lock_cooldown = 0
+    records = ([(t, 0, lazyblue._UNLOCKED) for t in range(10)] +
+               [(t, -20, lazyblue._UNLOCKED) for t in range(10, 30)] +
+               [(t, 0, lazyblue._LOCKED) for t in range(30, 35)])
+    self.assertEqual(lazyblue.replay(records), [("lock", 15), ("unlock", 30)])
+
+class test_EventLog(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "events")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _events(self):
+    with open(self.path) as fd:
+      return [json.loads(line) for line in fd]
+
+  def test_changes(self):
+    log = lazyblue.EventLog(self.path, summary_interval=10)
+    for (now, strength) in enumerate([0, -1, -20, -20, -20]):
+      state = lazyblue._LOCKED if now >= 4 else lazyblue._UNLOCKED
+      signal_state = lazyblue._GONE if strength < -10 else lazyblue._HERE
+      log.reading("mac", strength, strength, signal_state, state, now)
+    log.reading("mac", -20, -20, lazyblue._GONE, lazyblue._LOCKED, 10)
+    log.close()
+    events = self._events()
+    self.assertEqual([(e["event"], e.get("strength")) for e in events],
+                     [("change", 0), ("change", -20), ("change", -20),
+                      ("summary", None)])
+    self.assertEqual(events[2]["state"], lazyblue._LOCKED)
+    self.assertEqual(events[3]["readings"], 6)
+    self.assertEqual(events[3]["min_strength"], -20)
+    self.assertEqual(events[3]["max_strength"], 0)
+
+  def test_all(self):
+    log = lazyblue.EventLog(self.path, mode="all")
+    for now in range(3):
+      log.reading("mac", -5, -4.24, lazyblue._HERE, lazyblue._UNLOCKED, now)
+    # buffered until flushed
+    self.assertEqual(self._events(), [])
+    log.close()
+    events = self._events()
+    self.assertEqual(len(events), 3)
+    self.assertEqual(events[0]["filtered"], -4.2)
+    self.assertEqual(events[0]["device"], "mac")
+
+  def test_rotation_at_open(self):
+    log = lazyblue.EventLog(self.path)
+    for index in range(3):
+      log.log("test", index=index)
+    log.close()
+    # already over a smaller limit, so rotated before anything is added
+    log = lazyblue.EventLog(self.path, os.path.getsize(self.path), 1)
+    log.log("test", index=3)
+    log.close()
+    self.assertEqual([e["index"] for e in self._events()], [3])
+    with open(self.path + ".1") as fd:
+      self.assertEqual([json.loads(line)["index"] for line in fd], [0, 1, 2])
+
+class test_tune(unittest.TestCase):
+  def setUp(self):
+    lazyblue.config = Config(lazyblue.DEFAULT_OPTIONS)
+    lazyblue.config.lock_cooldown = 0
+    lazyblue.config.false_lock_window = 5
+
+  def test_parse_range(self):
+    self.assertEqual(lazyblue._parse_range("1:4"), [1, 2, 3, 4])
+    self.assertEqual(lazyblue._parse_range("-14:-6:4"), [-14, -10, -6])
+
+  def test_evaluate_strengths(self):
+    records = ([(t, 0, lazyblue._UNLOCKED) for t in range(10)] +
+               [(t, -20, lazyblue._UNLOCKED) for t in range(10, 12)] +
+               [(t, 0, lazyblue._UNLOCKED) for t in range(12, 20)] +
+               [(t, lazyblue._NOT_CONNECTED, lazyblue._UNLOCKED)
+                for t in range(20, 30)] +
+               [(t, 0, lazyblue._LOCKED) for t in range(30, 35)])
+    lazyblue._tune_init(records)
+    self.assertEqual(lazyblue._tune_departures, [(20, 30)])
+    results = dict(lazyblue._evaluate_strengths(((-10, -3), [(2, 1), (6, 1)])))
+
+    # Locks on the brief dip and again on departing.
+    jumpy = results[(-10, -3, 2, 1)]
+    self.assertEqual(jumpy["locks"], 2)
+    self.assertEqual(jumpy["false_locks"], 1)
+    self.assertEqual(jumpy["missed_locks"], 0)
+
+    patient = results[(-10, -3, 6, 1)]
+    self.assertEqual(patient["locks"], 1)
+    self.assertEqual(patient["false_locks"], 0)
+    self.assertEqual(patient["missed_locks"], 0)
+    self.assertEqual(patient["lock_latency"], 5)
+    self.assertEqual(patient["unlock_latency"], 0)
+
+  def test_matches_replay(self):
+    records = [(t, [0, -20, -5, lazyblue._NOT_CONNECTED][(t // 7) % 4],
+                lazyblue._UNLOCKED) for t in range(200)]
+    lazyblue._tune_init(records)
+    lazyblue.config.update(lock_strength=-10, unlock_strength=-3,
+                           lock_time=4, unlock_time=2)
+    expected = lazyblue.replay(records)
+    result = dict(lazyblue._evaluate_strengths(((-10, -3), [(4, 2)])))
+    self.assertEqual(result[(-10, -3, 4, 2)]["locks"],
+                     len([e for e in expected if e[0] == "lock"]))
+
+class test_startup(unittest.TestCase):
+  # Seconds that starting up and writing the config may take.
+  BUDGET = 1.0
+
+  def test_cold_start(self):
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, "lazyblue.cfg")
+      script = ("import sys, lazyblue; lazyblue.main(); "
+                "print sorted(m for m in sys.modules if 'bluetooth' in m)")
+      start = time.time()
+      output = subprocess.check_output(
+          [sys.executable, "-c", script, "-m", "00:11:22:33:44:55",
+           "--write_config", path],
+          cwd=os.path.dirname(os.path.abspath(lazyblue.__file__)))
+      elapsed = time.time() - start
+      self.assertEqual(output.strip(), "[]")
+      self.assertTrue(os.path.exists(path))
+      self.assertLess(elapsed, self.BUDGET)
+    finally:
+      shutil.rmtree(directory)